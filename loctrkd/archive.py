@@ -0,0 +1,28 @@
+""" Move old events into compressed archive blocks """
+
+from configparser import ConfigParser
+from logging import getLogger
+from time import time
+
+from . import common
+from .evstore import archive, initdb
+
+log = getLogger("loctrkd/archive")
+
+ARCHIVEAFTER: int = 0  # Disabled unless configured
+
+
+def main(conf: ConfigParser) -> None:
+    days = conf.getint("storage", "archiveafter", fallback=ARCHIVEAFTER)
+    if days <= 0:
+        log.info("Archiving is disabled")
+        return
+    dbfn = conf.get("storage", "dbfn")
+    # Storage daemon may be running, it is the one to migrate the schema
+    initdb(dbfn, migrate=False)
+    count = archive(time() - days * 86400)
+    log.info("archived %d events older than %d days in %s", count, days, dbfn)
+
+
+if __name__.endswith("__main__"):
+    main(common.init(log))
@@ -50,15 +50,18 @@ PROTO_PREFIX = "BS:"
 
 MAXBUFFER: int = 65557  # Theoretical max buffer 65536 + 21
 RE = re.compile(b"\[(\w\w)\*(\d{10})\*([0-9a-fA-F]{4})\*")
+HDRLEN: int = 20  # Length of the string that RE matches
 
 
-def _framestart(buffer: bytes) -> Tuple[int, str, str, int]:
+def _framestart(
+    buffer: Union[bytes, bytearray], pos: int = 0
+) -> Tuple[int, str, str, int]:
     """
-    Find the start of the frame in the buffer.
+    Find the start of the frame in the buffer, starting from `pos`.
     If found, return (offset, vendorId, imei, datalen) tuple.
     If not found, set -1 as the value of `offset`
     """
-    mo = RE.search(buffer)
+    mo = RE.search(buffer, pos)
     return (
         (
             mo.start(),
@@ -73,7 +76,9 @@ def _framestart(buffer: bytes) -> Tuple[int, str, str, int]:
 
 class Stream:
     def __init__(self) -> None:
-        self.buffer = b""
+        self.buffer = bytearray()
+        self.offset = 0  # Start of not yet consumed data in the buffer
+        self.scanned = 0  # Position up to which header was looked for
         self.imei: Optional[str] = None
         self.datalen: int = 0
 
@@ -83,23 +88,35 @@ class Stream:
         packets as `bytes` and error messages as `str`.
         """
         when = time()
+        if self.offset and self.offset >= len(self.buffer) // 2:
+            # Consumed part is big enough to be worth moving the rest
+            del self.buffer[: self.offset]
+            self.scanned -= self.offset
+            self.offset = 0
         self.buffer += segment
-        if len(self.buffer) > MAXBUFFER:
+        if len(self.buffer) - self.offset > MAXBUFFER:
             # We are receiving junk. Let's drop it or we run out of memory.
-            self.buffer = b""
+            self.buffer.clear()
+            self.offset = self.scanned = 0
             return [f"More than {MAXBUFFER} unparseable data, dropping"]
         msgs: List[Union[bytes, str]] = []
+        buffer = self.buffer
         while True:
             if not self.datalen:  # we have not seen packet start yet
-                toskip, _, imei, datalen = _framestart(self.buffer)
-                if toskip < 0:  # No frames, continue reading
+                # Header could have been cut at the end of previous scan
+                start, _, imei, datalen = _framestart(
+                    buffer, max(self.offset, self.scanned - HDRLEN + 1)
+                )
+                if start < 0:  # No frames, continue reading
+                    self.scanned = len(buffer)
                     break
+                toskip = start - self.offset
                 if toskip > 0:  # Should not happen, report
                     msgs.append(
                         f"Skipping {toskip} bytes of undecodable data"
-                        f' "{self.buffer[:toskip][:64]=!r}"'
+                        f' "{bytes(buffer[self.offset:start][:64])!r}"'
                     )
-                    self.buffer = self.buffer[toskip:]
+                    self.offset = start
                     # From this point, buffer starts with a packet header
                 if self.imei is None:
                     self.imei = imei
@@ -109,23 +126,27 @@ class Stream:
                         f" previous value {self.imei}, old value kept"
                     )
                 self.datalen = datalen
-            if len(self.buffer) < self.datalen + 21:  # Incomplete packet
+            frameend = self.offset + self.datalen + 21
+            if len(buffer) < frameend:  # Incomplete packet
                 break
             # At least one complete packet is present in the buffer
-            if chr(self.buffer[self.datalen + 20]) == "]":
-                msgs.append(self.buffer[: self.datalen + 21])
+            if chr(buffer[frameend - 1]) == "]":
+                with memoryview(buffer) as view:
+                    msgs.append(bytes(view[self.offset : frameend]))
             else:
                 msgs.append(
                     f"Packet does not end with ']'"
-                    f" at {self.datalen+20}: {self.buffer[:64]=!r}"
+                    f" at {self.datalen+20}:"
+                    f" {bytes(buffer[self.offset:self.offset+64])!r}"
                 )
-            self.buffer = self.buffer[self.datalen + 21 :]
+            self.offset = self.scanned = frameend
             self.datalen = 0
         return msgs
 
     def close(self) -> bytes:
-        ret = self.buffer
-        self.buffer = b""
+        ret = bytes(self.buffer[self.offset :])
+        self.buffer.clear()
+        self.offset = self.scanned = 0
         self.imei = None
         self.datalen = 0
         return ret
@@ -381,6 +402,10 @@ class _LOC_DATA(BeeSurePkt):
         self.latitude = p.lat * p.nors
         self.longitude = p.lon * p.eorw
 
+    def wifi_scan(self) -> List[Tuple[str, int]]:
+        # Access points seen when the position was taken, to learn from
+        return [(mac, sig) for _, mac, sig in self.wifi_aps]
+
     def rectified(self) -> Report:
         # self.gps_valid is supposed to mean it, but it does not. Perfectly
         # good looking coordinates, with ten satellites, still get 'V'.
@@ -1,9 +1,13 @@
 """ TCP server that communicates with terminals """
 
 from configparser import ConfigParser
+from heapq import heappop, heappush
 from importlib import import_module
 from logging import getLogger
-from os import umask
+from multiprocessing import Process
+from os import kill, umask
+from resource import getrlimit, RLIMIT_NOFILE
+from select import epoll, EPOLLERR, EPOLLET, EPOLLHUP, EPOLLIN, EPOLLOUT
 from socket import (
     socket,
     AF_INET6,
@@ -11,19 +15,145 @@ from socket import (
     SOL_SOCKET,
     SO_KEEPALIVE,
     SO_REUSEADDR,
+    SO_REUSEPORT,
 )
+from signal import signal, SIGINT, SIG_IGN
 from struct import pack
-from time import time
+from sys import exit
+from time import sleep, time
 from typing import Any, Dict, List, Optional, Set, Tuple, Union
 import zmq
 
 from . import common
 from .protomodule import ProtoModule
-from .zmsg import Bcast, Resp
+from .zmsg import Bcast, Resp, rtopic
 
 log = getLogger("loctrkd/collector")
 
 MAXBUFFER: int = 4096
+MAXSENDBUFFER: int = 65536
+LISTENBACKLOG: int = 128
+IDLETIMEOUT: int = 3600
+# Worker that exits sooner than this after start is restarted with
+# growing delay, up to the maximum, and when this happens too many times
+# in a row, the collector gives up.
+STARTUPTIME: float = 10.0
+MAXRESTARTDELAY: float = 60.0
+MAXRESTARTS: int = 5
+
+
+class EPoller:
+    """
+    Drop-in replacement for the subset of `zmq.Poller` API that we use,
+    built on Linux `epoll`. File descriptors are added and removed from
+    the kernel's interest list incrementally, and `poll()` only returns
+    the fds that have events, so the cost of an iteration does not depend
+    on the number of connected terminals. Zmq sockets expose an
+    edge-triggered fd that only signals that socket's state _may_ have
+    changed, so they are registered with EPOLLET, and real readiness is
+    taken from their `zmq.EVENTS` option.
+    """
+
+    def __init__(self) -> None:
+        self.ep = epoll()
+        self.zsocks: Dict[int, Tuple[Any, int]] = {}
+
+    @staticmethod
+    def _epflags(flags: int) -> int:
+        return (EPOLLIN if flags & zmq.POLLIN else 0) | (
+            EPOLLOUT if flags & zmq.POLLOUT else 0
+        )
+
+    @staticmethod
+    def _zflags(epflags: int) -> int:
+        # Hangup and error are reported as readability, so that the
+        # consumer would try to read and discover the condition
+        return (
+            (zmq.POLLIN if epflags & (EPOLLIN | EPOLLHUP | EPOLLERR) else 0)
+            | (zmq.POLLOUT if epflags & EPOLLOUT else 0)
+            | (zmq.POLLERR if epflags & EPOLLERR else 0)
+        )
+
+    def register(self, sock: Any, flags: int = zmq.POLLIN) -> None:
+        if isinstance(sock, int):
+            self.ep.register(sock, self._epflags(flags))
+        else:
+            fd = sock.getsockopt(zmq.FD)
+            self.zsocks[fd] = (sock, flags)
+            self.ep.register(fd, EPOLLIN | EPOLLET)
+
+    def modify(self, sock: Any, flags: int = zmq.POLLIN) -> None:
+        if isinstance(sock, int):
+            self.ep.modify(sock, self._epflags(flags))
+        else:
+            self.zsocks[sock.getsockopt(zmq.FD)] = (sock, flags)
+
+    def unregister(self, sock: Any) -> None:
+        if isinstance(sock, int):
+            self.ep.unregister(sock)
+        else:
+            fd = sock.getsockopt(zmq.FD)
+            self.ep.unregister(fd)
+            del self.zsocks[fd]
+
+    def _zready(self) -> List[Tuple[Any, int]]:
+        result = []
+        for zsock, flags in self.zsocks.values():
+            zevents = zsock.getsockopt(zmq.EVENTS) & flags
+            if zevents:
+                result.append((zsock, zevents))
+        return result
+
+    def poll(self, timeout: Optional[int] = None) -> List[Tuple[Any, int]]:
+        """Timeout in milliseconds, like in `zmq.Poller.poll()`"""
+        # Zmq socket may hold messages that arrived before the last edge
+        if self._zready():
+            timeout = 0
+        events = self.ep.poll(-1 if timeout is None else timeout / 1000)
+        result = [
+            (fd, self._zflags(fl))
+            for fd, fl in events
+            if fd not in self.zsocks
+        ]
+        return self._zready() + result
+
+    def close(self) -> None:
+        self.ep.close()
+
+
+class Publisher:
+    """
+    Publish `Bcast`s on the zmq socket, one message per `Bcast`, or,
+    when `batch` is set, accumulate them and publish on `flush()` as
+    multipart messages. Because subscription filter is only applied to
+    the first part, a multipart message only holds a run of consecutive
+    `Bcast`s with the same prefix that `topic()` can match: direction,
+    proto and IMEI. When the prefix changes, a new group is started, so
+    that messages keep the order in which they were sent.
+    """
+
+    TOPICLEN = 33
+
+    def __init__(self, zpub: Any, batch: bool = False) -> None:
+        self.zpub = zpub
+        self.batch = batch
+        self.pending: List[Tuple[bytes, List[bytes]]] = []
+
+    def send(self, bcast: Bcast) -> None:
+        packed = bcast.packed
+        if self.batch:
+            prefix = packed[: self.TOPICLEN]
+            if self.pending and self.pending[-1][0] == prefix:
+                self.pending[-1][1].append(packed)
+            else:
+                self.pending.append((prefix, [packed]))
+        else:
+            self.zpub.send(packed)
+
+    def flush(self) -> None:
+        for _, parts in self.pending:
+            self.zpub.send_multipart(parts)
+        self.pending.clear()
 
 
 class Client:
@@ -35,6 +165,8 @@ class Client:
         self.pmod: Optional[ProtoModule] = None
         self.stream: Optional[ProtoModule.Stream] = None
         self.imei: Optional[str] = None
+        self.outbuf = bytearray()
+        self.lastseen = time()
 
     def close(self) -> None:
         log.debug("Closing fd %d (IMEI %s)", self.sock.fileno(), self.imei)
@@ -52,6 +184,8 @@ class Client:
         """Read from the socket and parse complete messages"""
         try:
             segment = self.sock.recv(MAXBUFFER)
+        except BlockingIOError:  # Spurious wakeup, nothing to read
+            return []
         except OSError as e:
             log.warning(
                 "Reading from fd %d (IMEI %s): %s",
@@ -67,6 +201,7 @@ class Client:
                 self.imei,
             )
             return None
+        self.lastseen = time()
         if self.stream is None:
             self.pmod = common.probe_pmod(segment)
             if self.pmod is not None:
@@ -94,41 +229,120 @@ class Client:
         return msgs
 
     def send(self, buffer: bytes) -> None:
+        """Queue the message, it will be sent out by `write()`"""
         assert self.stream is not None and self.pmod is not None
-        try:
-            self.sock.send(self.pmod.enframe(buffer, imei=self.imei))
-        except OSError as e:
-            log.error(
-                "Sending to fd %d (IMEI %s): %s",
-                self.sock.fileno(),
-                self.imei,
-                e,
-            )
+        self.outbuf += self.pmod.enframe(buffer, imei=self.imei)
+
+    def write(self) -> bool:
+        """Send out as much as possible, return True if anything is left"""
+        if self.outbuf:
+            try:
+                sent = self.sock.send(self.outbuf)
+                del self.outbuf[:sent]
+            except BlockingIOError:
+                pass
+            except OSError as e:
+                log.error(
+                    "Sending to fd %d (IMEI %s): %s",
+                    self.sock.fileno(),
+                    self.imei,
+                    e,
+                )
+                self.outbuf.clear()
+        return bool(self.outbuf)
 
 
 class Clients:
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        poller: Any,
+        subscriber: Any = None,
+        maxsendbuffer: int = MAXSENDBUFFER,
+        idletimeout: int = IDLETIMEOUT,
+        maxconnections: int = 0,
+    ) -> None:
+        self.poller = poller
+        self.subscriber = subscriber
+        self.maxsendbuffer = maxsendbuffer
+        self.idletimeout = idletimeout
+        if maxconnections <= 0:  # Leave some fds for zmq and logging
+            maxconnections = getrlimit(RLIMIT_NOFILE)[0] - 64
+        self.maxconnections = maxconnections
         self.by_fd: Dict[int, Client] = {}
         self.by_imei: Dict[str, Client] = {}
+        self.towrite: Set[int] = set()  # have data queued
+        self.towait: Set[int] = set()  # also registered for POLLOUT
+        # Heap of (deadline, seqno, fd, client). May contain entries of
+        # the clients that are already gone, they are skipped on expiry.
+        self.deadlines: List[Tuple[float, int, int, Client]] = []
+        self.seqno = 0
 
     def fds(self) -> Set[int]:
         return set(self.by_fd.keys())
 
-    def add(self, clntsock: socket, clntaddr: Any) -> int:
+    def _arm(self, fd: int, clnt: Client) -> None:
+        self.seqno += 1
+        heappush(
+            self.deadlines,
+            (clnt.lastseen + self.idletimeout, self.seqno, fd, clnt),
+        )
+
+    def add(self, clntsock: socket, clntaddr: Any) -> Optional[int]:
         fd = clntsock.fileno()
+        if len(self.by_fd) >= self.maxconnections:
+            log.warning(
+                "Already %d connections, refusing fd %d from %s",
+                len(self.by_fd),
+                fd,
+                clntaddr,
+            )
+            clntsock.close()
+            return None
         log.info("Start serving fd %d from %s", fd, clntaddr)
-        self.by_fd[fd] = Client(clntsock, clntaddr)
+        clntsock.setblocking(False)
+        clnt = Client(clntsock, clntaddr)
+        self.by_fd[fd] = clnt
+        self.poller.register(fd, flags=zmq.POLLIN)
+        if self.idletimeout > 0:
+            self._arm(fd, clnt)
         return fd
 
+    def reap(self, now: float) -> None:
+        """
+        Close connections that were silent for longer than `idletimeout`.
+        Only looks at the clients whose deadline has come: those that
+        were active since get rescheduled.
+        """
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, _, fd, clnt = heappop(self.deadlines)
+            if self.by_fd.get(fd) is not clnt:  # Already gone
+                continue
+            if clnt.lastseen + self.idletimeout > now:
+                self._arm(fd, clnt)
+            else:
+                log.info(
+                    "Fd %d (IMEI %s) idle since %s, closing",
+                    fd,
+                    clnt.imei,
+                    clnt.lastseen,
+                )
+                self.stop(fd)
+
     def stop(self, fd: int) -> None:
         if fd not in self.by_fd:
             log.debug("Fd %d is not served, ingore stop", fd)
             return
         clnt = self.by_fd[fd]
         log.info("Stop serving fd %d (IMEI %s)", clnt.sock.fileno(), clnt.imei)
+        # Must unregister before close, epoll forgets closed fds by itself
+        self.poller.unregister(fd)
+        self.towrite.discard(fd)
+        self.towait.discard(fd)
         clnt.close()
         if clnt.imei and self.by_imei[clnt.imei] == clnt:  # could be replaced
             del self.by_imei[clnt.imei]
+            if self.subscriber is not None:
+                self.subscriber.setsockopt(zmq.UNSUBSCRIBE, rtopic(clnt.imei))
         del self.by_fd[fd]
 
     def recv(
@@ -155,6 +369,10 @@ class Clients:
                         log.info("Removing stale connection on fd %d", oldfd)
                         oldclnt.imei = None
                         self.stop(oldfd)
+                    elif self.subscriber is not None:
+                        self.subscriber.setsockopt(
+                            zmq.SUBSCRIBE, rtopic(clnt.imei)
+                        )
                     self.by_imei[clnt.imei] = clnt
             result.append((clnt.pmod, clnt.imei, when, peeraddr, packet))
             log.debug(
@@ -169,35 +387,106 @@ class Clients:
         if resp.imei in self.by_imei:
             clnt = self.by_imei[resp.imei]
             clnt.send(resp.packet)
+            self.towrite.add(clnt.sock.fileno())
             return clnt.pmod
         else:
             log.info("Not connected (IMEI %s)", resp.imei)
             return None
 
+    def write(self, writable: Set[int]) -> None:
+        """
+        Try to send queued data, unless the socket is known to be busy
+        and did not become `writable` since. Sockets that still have data
+        are polled for POLLOUT. Disconnect clients that do not drain their
+        queue and let it grow over `maxsendbuffer`.
+        """
+        for fd in list(self.towrite):
+            clnt = self.by_fd[fd]
+            # Busy socket is not written to, but its queue may have grown
+            if (fd not in self.towait or fd in writable) and not clnt.write():
+                self.towrite.discard(fd)
+                if fd in self.towait:
+                    self.towait.discard(fd)
+                    self.poller.modify(fd, flags=zmq.POLLIN)
+            elif len(clnt.outbuf) > self.maxsendbuffer:
+                log.warning(
+                    "%d bytes unsent to fd %d (IMEI %s), disconnecting",
+                    len(clnt.outbuf),
+                    fd,
+                    clnt.imei,
+                )
+                self.stop(fd)
+            elif fd not in self.towait:
+                self.towait.add(fd)
+                self.poller.modify(fd, flags=zmq.POLLIN | zmq.POLLOUT)
 
-def runserver(conf: ConfigParser, handle_hibernate: bool = True) -> None:
-    # Is this https://github.com/zeromq/pyzmq/issues/1627 still not fixed?!
-    zctx = zmq.Context()  # type: ignore
-    zpub = zctx.socket(zmq.PUB)  # type: ignore
-    zpull = zctx.socket(zmq.PULL)  # type: ignore
-    oldmask = umask(0o117)
-    zpub.bind(conf.get("collector", "publishurl"))
-    zpull.bind(conf.get("collector", "listenurl"))
-    umask(oldmask)
+
+def _listener(conf: ConfigParser, reuseport: bool = False) -> socket:
     tcpl = socket(AF_INET6, SOCK_STREAM)
     tcpl.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reuseport:
+        tcpl.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    tcpl.setblocking(False)
     tcpl.bind(("", conf.getint("collector", "port")))
-    tcpl.listen(5)
+    tcpl.listen(
+        conf.getint("collector", "listenbacklog", fallback=LISTENBACKLOG)
+    )
+    return tcpl
+
+
+def _workerurl(conf: ConfigParser, option: str, base: str) -> str:
+    """Zmq endpoint used between the main process and the workers"""
+    if conf.has_option("collector", option):
+        return conf.get("collector", option)
+    url = conf.get("collector", base)
+    if url.startswith("ipc://"):
+        return url + ".workers"
+    raise ValueError(f"Need [collector] {option} when {base} is {url}")
+
+
+def serve(
+    conf: ConfigParser,
+    zpub: Any,
+    zpull: Any,
+    tcpl: socket,
+    handle_hibernate: bool = True,
+    routed: bool = False,
+) -> None:
+    """
+    Run the event loop, publishing on `zpub` what was received from the
+    terminals, and relaying to the terminals `Resp`s that come from
+    `zpull`. When `routed` is set, `zpull` is a SUB socket, and
+    subscriptions are maintained for the IMEIs that are connected to us.
+    """
     tcpfd = tcpl.fileno()
-    poller = zmq.Poller()  # type: ignore
+    eventloop = conf.get("collector", "eventloop", fallback="epoll")
+    if eventloop == "epoll":
+        poller: Any = EPoller()
+    elif eventloop == "zmq":
+        poller = zmq.Poller()  # type: ignore
+    else:
+        raise ValueError(f"Unknown collector eventloop {eventloop}")
     poller.register(zpull, flags=zmq.POLLIN)
     poller.register(tcpfd, flags=zmq.POLLIN)
-    clients = Clients()
-    pollingfds: Set[int] = set()
+    clients = Clients(
+        poller,
+        subscriber=zpull if routed else None,
+        maxsendbuffer=conf.getint(
+            "collector", "maxsendbuffer", fallback=MAXSENDBUFFER
+        ),
+        idletimeout=conf.getint(
+            "collector", "idletimeout", fallback=IDLETIMEOUT
+        ),
+        maxconnections=conf.getint("collector", "maxconnections", fallback=0),
+    )
+    publisher = Publisher(
+        zpub,
+        batch=conf.getboolean("collector", "batchpublish", fallback=False),
+    )
     try:
         while True:
             tosend: List[Resp] = []
-            toadd: List[Tuple[socket, Any]] = []
+            writable: Set[int] = set()
             events = poller.poll(1000)
             for sk, fl in events:
                 if sk is zpull:
@@ -209,10 +498,20 @@ def runserver(conf: ConfigParser, handle_hibernate: bool = True) -> None:
                         except zmq.Again:
                             break
                 elif sk == tcpfd:
-                    clntsock, clntaddr = tcpl.accept()
-                    clntsock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
-                    toadd.append((clntsock, clntaddr))
+                    # Drain accept queue, there may be a reconnect storm
+                    while True:
+                        try:
+                            clntsock, clntaddr = tcpl.accept()
+                        except BlockingIOError:
+                            break
+                        except OSError as e:  # e.g. out of fds
+                            log.error("Accepting connection: %s", e)
+                            break
+                        clntsock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+                        clients.add(clntsock, clntaddr)
                 elif fl & zmq.POLLIN:
+                    if fl & zmq.POLLOUT:
+                        writable.add(sk)
                     received = clients.recv(sk)
                     if received is None:
                         log.debug("Terminal gone from fd %d", sk)
@@ -220,7 +519,7 @@ def runserver(conf: ConfigParser, handle_hibernate: bool = True) -> None:
                     else:
                         for pmod, imei, when, peeraddr, packet in received:
                             proto = pmod.proto_of_message(packet)
-                            zpub.send(
+                            publisher.send(
                                 Bcast(
                                     proto=proto,
                                     pmod=pmod.PMODNAME,
@@ -228,7 +527,7 @@ def runserver(conf: ConfigParser, handle_hibernate: bool = True) -> None:
                                     when=when,
                                     peeraddr=peeraddr,
                                     packet=packet,
-                                ).packed
+                                )
                             )
                             if (
                                 pmod.is_goodbye_packet(packet)
@@ -245,6 +544,9 @@ def runserver(conf: ConfigParser, handle_hibernate: bool = True) -> None:
                                 tosend.append(
                                     Resp(imei=imei, when=when, packet=respmsg)
                                 )
+                elif fl & zmq.POLLOUT:
+                    log.debug("Write now open for fd %d", sk)
+                    writable.add(sk)
                 else:
                     log.debug("Stray event: %s on socket %s", fl, sk)
             # poll queue consumed, make changes now
@@ -252,29 +554,184 @@ def runserver(conf: ConfigParser, handle_hibernate: bool = True) -> None:
                 log.debug("Sending to the client: %s", zmsg)
                 rpmod = clients.response(zmsg)
                 if rpmod is not None:
-                    zpub.send(
+                    publisher.send(
                         Bcast(
                             is_incoming=False,
                             proto=rpmod.proto_of_message(zmsg.packet),
-                            pmod=pmod.PMODNAME,
+                            pmod=rpmod.PMODNAME,
                             imei=zmsg.imei,
                             when=zmsg.when,
                             packet=zmsg.packet,
-                        ).packed
+                        )
+                    )
+            publisher.flush()
+            clients.write(writable)
+            clients.reap(time())
+    finally:
+        if isinstance(poller, EPoller):
+            poller.close()
+
+
+def worker(conf: ConfigParser, handle_hibernate: bool = True) -> None:
+    """One of the processes sharing the terminal port"""
+    zctx = zmq.Context()  # type: ignore
+    zpub = zctx.socket(zmq.PUB)
+    zpub.connect(_workerurl(conf, "workerpublishurl", "publishurl"))
+    zsub = zctx.socket(zmq.SUB)
+    zsub.connect(_workerurl(conf, "workerlistenurl", "listenurl"))
+    tcpl = _listener(conf, reuseport=True)
+    try:
+        serve(conf, zpub, zsub, tcpl, handle_hibernate, routed=True)
+    except KeyboardInterrupt:
+        # Under systemd, SIGINT comes both from the parent and directly
+        signal(SIGINT, SIG_IGN)
+        zpub.close()
+        zsub.close()
+        zctx.destroy()
+        tcpl.close()
+
+
+def supervise(
+    conf: ConfigParser, numworkers: int, handle_hibernate: bool = True
+) -> None:
+    """
+    Start `numworkers` workers and restart those that exit. A worker
+    that exits soon after start is restarted with growing delay. After
+    `MAXRESTARTS` such exits in a row, stop the others and exit with
+    code 1.
+    """
+
+    def spawn() -> Process:
+        proc = Process(target=worker, args=(conf, handle_hibernate))
+        proc.start()
+        return proc
+
+    workers: List[Optional[Process]] = [spawn() for _ in range(numworkers)]
+    started = [time()] * numworkers
+    failures = [0] * numworkers
+    restartat = [0.0] * numworkers
+    status = 0
+    try:
+        while status == 0:
+            sleep(1.0)
+            now = time()
+            for i, proc in enumerate(workers):
+                if proc is not None and not proc.is_alive():
+                    if now - started[i] < STARTUPTIME:
+                        failures[i] += 1
+                    else:
+                        failures[i] = 0
+                    if failures[i] > MAXRESTARTS:
+                        log.error(
+                            "Worker exited %d times after start, giving up",
+                            failures[i],
+                        )
+                        status = 1
+                        break
+                    delay = (
+                        min(2.0 ** failures[i], MAXRESTARTDELAY)
+                        if failures[i]
+                        else 0.0
                     )
-            for fd in pollingfds - clients.fds():
-                poller.unregister(fd)  # type: ignore
-            for clntsock, clntaddr in toadd:
-                fd = clients.add(clntsock, clntaddr)
-            for fd in clients.fds() - pollingfds:
-                poller.register(fd, flags=zmq.POLLIN)
-            pollingfds = clients.fds()
+                    log.error(
+                        "Worker pid %s exited with code %s, restart in %d s",
+                        proc.pid,
+                        proc.exitcode,
+                        delay,
+                    )
+                    workers[i] = None
+                    restartat[i] = now + delay
+                if workers[i] is None and now >= restartat[i]:
+                    workers[i] = spawn()
+                    started[i] = time()
+    except KeyboardInterrupt:
+        # Under systemd, SIGINT comes both from the parent and directly
+        signal(SIGINT, SIG_IGN)
+    for proc in workers:
+        if proc is not None:
+            if proc.pid is not None and proc.is_alive():
+                kill(proc.pid, SIGINT)
+            proc.join()
+    exit(status)
+
+
+def runsharded(
+    conf: ConfigParser, numworkers: int, handle_hibernate: bool = True
+) -> int:
+    """
+    Start the process that runs `numworkers` workers listening on the
+    terminal port, and relay messages between them and the zmq bus.
+    Broadcasts from the workers are proxied through XSUB/XPUB pair, so
+    that subscriptions propagate and filtering is done in the workers.
+    `Resp` messages are re-published to the workers, each of them is
+    subscribed to the IMEIs of the terminals that it serves.
+    """
+    # Fork before creating zmq context: it does not survive fork, and
+    # the workers are forked later by the supervisor process
+    supervisor = Process(
+        target=supervise, args=(conf, numworkers, handle_hibernate)
+    )
+    supervisor.start()
+    zctx = zmq.Context()  # type: ignore
+    zxsub = zctx.socket(zmq.XSUB)
+    zxpub = zctx.socket(zmq.XPUB)
+    zpull = zctx.socket(zmq.PULL)
+    zrpub = zctx.socket(zmq.PUB)
+    oldmask = umask(0o117)
+    zxsub.bind(_workerurl(conf, "workerpublishurl", "publishurl"))
+    zxpub.bind(conf.get("collector", "publishurl"))
+    zpull.bind(conf.get("collector", "listenurl"))
+    zrpub.bind(_workerurl(conf, "workerlistenurl", "listenurl"))
+    umask(oldmask)
+    poller = zmq.Poller()
+    for zsk in zxsub, zxpub, zpull:
+        poller.register(zsk, flags=zmq.POLLIN)
+    relay = {zxsub: zxpub, zxpub: zxsub, zpull: zrpub}
+    try:
+        while supervisor.is_alive():
+            for sk, fl in poller.poll(1000):
+                while True:
+                    try:
+                        relay[sk].send_multipart(
+                            sk.recv_multipart(zmq.NOBLOCK)
+                        )
+                    except zmq.Again:
+                        break
+        log.error("Supervisor exited with code %s", supervisor.exitcode)
+        status = 1  # Let systemd restart us
+    except KeyboardInterrupt:
+        if supervisor.pid is not None and supervisor.is_alive():
+            kill(supervisor.pid, SIGINT)
+        supervisor.join()
+        status = 0
+    for zsk in zxsub, zxpub, zpull, zrpub:
+        zsk.close()
+    zctx.destroy()
+    return status
+
+
+def runserver(conf: ConfigParser, handle_hibernate: bool = True) -> int:
+    numworkers = conf.getint("collector", "workers", fallback=0)
+    if numworkers > 0:
+        return runsharded(conf, numworkers, handle_hibernate)
+    # Is this https://github.com/zeromq/pyzmq/issues/1627 still not fixed?!
+    zctx = zmq.Context()  # type: ignore
+    zpub = zctx.socket(zmq.PUB)  # type: ignore
+    zpull = zctx.socket(zmq.PULL)  # type: ignore
+    oldmask = umask(0o117)
+    zpub.bind(conf.get("collector", "publishurl"))
+    zpull.bind(conf.get("collector", "listenurl"))
+    umask(oldmask)
+    tcpl = _listener(conf)
+    try:
+        serve(conf, zpub, zpull, tcpl, handle_hibernate)
     except KeyboardInterrupt:
         zpub.close()
         zpull.close()
         zctx.destroy()  # type: ignore
         tcpl.close()
+    return 0
 
 
 if __name__.endswith("__main__"):
-    runserver(common.init(log))
+    exit(runserver(common.init(log)))
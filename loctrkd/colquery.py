@@ -0,0 +1,80 @@
+"""
+Query location history exported by `loctrkd.columnar`, needs numpy
+"""
+
+from os import path
+from typing import Dict, Optional
+import numpy as np
+
+from .columnar import columnfile, COLUMNS
+
+__all__ = "distance", "track"
+
+EARTHRADIUS = 6371008.8  # Mean radius in metres
+
+
+def _columns(directory: str, imei: str, tail: bool) -> Dict[str, np.ndarray]:
+    if not path.exists(columnfile(directory, imei, "epoch", tail)):
+        return {column: np.empty(0) for column in COLUMNS}
+    columns = {
+        column: np.memmap(
+            columnfile(directory, imei, column, tail),
+            dtype=np.float64,
+            mode="r",
+        )
+        if path.getsize(columnfile(directory, imei, column, tail))
+        else np.empty(0)
+        for column in COLUMNS
+    }
+    # Exporter may be appending to the columns right now
+    size = min(len(values) for values in columns.values())
+    return {column: values[:size] for column, values in columns.items()}
+
+
+def _slice(
+    columns: Dict[str, np.ndarray],
+    start: Optional[float],
+    end: Optional[float],
+) -> Dict[str, np.ndarray]:
+    epoch = columns["epoch"]
+    first = 0 if start is None else int(np.searchsorted(epoch, start))
+    last = len(epoch) if end is None else int(np.searchsorted(epoch, end))
+    return {column: values[first:last] for column, values in columns.items()}
+
+
+def track(
+    directory: str,
+    imei: str,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Reports of `imei` with `start` <= epoch < `end` as a dict of
+    float64 arrays by column name, sorted by epoch. Unless there are
+    late reports in the range, arrays are slices of memory mapped
+    files, they are only read from disk when used.
+    """
+    main = _slice(_columns(directory, imei, False), start, end)
+    tail = _slice(_columns(directory, imei, True), start, end)
+    if not len(tail["epoch"]):
+        return main
+    order = np.argsort(
+        np.concatenate((main["epoch"], tail["epoch"])), kind="stable"
+    )
+    return {
+        column: np.concatenate((main[column], tail[column]))[order]
+        for column in COLUMNS
+    }
+
+
+def distance(latitude: np.ndarray, longitude: np.ndarray) -> float:
+    """Length of the track in metres, haversine formula"""
+    lat = np.radians(latitude)
+    lon = np.radians(longitude)
+    hav = (
+        np.sin(np.diff(lat) / 2) ** 2
+        + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    )
+    return float(
+        np.sum(2 * EARTHRADIUS * np.arcsin(np.sqrt(np.minimum(hav, 1.0))))
+    )
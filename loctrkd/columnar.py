@@ -0,0 +1,216 @@
+""" Export location reports to per-IMEI column files """
+
+# run as:
+# python -m loctrkd.columnar
+# Repeated runs append only the reports stored since the previous run.
+# Use `loctrkd.colquery` to read the files.
+
+from array import array
+from bisect import bisect_left
+from configparser import ConfigParser
+from json import dump, load, loads
+from logging import getLogger
+from math import nan
+from os import makedirs, path, replace
+from sqlite3 import Connection
+from typing import Any, Dict, List, Tuple
+
+from . import common
+from .evstore import partitions, readonly
+
+log = getLogger("loctrkd/columnar")
+
+# Every column is a file of native float64 values, all columns of one
+# IMEI have the same length and are sorted by "epoch". Null is NaN.
+# Reports are appended to the columns. Those that come later than
+# reports already exported, but have an earlier epoch, go to the tail
+# columns instead, that are kept sorted and rewritten when they change.
+# When the tail grows larger than 1/COMPACT of the main columns, both
+# are merged into the main columns. Files that are rewritten are made
+# with ".new" suffix, and renamed after they are listed in the state
+# file, so that an interrupted run can be completed by the next one.
+# State file keeps the last exported rowid of every reports table, the
+# size of the columns (and tails) of every IMEI after the last complete
+# run, and the files waiting to be renamed, if any.
+COLUMNS = ("epoch", "latitude", "longitude", "accuracy", "battery")
+STATE = "exported.json"
+COMPACT = 4
+
+
+def columnfile(
+    directory: str, imei: str, column: str, tail: bool = False
+) -> str:
+    return path.join(
+        directory, imei, column + (".tail" if tail else "") + ".f64"
+    )
+
+
+def _read(fn: str, size: int) -> "array[float]":
+    values = array("d")
+    if size:
+        with open(fn, "rb") as fl:
+            values.fromfile(fl, size // values.itemsize)
+    return values
+
+
+def _rows(
+    directory: str, imei: str, tail: bool, size: int
+) -> List[Tuple[float, ...]]:
+    return list(
+        zip(
+            *(
+                _read(columnfile(directory, imei, column, tail), size)
+                for column in COLUMNS
+            )
+        )
+    )
+
+
+def _rewrite(
+    directory: str, imei: str, tail: bool, rows: List[Tuple[float, ...]]
+) -> List[str]:
+    """Write columns to ".new" files, return the names to rename"""
+    names = []
+    for num, column in enumerate(COLUMNS):
+        fn = columnfile(directory, imei, column, tail)
+        with open(fn + ".new", "wb") as fl:
+            array("d", (row[num] for row in rows)).tofile(fl)
+        names.append(path.relpath(fn, directory))
+    return names
+
+
+def _append(
+    directory: str,
+    imei: str,
+    rows: List[Tuple[float, ...]],
+    size: int,
+    tailsize: int,
+) -> Tuple[int, int, List[str]]:
+    """
+    Add rows to the columns of `imei`, that are known to hold `size`
+    bytes each, and `tailsize` bytes in the tail. Return the new sizes
+    and the files to be renamed from ".new".
+    """
+    rows.sort()
+    itemsize = array("d").itemsize
+    for column in COLUMNS:
+        fn = columnfile(directory, imei, column)
+        if path.exists(fn) and path.getsize(fn) != size:
+            # Previous run was interrupted, drop what it appended
+            log.warning("Truncating %s to %d bytes", fn, size)
+            with open(fn, "r+b") as fl:
+                fl.truncate(size)
+    makedirs(path.join(directory, imei), exist_ok=True)
+    renames = []
+    late: List[Tuple[float, ...]] = []
+    if size:
+        last = array("d")
+        with open(columnfile(directory, imei, "epoch"), "rb") as fl:
+            fl.seek(size - last.itemsize)
+            last.fromfile(fl, 1)
+        split = bisect_left(rows, (last[0],))
+        late, rows = rows[:split], rows[split:]
+    if late:
+        # Reports came out of order, they go to the tail
+        tail = sorted(_rows(directory, imei, True, tailsize) + late)
+        if len(tail) * COMPACT > size // itemsize:
+            merged = sorted(_rows(directory, imei, False, size) + tail + rows)
+            log.info("Merging %d late reports of %s", len(tail), imei)
+            renames.extend(_rewrite(directory, imei, False, merged))
+            renames.extend(_rewrite(directory, imei, True, []))
+            return len(merged) * itemsize, 0, renames
+        renames.extend(_rewrite(directory, imei, True, tail))
+        tailsize = len(tail) * itemsize
+    for num, column in enumerate(COLUMNS):
+        with open(columnfile(directory, imei, column), "ab") as fl:
+            array("d", (row[num] for row in rows)).tofile(fl)
+    return size + len(rows) * itemsize, tailsize, renames
+
+
+def _save(statefn: str, state: Dict[str, Any]) -> None:
+    # Until the new state is in place, the previous one is valid
+    with open(statefn + ".new", "w") as fl:
+        dump(state, fl)
+    replace(statefn + ".new", statefn)
+
+
+def _finish(directory: str, statefn: str, state: Dict[str, Any]) -> None:
+    """Rename files listed in the state, the run is complete then"""
+    if not state["renames"]:
+        return
+    for name in state["renames"]:
+        fn = path.join(directory, name)
+        if path.exists(fn + ".new"):
+            replace(fn + ".new", fn)
+    state["renames"] = []
+    _save(statefn, state)
+
+
+def export(db: Connection, directory: str) -> int:
+    """
+    Append reports that were not exported yet to the column files
+    in `directory`, return the number of exported reports.
+    """
+    makedirs(directory, exist_ok=True)
+    statefn = path.join(directory, STATE)
+    try:
+        with open(statefn) as fl:
+            state: Dict[str, Any] = load(fl)
+    except FileNotFoundError:
+        state = {"rowids": {}, "sizes": {}}
+    state.setdefault("tails", {})
+    state.setdefault("renames", [])
+    # Previous run was interrupted after it saved the state
+    _finish(directory, statefn, state)
+    rowids = {}
+    byimei: Dict[str, List[Tuple[float, ...]]] = {}
+    for name in partitions(db, "reports"):
+        lastrow = state["rowids"].get(name, 0)
+        for rowid, imei, devepoch, lat, lon, acc, remainder in db.execute(
+            f"""select rowid, imei, devepoch, latitude, longitude,
+                       accuracy, remainder
+                from {name} where rowid > ? and imei is not null
+                and devepoch is not null order by rowid""",
+            (lastrow,),
+        ):
+            battery = loads(remainder).get("battery_percentage")
+            byimei.setdefault(imei, []).append(
+                tuple(
+                    nan if value is None else float(value)
+                    for value in (devepoch, lat, lon, acc, battery)
+                )
+            )
+            lastrow = rowid
+        rowids[name] = lastrow
+    sizes = state["sizes"]
+    tails = state["tails"]
+    renames = []
+    for imei, rows in byimei.items():
+        sizes[imei], tails[imei], names = _append(
+            directory, imei, rows, sizes.get(imei, 0), tails.get(imei, 0)
+        )
+        renames.extend(names)
+    state = {
+        "rowids": rowids,
+        "sizes": sizes,
+        "tails": tails,
+        "renames": renames,
+    }
+    _save(statefn, state)
+    _finish(directory, statefn, state)
+    return sum(len(rows) for rows in byimei.values())
+
+
+def main(conf: ConfigParser) -> None:
+    dbfn = conf.get("storage", "dbfn")
+    directory = conf.get(
+        "storage",
+        "columnar",
+        fallback=path.join(path.dirname(dbfn), "columnar"),
+    )
+    count = export(readonly(dbfn), directory)
+    log.info("exported %d reports to %s", count, directory)
+
+
+if __name__.endswith("__main__"):
+    main(common.init(log))
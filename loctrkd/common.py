@@ -1,5 +1,6 @@
 """ Common housekeeping for all daemons """
 
+from collections import deque
 from configparser import ConfigParser
 from importlib import import_module
 from getopt import getopt
@@ -7,11 +8,24 @@ from json import dumps
 from logging import Formatter, getLogger, Logger, StreamHandler, DEBUG, INFO
 from logging.handlers import SysLogHandler
 from pkg_resources import get_distribution, DistributionNotFound
+from socket import socketpair
 from sys import argv, stderr, stdout
-from typing import Any, cast, Dict, List, Optional, Tuple, Union
+from typing import (
+    Any,
+    cast,
+    Deque,
+    Dict,
+    Generic,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 from types import SimpleNamespace
 
 from .protomodule import ProtoClass, ProtoModule
+from .zmsg import pack_report
 
 CONF = "/etc/loctrkd.conf"
 pmods: List[ProtoModule] = []
@@ -57,6 +71,51 @@ def init(
     return conf
 
 
+T = TypeVar("T")
+
+
+class Completions(Generic[T]):
+    """
+    Hands over items from worker threads to the event loop: `put()`
+    queues the item and writes to a socketpair that the loop polls via
+    `fileno()`, `take()` returns what has been queued.
+    """
+
+    def __init__(self) -> None:
+        self.rsock, self.wsock = socketpair()
+        self.rsock.setblocking(False)
+        self.wsock.setblocking(False)
+        self.items: Deque[T] = deque()
+
+    def fileno(self) -> int:
+        return self.rsock.fileno()
+
+    def put(self, item: T) -> None:
+        """Called from any thread"""
+        self.items.append(item)
+        try:
+            self.wsock.send(b"\0")
+        except BlockingIOError:
+            pass  # Plenty of wakeups are pending already
+
+    def take(self) -> List[T]:
+        """Called from the event loop"""
+        try:
+            while self.rsock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        # Items put after draining the socket will wake the loop again
+        result = []
+        while self.items:
+            result.append(self.items.popleft())
+        return result
+
+    def close(self) -> None:
+        self.rsock.close()
+        self.wsock.close()
+
+
 def probe_pmod(segment: bytes) -> Optional[ProtoModule]:
     for pmod in pmods:
         if pmod.probe_buffer(segment):
@@ -114,6 +173,11 @@ class Report:
         self.type = self.TYPE
         return dumps(self.__dict__)
 
+    @property
+    def binary(self) -> bytes:
+        self.type = self.TYPE
+        return pack_report(self.__dict__)
+
 
 class CoordReport(Report):
     TYPE = "location"
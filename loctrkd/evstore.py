@@ -1,16 +1,65 @@
 """ sqlite event store """
 
-from datetime import datetime
+from contextlib import closing, contextmanager
+from datetime import datetime, timezone
 from json import dumps, loads
-from sqlite3 import connect, OperationalError, Row
-from typing import Any, Dict, List, Optional, Tuple
+from logging import getLogger
+from math import inf
+from os import path
+from queue import Empty, Queue
+from sqlite3 import connect, Connection, OperationalError, Row
+from threading import Lock
+from time import time
+from struct import Struct
+from urllib.request import pathname2url
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from zlib import compress, decompressobj
 
-__all__ = "fetch", "initdb", "stow", "stowloc"
+__all__ = (
+    "archive",
+    "archived",
+    "commit_pending",
+    "committed",
+    "createdb",
+    "expire",
+    "fetch",
+    "fetchlatest",
+    "flush",
+    "initdb",
+    "partitions",
+    "readonly",
+    "Readers",
+    "stow",
+    "stowloc",
+)
+
+log = getLogger("loctrkd/evstore")
 
 DB = None
 
-SCHEMA = (
-    """create table if not exists events (
+SYNCHRONOUS = ("off", "normal", "full", "extra")
+
+# Rows waiting to be inserted, by statement, in order of arrival
+PENDING: Dict[str, List[Dict[str, Any]]] = {}
+NPENDING = 0
+OLDEST = 0.0  # When the first of the pending rows was queued
+COMMITROWS = 1
+COMMITMSEC = 0
+MAXPENDING = 0  # Rows kept for retry while commits fail, 0 - no limit
+COMMITTED = 0  # Rows inserted since the database was opened
+
+# What was last written to pmodmap, and when. Must be refreshed well
+# before `fetchpmod()` considers the mapping stale (3600 s).
+PMODCACHE: Dict[str, Tuple[str, float]] = {}
+# Mappings in the pending rows, go to the cache when they are committed
+PMODPENDING: Dict[str, Tuple[str, float]] = {}
+PMODREFRESH: float = 600.0
+
+# Tables that can be split into partitions by time, `{name}` is either
+# the name of the table itself, or `<table>_<YYYYMM[DD]>`.
+PARTITIONED = {
+    "events": (
+        """create table if not exists {name} (
     tstamp real not null,
     imei text,
     peeraddr text not null,
@@ -18,27 +67,148 @@ SCHEMA = (
     proto text not null,
     packet blob
 )""",
-    """create table if not exists reports (
+        """create index if not exists {name}_imei_tstamp
+    on {name} (imei, tstamp)""",
+    ),
+    "reports": (
+        """create table if not exists {name} (
     imei text,
     devtime text not null,
     accuracy real,
     latitude real,
     longitude real,
-    remainder text
+    remainder text,
+    devepoch real
+)""",
+        """create index if not exists {name}_imei_devepoch
+    on {name} (imei, devepoch)""",
+    ),
+}
+
+ARCHIVESCHEMA = (
+    """create table if not exists archive (
+    imei text,
+    day text not null,
+    first real not null,
+    last real not null,
+    count int not null,
+    data blob not null
 )""",
-    """create table if not exists pmodmap (
+    """create index if not exists archive_imei_day
+    on archive (imei, day)""",
+)
+
+SCHEMA = (
+    tuple(
+        stmt.format(name=table)
+        for table, stmts in PARTITIONED.items()
+        for stmt in stmts
+    )
+    + (
+        """create table if not exists pmodmap (
     imei text not null unique,
     pmod text not null,
     tstamp real not null default (strftime('%s'))
 )""",
+    )
+    + ARCHIVESCHEMA
+    + (
+        """create table if not exists latest (
+    imei text not null primary key,
+    devtime text not null,
+    devepoch real,
+    accuracy real,
+    latitude real,
+    longitude real,
+    remainder text
+)""",
+    )
 )
 
+# Last known position of every terminal, a report does not replace
+# a newer one that arrived before it. Position without valid time is
+# replaced by any that comes later.
+LATEST = """insert into latest
+    (imei, devtime, devepoch, accuracy, latitude, longitude, remainder)
+    {values}
+    on conflict (imei) do update set
+    devtime = excluded.devtime, devepoch = excluded.devepoch,
+    accuracy = excluded.accuracy, latitude = excluded.latitude,
+    longitude = excluded.longitude, remainder = excluded.remainder
+    where latest.devepoch is null or excluded.devepoch >= latest.devepoch"""
+
+# Archived event: tstamp, is_incoming, and lengths of peeraddr, proto
+# and packet, that follow. A block is a zlib stream of such records.
+_ARCREC = Struct("!dBBBI")
+ARCHUNK = 65536
 
-def initdb(dbname: str) -> None:
-    global DB
+PARTFMT = {"day": "%Y%m%d", "month": "%Y%m"}
+PARTITION: Optional[str] = None
+RETENTION = 0  # days
+# Time span and name of the partition where the rows currently go
+CURPART: Dict[str, Tuple[float, float, str]] = {}
+
+
+def initdb(
+    dbname: str,
+    wal: bool = False,
+    synchronous: Optional[str] = None,
+    commitrows: int = 1,
+    commitmsec: int = 0,
+    partition: Optional[str] = None,
+    retention: int = 0,
+    migrate: bool = True,
+    maxpending: int = 0,
+) -> None:
+    """
+    Open the database. Unless `migrate` is false, create what is missing
+    and bring an existing database up to date, which the tools that run
+    alongside the storage daemon leave to it. Rows passed to `stow*()`
+    functions are inserted
+    in one transaction when `commitrows` of them accumulate, or when
+    `commit_pending()` finds that the oldest of them is waiting for
+    longer than `commitmsec` milliseconds, whichever comes first.
+    When the database stays locked, rows are kept for the next attempt,
+    but if `maxpending` is not zero and that many have accumulated,
+    they are dropped.
+    If `partition` is "day" or "month", events and reports are stored
+    in a separate table for each day or month, and the tables that
+    are older than `retention` days are dropped.
+    """
+    global DB, COMMITROWS, COMMITMSEC, MAXPENDING, PARTITION, RETENTION
+    global COMMITTED, NPENDING
+    if synchronous is not None and synchronous.lower() not in SYNCHRONOUS:
+        raise ValueError(
+            f"synchronous must be one of {SYNCHRONOUS}, not {synchronous}"
+        )
+    if partition is not None and partition not in PARTFMT:
+        raise ValueError(
+            f"partition must be one of {tuple(PARTFMT)}, not {partition}"
+        )
+    COMMITROWS = commitrows
+    COMMITMSEC = commitmsec
+    MAXPENDING = maxpending
+    PARTITION = partition
+    RETENTION = retention
+    PENDING.clear()
+    NPENDING = 0
+    COMMITTED = 0
+    PMODCACHE.clear()
+    PMODPENDING.clear()
+    CURPART.clear()
     DB = connect(dbname)
     DB.row_factory = Row
+    if wal:
+        DB.execute("pragma journal_mode = wal")
+    if synchronous is not None:
+        DB.execute(f"pragma synchronous = {synchronous}")
+    if not migrate:
+        return
     need_populate_pmodmap = False
+    need_populate_latest = not DB.execute(
+        "select 1 from sqlite_master where type = 'table' and name = ?",
+        ("latest",),
+    ).fetchone()
     try:
         DB.execute("select count(pmod) from pmodmap")
         try:
@@ -48,6 +218,20 @@ def initdb(dbname: str) -> None:
             DB.execute("alter table pmodmap rename to old_pmodmap")
     except OperationalError:
         pass  # DB was empty
+    try:
+        DB.execute("select count(devtime) from reports")
+        try:
+            DB.execute("select count(devepoch) from reports")
+        except OperationalError:
+            # Populate before the index is created, it is faster
+            DB.execute("alter table reports add column devepoch real")
+            DB.execute(
+                """update reports set devepoch =
+                   (julianday(devtime) - 2440587.5) * 86400.0"""
+            )
+            DB.commit()
+    except OperationalError:
+        pass  # DB was empty
     for stmt in SCHEMA:
         DB.execute(stmt)
     if need_populate_pmodmap:
@@ -57,6 +241,93 @@ def initdb(dbname: str) -> None:
         )
         DB.execute("drop table old_pmodmap")
         DB.commit()
+    if need_populate_latest:
+        for name in reversed(partitions(DB, "reports")):
+            DB.execute(
+                LATEST.format(
+                    values=f"""select imei, devtime, devepoch, accuracy,
+                    latitude, longitude, remainder from {name}
+                    where imei is not null order by devepoch"""
+                )
+            )
+        DB.commit()
+    expire()
+
+
+def createdb(dbname: str) -> None:
+    """
+    Create the database with the current schema, unless it exists.
+    An existing database is left alone, it is up to `initdb()` in the
+    storage daemon to migrate it.
+    """
+    if path.exists(dbname):
+        return
+    with closing(connect(dbname)) as db:
+        for stmt in SCHEMA:
+            db.execute(stmt)
+        db.commit()
+
+
+def readonly(dbname: str) -> Connection:
+    """
+    Open the database for reading only, the connection may be passed
+    between threads. In write-ahead log mode, readers do not block the
+    writer and are not blocked by it.
+    """
+    db = connect(
+        f"file:{pathname2url(dbname)}?mode=ro",
+        uri=True,
+        check_same_thread=False,
+    )
+    db.row_factory = Row
+    db.execute("pragma query_only = on")
+    return db
+
+
+class Readers:
+    """
+    Pool of up to `size` read-only connections, opened when needed.
+    A connection taken by `connection()` is used by one thread at a time.
+    """
+
+    def __init__(self, dbname: str, size: int = 4) -> None:
+        self.dbname = dbname
+        self.size = size
+        self.opened = 0
+        self.lock = Lock()
+        self.idle: "Queue[Connection]" = Queue()
+
+    @contextmanager
+    def connection(self) -> Iterator[Connection]:
+        try:
+            db = self.idle.get_nowait()
+        except Empty:
+            with self.lock:
+                grow = self.opened < self.size
+                if grow:
+                    self.opened += 1
+            if grow:
+                try:
+                    db = readonly(self.dbname)
+                except Exception:
+                    with self.lock:
+                        self.opened -= 1
+                    raise
+            else:
+                db = self.idle.get()
+        try:
+            yield db
+        finally:
+            self.idle.put(db)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Empty:
+                break
+            with self.lock:
+                self.opened -= 1
 
 
 def stow(**kwargs: Any) -> None:
@@ -73,15 +344,20 @@ def stow(**kwargs: Any) -> None:
         )
     }
     assert len(kwargs) <= len(parms)
-    DB.execute(
-        """insert or ignore into events
+    name = _partition("events", parms["when"])
+    if name is None:
+        log.debug("Event of %s is past retention, skipped", parms["imei"])
+        return
+    _queue(
+        """insert or ignore into """
+        + name
+        + """
                 (tstamp, imei, peeraddr, proto, packet, is_incoming)
                 values
                 (:when, :imei, :peeraddr, :proto, :packet, :is_incoming)
         """,
         parms,
     )
-    DB.commit()
 
 
 def stowloc(**kwargs: Dict[str, Any]) -> None:
@@ -97,51 +373,290 @@ def stowloc(**kwargs: Dict[str, Any]) -> None:
         )
     }
     parms["remainder"] = dumps(kwargs)
-    DB.execute(
-        """insert or ignore into reports
-                (imei, devtime, accuracy, latitude, longitude, remainder)
+    name = _partition("reports", time())
+    assert name is not None  # Now is never past retention
+    _queue(
+        """insert or ignore into """
+        + name
+        + """
+                (imei, devtime, accuracy, latitude, longitude, remainder,
+                 devepoch)
                 values
-                (:imei, :devtime, :accuracy, :latitude, :longitude, :remainder)
+                (:imei, :devtime, :accuracy, :latitude, :longitude, :remainder,
+                 (julianday(:devtime) - 2440587.5) * 86400.0)
         """,
         parms,
     )
-    DB.commit()
+    if parms["imei"] is not None:
+        _queue(
+            LATEST.format(
+                values="""values (:imei, :devtime,
+                (julianday(:devtime) - 2440587.5) * 86400.0, :accuracy,
+                :latitude, :longitude, :remainder)"""
+            ),
+            parms,
+        )
 
 
 def stowpmod(imei: str, pmod: str) -> None:
     assert DB is not None
-    DB.execute(
+    now = time()
+    cached = PMODPENDING.get(imei) or PMODCACHE.get(imei)
+    if (
+        cached is not None
+        and cached[0] == pmod
+        and now - cached[1] < PMODREFRESH
+    ):
+        return
+    PMODPENDING[imei] = (pmod, now)
+    _queue(
         """insert or replace into pmodmap
                 (imei, pmod) values (:imei, :pmod)
         """,
         {"imei": imei, "pmod": pmod},
     )
-    DB.commit()
 
 
-def fetch(imei: str, backlog: int) -> List[Dict[str, Any]]:
+def _span(when: float, partition: str) -> Tuple[float, float]:
+    """Start and end of the partition that `when` belongs to"""
+    if partition == "day":
+        start = when // 86400 * 86400
+        return start, start + 86400
+    dt = datetime.fromtimestamp(when, timezone.utc)
+    first = datetime(dt.year, dt.month, 1, tzinfo=timezone.utc)
+    if dt.month == 12:
+        nxt = datetime(dt.year + 1, 1, 1, tzinfo=timezone.utc)
+    else:
+        nxt = datetime(dt.year, dt.month + 1, 1, tzinfo=timezone.utc)
+    return first.timestamp(), nxt.timestamp()
+
+
+def _partition(table: str, when: float) -> Optional[str]:
+    """
+    Name of the table where the row with this time goes, `None` if the
+    partition would be dropped by `expire()` already
+    """
     assert DB is not None
-    cur = DB.cursor()
-    cur.execute(
-        """select imei, devtime, accuracy, latitude, longitude, remainder
-                    from reports where imei = ?
-                    order by devtime desc limit ?""",
-        (imei, backlog),
+    if PARTITION is None:
+        return table
+    start, end, name = CURPART.get(table, (0.0, 0.0, table))
+    if start <= when < end:
+        return name
+    start, end = _span(when, PARTITION)
+    if RETENTION > 0 and end <= time() - RETENTION * 86400:
+        return None
+    name = (
+        table
+        + "_"
+        + datetime.fromtimestamp(start, timezone.utc).strftime(
+            PARTFMT[PARTITION]
+        )
     )
-    result = []
-    for row in cur:
-        dic = dict(row)
-        remainder = loads(dic.pop("remainder"))
-        dic.update(remainder)
-        result.append(dic)
-    cur.close()
-    return list(reversed(result))
+    # Moving on to a new partition is time to expire old ones
+    if table in CURPART and end > CURPART[table][1]:
+        expire()
+    for stmt in PARTITIONED[table]:
+        DB.execute(stmt.format(name=name))
+    # The next row most probably goes into the same partition
+    CURPART[table] = (start, end, name)
+    return name
+
+
+def partitions(db: Connection, table: str) -> List[str]:
+    """
+    Names of the tables where the rows of `table` are stored, newest
+    first. Unpartitioned table itself, if it exists, comes last.
+    """
+    names = sorted(
+        (
+            name
+            for (name,) in db.execute(
+                """select name from sqlite_master where type = 'table'
+                   and name like ?""",
+                (table + "_%",),
+            )
+            if name[len(table) + 1 :].isdigit()
+        ),
+        # In case there are both daily and monthly partitions
+        key=lambda name: str(name[len(table) + 1 :]).ljust(8, "0"),
+        reverse=True,
+    )
+    if db.execute(
+        "select 1 from sqlite_master where type = 'table' and name = ?",
+        (table,),
+    ).fetchone():
+        names.append(table)
+    return names
+
+
+def expire(now: Optional[float] = None) -> None:
+    """Drop partitions that are entirely older than `RETENTION` days"""
+    assert DB is not None
+    if PARTITION is None or RETENTION <= 0:
+        return
+    cutoff = (time() if now is None else now) - RETENTION * 86400
+    for table in PARTITIONED:
+        for name in partitions(DB, table):
+            suffix = name[len(table) + 1 :]
+            if not suffix:
+                continue  # Unpartitioned table is never dropped
+            partition = "day" if len(suffix) == 8 else "month"
+            start = (
+                datetime.strptime(suffix, PARTFMT[partition])
+                .replace(tzinfo=timezone.utc)
+                .timestamp()
+            )
+            if _span(start, partition)[1] <= cutoff:
+                flush()  # There may be pending rows for this table
+                DB.execute(f"drop table {name}")
+                DB.commit()
+
+
+def _queue(stmt: str, parms: Dict[str, Any]) -> None:
+    global NPENDING, OLDEST
+    if NPENDING == 0:
+        OLDEST = time()
+    PENDING.setdefault(stmt, []).append(parms)
+    NPENDING += 1
+    if NPENDING >= COMMITROWS:
+        flush()
+
+
+def _drop() -> None:
+    global NPENDING
+    PENDING.clear()
+    PMODPENDING.clear()
+    NPENDING = 0
 
 
-def fetchpmod(imei: str) -> Optional[Any]:
+def flush() -> None:
+    """Insert all pending rows in one transaction"""
+    global COMMITTED, NPENDING
     assert DB is not None
+    if NPENDING == 0:
+        return
+    try:
+        for stmt, rows in PENDING.items():
+            DB.executemany(stmt, rows)
+        DB.commit()
+    except OperationalError:
+        # Database locked or the disk full, keep the rows to retry
+        DB.rollback()
+        if MAXPENDING and NPENDING >= MAXPENDING:
+            log.error("Database unavailable, dropping %d rows", NPENDING)
+            _drop()
+        raise
+    except Exception:
+        # Rows that cannot be stored would block all that come later
+        DB.rollback()
+        log.error("Dropping %d pending rows", NPENDING)
+        _drop()
+        raise
+    PENDING.clear()
+    PMODCACHE.update(PMODPENDING)
+    PMODPENDING.clear()
+    COMMITTED += NPENDING
+    NPENDING = 0
+
+
+def committed() -> int:
+    """Number of rows inserted since `initdb()`"""
+    return COMMITTED
+
+
+def commit_pending() -> Optional[int]:
+    """
+    Flush pending rows if the oldest of them waited for `commitmsec`.
+    Return the number of milliseconds until the next flush is due,
+    or `None` if there is nothing pending.
+    """
+    if NPENDING == 0:
+        return None
+    remaining = int(OLDEST * 1000 + COMMITMSEC - time() * 1000)
+    if remaining > 0:
+        return remaining
+    flush()
+    return None
+
+
+def fetch(
+    imei: str, backlog: int, db: Optional[Connection] = None
+) -> List[Dict[str, Any]]:
+    """
+    Last `backlog` reports of the terminal, ordered by device time.
+    Partitions hold the reports by the time of arrival, a report that
+    arrived late, or came from a terminal with wrong clock, can be in
+    any of them, so the newest are picked from all partitions.
+    """
+    if db is None:
+        assert DB is not None
+        db = DB
+    rows: List[Row] = []
+    for name in partitions(db, "reports"):
+        stmt = (
+            """select imei, devtime, accuracy, latitude, longitude,
+                      remainder, devepoch from """
+            + name
+            + " where imei = ?"
+        )
+        parms: Tuple[Any, ...] = (imei,)
+        if len(rows) >= backlog and rows[-1]["devepoch"] is not None:
+            # Only those newer than what we have, it is an index seek
+            stmt += " and devepoch > ?"
+            parms += (rows[-1]["devepoch"],)
+        rows.extend(
+            db.execute(
+                stmt + " order by devepoch desc limit ?", parms + (backlog,)
+            )
+        )
+        # Stable, among equal times those from the newer partition win
+        rows.sort(
+            key=lambda row: -inf
+            if row["devepoch"] is None
+            else row["devepoch"],
+            reverse=True,
+        )
+        del rows[backlog:]
+    result = []
+    for row in reversed(rows):
+        report = _report(row)
+        del report["devepoch"]
+        result.append(report)
+    return result
+
+
+def fetchlatest(
+    imeis: Optional[List[str]] = None, db: Optional[Connection] = None
+) -> List[Dict[str, Any]]:
+    """Last known positions of `imeis`, or of all terminals"""
+    if db is None:
+        assert DB is not None
+        db = DB
+    stmt = """select imei, devtime, accuracy, latitude, longitude, remainder
+              from latest"""
+    if imeis is None:
+        return [_report(row) for row in db.execute(stmt)]
+    return [
+        _report(row)
+        for row in db.execute(
+            stmt + f" where imei in ({', '.join('?' * len(imeis))})", imeis
+        )
+    ]
+
+
+def _report(row: Row) -> Dict[str, Any]:
+    dic = dict(row)
+    remainder = loads(dic.pop("remainder"))
+    dic.update(remainder)
+    return dic
+
+
+def fetchpmod(imei: str, db: Optional[Connection] = None) -> Optional[Any]:
+    if db is None:
+        assert DB is not None
+        db = DB
     ret = None
-    cur = DB.cursor()
+    cur = db.cursor()
     cur.execute(
         """select pmod from pmodmap where imei = ?
            and tstamp > strftime('%s') - 3600.0""",
@@ -152,3 +667,133 @@ def fetchpmod(imei: str) -> Optional[Any]:
         ret = result[0]
     cur.close()
     return ret
+
+
+def archive(before: float, level: int = 9) -> int:
+    """
+    Move events older than `before` into compressed blocks, one per
+    IMEI and (UTC) day, in the `archive` table. Every block is committed
+    separately, not to keep the database locked for long. Return the
+    number of archived events. The archive table is created if it is
+    missing, nothing else in the schema is touched.
+    """
+    assert DB is not None
+    flush()
+    for stmt in ARCHIVESCHEMA:
+        DB.execute(stmt)
+    total = 0
+    for name in partitions(DB, "events"):
+        for imei, day in DB.execute(
+            f"""select distinct imei, date(tstamp, 'unixepoch') from {name}
+                where tstamp < ?""",
+            (before,),
+        ).fetchall():
+            start = (
+                datetime.strptime(day, "%Y-%m-%d")
+                .replace(tzinfo=timezone.utc)
+                .timestamp()
+            )
+            end = min(start + 86400, before)
+            rows = DB.execute(
+                f"""select tstamp, is_incoming, peeraddr, proto, packet
+                    from {name} where imei is ? and tstamp >= ?
+                    and tstamp < ? order by tstamp""",
+                (imei, start, end),
+            ).fetchall()
+            if not rows:
+                continue
+            block = []
+            for tstamp, is_incoming, peeraddr, proto, packet in rows:
+                bpeer = peeraddr.encode()
+                bproto = proto.encode()
+                packet = packet or b""
+                block.append(
+                    _ARCREC.pack(
+                        tstamp,
+                        is_incoming,
+                        len(bpeer),
+                        len(bproto),
+                        len(packet),
+                    )
+                    + bpeer
+                    + bproto
+                    + packet
+                )
+            DB.execute(
+                """insert into archive (imei, day, first, last, count, data)
+                   values (?, ?, ?, ?, ?, ?)""",
+                (
+                    imei,
+                    day,
+                    rows[0][0],
+                    rows[-1][0],
+                    len(rows),
+                    compress(b"".join(block), level),
+                ),
+            )
+            DB.execute(
+                f"""delete from {name} where imei is ? and tstamp >= ?
+                    and tstamp < ?""",
+                (imei, start, end),
+            )
+            DB.commit()
+            total += len(rows)
+    return total
+
+
+def archived(
+    db: Connection,
+    imei: Optional[str] = None,
+    protos: Optional[Tuple[str, ...]] = None,
+) -> Iterator[Tuple[float, Optional[str], str, bool, str, bytes]]:
+    """
+    Yield archived events, optionally only those of one terminal and
+    with given protos, as (tstamp, imei, peeraddr, is_incoming, proto,
+    packet) tuples. Blocks come in the order of their first event, and
+    events of a block in the order of time, so the events of one
+    terminal are ordered, but those of different terminals are grouped
+    by block, not interleaved. Compressed data of a block is read whole,
+    but it is decompressed piecewise, and events are yielded as they
+    come out, so the decompressed block is never in memory at once.
+    """
+    if not db.execute(
+        "select 1 from sqlite_master where type = 'table' and name = ?",
+        ("archive",),
+    ).fetchone():
+        return
+    cur = db.execute(
+        "select imei, data from archive"
+        + ("" if imei is None else " where imei = :imei")
+        + " order by first",
+        {"imei": imei},
+    )
+    for bimei, data in cur:
+        dobj = decompressobj()
+        buffer = b""
+        for pos in range(0, len(data) + 1, ARCHUNK):
+            buffer += dobj.decompress(data[pos : pos + ARCHUNK])
+            offset = 0
+            while len(buffer) - offset >= _ARCREC.size:
+                (
+                    tstamp,
+                    is_incoming,
+                    lpeer,
+                    lproto,
+                    lpacket,
+                ) = _ARCREC.unpack_from(buffer, offset)
+                start = offset + _ARCREC.size
+                end = start + lpeer + lproto + lpacket
+                if end > len(buffer):
+                    break
+                proto = buffer[start + lpeer : start + lpeer + lproto].decode()
+                if protos is None or proto in protos:
+                    yield (
+                        tstamp,
+                        bimei,
+                        buffer[start : start + lpeer].decode(),
+                        bool(is_incoming),
+                        proto,
+                        buffer[end - lpacket : end],
+                    )
+                offset = end
+            buffer = buffer[offset:]
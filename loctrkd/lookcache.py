@@ -0,0 +1,139 @@
+"""
+Caching wrapper for lookaside backends
+"""
+
+from collections import OrderedDict
+from configparser import ConfigParser
+from logging import getLogger
+from sqlite3 import connect, Connection
+from threading import Lock
+from time import time
+from typing import Any, List, Optional, Tuple
+
+__all__ = ("LookupCache",)
+
+log = getLogger("loctrkd/lookcache")
+
+SCHEMA = """create table if not exists lookups (
+    key text not null primary key,
+    expires real not null,
+    latitude real not null,
+    longitude real not null,
+    accuracy real not null
+)"""
+
+
+def fingerprint(
+    mcc: int,
+    mnc: int,
+    gsm_cells: List[Tuple[int, int, int]],
+    wifi_aps: List[Tuple[str, int]],
+) -> str:
+    """Same cells and access points in any order and with any signal"""
+    return "{}:{}:{}:{}".format(
+        mcc,
+        mnc,
+        ",".join(
+            f"{area}/{cell}"
+            for area, cell in sorted(
+                {(area, cell) for area, cell, _ in gsm_cells}
+            )
+        ),
+        ",".join(sorted({mac.lower() for mac, _ in wifi_aps})),
+    )
+
+
+class LookupCache:
+    """
+    Wraps lookaside backend module `qry` and remembers up to `size`
+    results for `ttl` seconds, least recently used are evicted first.
+    If `dbfn` is given, results are also kept there, and loaded back
+    on `init()`. Failed lookups are not remembered. Can be used from
+    several threads.
+    """
+
+    def __init__(
+        self, qry: Any, size: int, ttl: float, dbfn: Optional[str] = None
+    ) -> None:
+        self.qry = qry
+        self.size = size
+        self.ttl = ttl
+        self.dbfn = dbfn
+        self.db: Optional[Connection] = None
+        self.lock = Lock()
+        self.cache: "OrderedDict[str, Tuple[float, Tuple[float, float, float]]]"
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def init(self, conf: ConfigParser) -> None:
+        self.qry.init(conf)
+        if self.dbfn is None:
+            return
+        self.db = connect(self.dbfn, check_same_thread=False)
+        self.db.execute(SCHEMA)
+        self.db.execute("delete from lookups where expires < ?", (time(),))
+        self.db.commit()
+        for key, expires, lat, lon, acc in self.db.execute(
+            """select key, expires, latitude, longitude, accuracy
+               from lookups order by expires desc limit ?""",
+            (self.size,),
+        ).fetchall()[::-1]:
+            self.cache[key] = (expires, (lat, lon, acc))
+        log.info(
+            "Loaded %d cached lookups from %s", len(self.cache), self.dbfn
+        )
+
+    def shut(self) -> None:
+        self.logstats()
+        if self.db is not None:
+            self.db.close()
+        self.qry.shut()
+
+    def logstats(self) -> None:
+        log.info(
+            "Lookups: %d hits, %d misses, %d cached",
+            self.hits,
+            self.misses,
+            len(self.cache),
+        )
+
+    def lookup(
+        self,
+        mcc: int,
+        mnc: int,
+        gsm_cells: List[Tuple[int, int, int]],
+        wifi_aps: List[Tuple[str, int]],
+    ) -> Tuple[float, float, float]:
+        key = fingerprint(mcc, mnc, gsm_cells, wifi_aps)
+        now = time()
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] > now:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        # Not holding the lock while the backend works
+        result: Tuple[float, float, float] = self.qry.lookup(
+            mcc, mnc, gsm_cells, wifi_aps
+        )
+        expires = time() + self.ttl
+        with self.lock:
+            self.cache[key] = (expires, result)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.size:
+                evicted, _ = self.cache.popitem(last=False)
+                if self.db is not None:
+                    self.db.execute(
+                        "delete from lookups where key = ?", (evicted,)
+                    )
+            if self.db is not None:
+                self.db.execute(
+                    """insert or replace into lookups
+                       (key, expires, latitude, longitude, accuracy)
+                       values (?, ?, ?, ?, ?)""",
+                    (key, expires, *result),
+                )
+                self.db.commit()
+        return result
@@ -9,11 +9,12 @@ from datetime import datetime, timezone
 from getopt import getopt
 from importlib import import_module
 from logging import getLogger
-from sqlite3 import connect
+from itertools import chain
 from sys import argv
 from typing import Any, cast, List, Tuple
 
 from . import common
+from .evstore import archived, partitions, readonly
 from .protomodule import ProtoModule
 
 log = getLogger("loctrkd/mkgpx")
@@ -22,14 +23,18 @@ log = getLogger("loctrkd/mkgpx")
 def main(
     conf: ConfigParser, opts: List[Tuple[str, str]], args: List[str]
 ) -> None:
-    db = connect(conf.get("storage", "dbfn"))
-    c = db.cursor()
-    c.execute(
-        """select tstamp, is_incoming, proto, packet from events
-           where imei = ?  and is_incoming = true
-           and proto in (?, ?)
-           order by tstamp""",
-        (args[0], "BS:UD", "BS:UD2"),
+    db = readonly(conf.get("storage", "dbfn"))
+    # One query per partition, oldest first: there can be more of them
+    # than sqlite allows terms in a compound select
+    c = chain.from_iterable(
+        db.execute(
+            """select tstamp, is_incoming, proto, packet from """
+            + name
+            + """ where imei = :imei and is_incoming = true
+               and proto in (:ud, :ud2) order by tstamp""",
+            {"imei": args[0], "ud": "BS:UD", "ud2": "BS:UD2"},
+        )
+        for name in reversed(partitions(db, "events"))
     )
     print(
         """<?xml version="1.0"?>
@@ -43,7 +48,17 @@ def main(
     """
     )
 
-    for tstamp, is_incoming, proto, packet in c:
+    # Archived events are older than those still in the tables
+    for tstamp, is_incoming, proto, packet in chain(
+        (
+            (tstamp, is_incoming, proto, packet)
+            for tstamp, _, _, is_incoming, proto, packet in archived(
+                db, imei=args[0], protos=("BS:UD", "BS:UD2")
+            )
+            if is_incoming
+        ),
+        c,
+    ):
         pmod = common.pmod_for_proto(proto)
         if pmod is not None:
             msg = pmod.parse_message(packet, is_incoming=is_incoming)
@@ -2,30 +2,212 @@
 Lookaside backend to query local opencellid database
 """
 
+from array import array
+from bisect import bisect_left
 from configparser import ConfigParser
-from sqlite3 import connect
-from typing import Any, Dict, List, Tuple
+from logging import getLogger
+from math import cos, radians, sqrt
+from sqlite3 import connect, Connection
+from threading import local
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
 __all__ = "init", "lookup"
 
-ldb = None
+log = getLogger("loctrkd/opencellid")
+
+dbfn = None
+# Lookups may run in several threads, each needs its own connection
+tls = local()
+cells: Optional["CellIndex"] = None
+
+
+# A cell, as used by the estimator: latitude, longitude, range (m)
+# and number of samples from the database, signal strength from the
+# terminal.
+Cell = Tuple[float, float, float, float, int]
+
+MINRANGE = 100.0  # Opencellid has cells with range 0 and 1
+DEFAULTRANGE = 1000.0
+DEFAULTSIGNAL = -100  # For terminals that do not report it
+SAMPLESPRIOR = 2.0  # Cell with this many samples has half the weight
+EARTHRADIUS = 6371008.8  # Mean radius in metres
+
+
+def centroid(
+    data: List[Cell], minrange: float = MINRANGE
+) -> Tuple[float, float, float]:
+    """
+    Weighted centroid of the cells and its accuracy radius in metres.
+    Cell weight grows with the signal strength (1/|dBm|) and with the
+    number of samples (n/(n+SAMPLESPRIOR)), and is inversely proportional
+    to the cell range. Accuracy is the weighted root mean square of
+    distance from the centroid to the cell plus the cell range, that is
+    the range itself when there is only one cell. Ranges smaller than
+    `minrange` are not trusted.
+    """
+    weights = []
+    for _, _, rng, samples, signal in data:
+        if signal >= 0:
+            signal = DEFAULTSIGNAL
+        weights.append(
+            (1.0 / -signal)
+            * (samples / (samples + SAMPLESPRIOR))
+            / max(rng, minrange)
+        )
+    sumw = sum(weights)
+    if sumw <= 0.0:
+        raise ValueError("Cells have no weight")
+    lat = sum(w * c[0] for w, c in zip(weights, data)) / sumw
+    lon = sum(w * c[1] for w, c in zip(weights, data)) / sumw
+    coslat = cos(radians(lat))
+    acc = 0.0
+    for w, (clat, clon, rng, _, _) in zip(weights, data):
+        dy = radians(clat - lat) * EARTHRADIUS
+        dx = radians(clon - lon) * EARTHRADIUS * coslat
+        acc += w * (dx * dx + dy * dy + max(rng, minrange) ** 2)
+    return lat, lon, sqrt(acc / sumw)
+
+
+class CellIndex:
+    """
+    Cells, looked up by (mcc, net, area, cell) packed into one 64 bit
+    integer, in a sorted array. Cells with a component that does not
+    fit its bit field (e.g. 5G cell ids) go to a dict. Cells of
+    different radio types can have the same key, all of them are
+    returned, like the sql query does.
+    """
+
+    def __init__(
+        self,
+        rows: Iterable[Tuple[int, int, int, int, float, float, float, float]],
+    ) -> None:
+        self.mccs: Set[int] = set()
+        self.extra: Dict[
+            Tuple[int, int, int, int], List[Tuple[float, float, float, float]]
+        ] = {}
+        packed = []
+        for mcc, net, area, cell, lat, lon, rng, samples in rows:
+            self.mccs.add(mcc)
+            key = self.key(mcc, net, area, cell)
+            if key is None:
+                self.extra.setdefault((mcc, net, area, cell), []).append(
+                    (lat, lon, rng, samples)
+                )
+            else:
+                packed.append((key, lat, lon, rng, samples))
+        packed.sort()
+        self.keys = array("Q", (row[0] for row in packed))
+        self.lats = array("d", (row[1] for row in packed))
+        self.lons = array("d", (row[2] for row in packed))
+        self.ranges = array("d", (row[3] for row in packed))
+        self.samples = array("d", (row[4] for row in packed))
+
+    def __len__(self) -> int:
+        return len(self.keys) + sum(len(v) for v in self.extra.values())
+
+    @staticmethod
+    def key(mcc: int, net: int, area: int, cell: int) -> Optional[int]:
+        if (
+            0 <= mcc < 1 << 10
+            and 0 <= net < 1 << 10
+            and 0 <= area < 1 << 16
+            and 0 <= cell < 1 << 28
+        ):
+            return mcc << 54 | net << 44 | area << 28 | cell
+        return None
+
+    def get(
+        self, mcc: int, net: int, area: int, cell: int
+    ) -> List[Tuple[float, float, float, float]]:
+        key = self.key(mcc, net, area, cell)
+        if key is None:
+            return self.extra.get((mcc, net, area, cell), [])
+        found = []
+        pos = bisect_left(self.keys, key)
+        while pos < len(self.keys) and self.keys[pos] == key:
+            found.append(
+                (
+                    self.lats[pos],
+                    self.lons[pos],
+                    self.ranges[pos],
+                    self.samples[pos],
+                )
+            )
+            pos += 1
+        return found
+
+
+def _ldb() -> Connection:
+    ldb: Optional[Connection] = getattr(tls, "ldb", None)
+    if ldb is None:
+        assert dbfn is not None
+        ldb = connect(dbfn)
+        ldb.execute(
+            "create temp table seen (locac int, cellid int, signal int)"
+        )
+        tls.ldb = ldb
+    return ldb
 
 
 def init(conf: ConfigParser) -> None:
-    global ldb
-    ldb = connect(conf["opencellid"]["dbfn"])
-    ldb.execute("create temp table seen (locac int, cellid int, signal int)")
+    global dbfn, cells
+    dbfn = conf["opencellid"]["dbfn"]
+    ldb = _ldb()
+    if conf.getboolean("opencellid", "inmemory", fallback=False):
+        mcc = conf.get("opencellid", "downloadmcc", fallback="")
+        cells = CellIndex(
+            ldb.execute(
+                f"""select mcc, net, area, cell, lat, lon,
+                       {_RANGE}, {_SAMPLES} from cells
+                   where typeof(mcc) = 'integer'"""
+                + (" and mcc = ?" if mcc.isdigit() else ""),
+                (int(mcc),) if mcc.isdigit() else (),
+            )
+        )
+        log.info(
+            "Loaded %d cells of MCC %s into memory", len(cells), cells.mccs
+        )
 
 
 def shut() -> None:
+    # Connections of other threads are closed when the threads end
+    ldb: Optional[Connection] = getattr(tls, "ldb", None)
     if ldb is not None:
         ldb.close()
+        tls.ldb = None
+
+
+def seen(
+    mcc: int, mnc: int, gsm_cells: List[Tuple[int, int, int]]
+) -> List[Cell]:
+    """Cells from the database that match those seen by the terminal"""
+    if cells is not None and mcc in cells.mccs:
+        data = []
+        for locac, cellid, signal in gsm_cells:
+            for lat, lon, rng, samples in cells.get(mcc, mnc, locac, cellid):
+                data.append((lat, lon, rng, samples, signal))
+        return data
+    return _query(mcc, mnc, gsm_cells)
 
 
 def lookup(
     mcc: int, mnc: int, gsm_cells: List[Tuple[int, int, int]], __: Any
 ) -> Tuple[float, float, float]:
-    assert ldb is not None
+    data = seen(mcc, mnc, gsm_cells)
+    if not data:
+        raise ValueError("No location data found in opencellid")
+    return centroid(data)
+
+
+# Range and samples may be missing in the downloaded data
+_RANGE = f"coalesce(range, {DEFAULTRANGE})"
+_SAMPLES = "coalesce(samples, 1)"
+
+
+def _query(
+    mcc: int, mnc: int, gsm_cells: List[Tuple[int, int, int]]
+) -> List[Cell]:
+    ldb = _ldb()
     lc = ldb.cursor()
     lc.executemany(
         "insert into seen (locac, cellid, signal) values (?, ?, ?)",
@@ -33,7 +215,7 @@ def lookup(
     )
     ldb.commit()
     lc.execute(
-        """select c.lat, c.lon, s.signal
+        f"""select c.lat, c.lon, {_RANGE}, {_SAMPLES}, s.signal
                   from cells c, seen s
                   where c.mcc = ?
                   and c.net = ?
@@ -46,10 +228,4 @@ def lookup(
     # https://www.sqlite.org/lang_delete.html#the_truncate_optimization
     lc.execute("delete from seen")
     lc.close()
-    if not data:
-        raise ValueError("No location data found in opencellid")
-    sumsig = sum([1 / sig for _, _, sig in data])
-    nsigs = [1 / sig / sumsig for _, _, sig in data]
-    avlat = sum([lat * nsig for (lat, _, _), nsig in zip(data, nsigs)])
-    avlon = sum([lon * nsig for (_, lon, _), nsig in zip(data, nsigs)])
-    return avlat, avlon, 99.9  # TODO estimate accuracy for real
+    return data
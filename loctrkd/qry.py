@@ -5,11 +5,12 @@ from datetime import datetime, timezone
 from getopt import getopt
 from importlib import import_module
 from logging import getLogger
-from sqlite3 import connect
+from itertools import chain
 from sys import argv
 from typing import Any, cast, List, Tuple
 
 from . import common
+from .evstore import archived, partitions, readonly
 from .protomodule import ProtoModule
 
 log = getLogger("loctrkd/qry")
@@ -26,8 +27,7 @@ def main(
         cast(ProtoModule, import_module("." + modnm, __package__))
         for modnm in conf.get("common", "protocols").split(",")
     ]
-    db = connect(conf.get("storage", "dbfn"))
-    c = db.cursor()
+    db = readonly(conf.get("storage", "dbfn"))
     if len(args) > 0:
         proto = args[0]
         selector = " where proto = :proto"
@@ -42,14 +42,25 @@ def main(
         attr = ""
         fn = ""
 
-    c.execute(
-        """select tstamp, imei, peeraddr, is_incoming, proto, packet
-           from events"""
-        + selector,
-        {"proto": proto},
+    # One query per partition, oldest first: there can be more of them
+    # than sqlite allows terms in a compound select. Queries run lazily,
+    # after the loop below has reused `proto`.
+    parms = {"proto": proto}
+    c = chain.from_iterable(
+        db.execute(
+            """select tstamp, imei, peeraddr, is_incoming, proto, packet
+               from """
+            + name
+            + selector,
+            parms,
+        )
+        for name in reversed(partitions(db, "events"))
     )
 
-    for tstamp, imei, peeraddr, is_incoming, proto, packet in c:
+    # Archived events are older than those still in the tables
+    for tstamp, imei, peeraddr, is_incoming, proto, packet in chain(
+        archived(db, protos=(proto,) if proto else None), c
+    ):
         msg: Any = f"Unparseable({packet.hex()})"
         for pmod in pmods:
             if pmod.proto_handled(proto):
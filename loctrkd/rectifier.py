@@ -1,20 +1,36 @@
 """ Estimate coordinates from WIFI_POSITIONING and send back """
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from configparser import ConfigParser
 from datetime import datetime, timezone
+from functools import partial
 from importlib import import_module
-from logging import getLogger
+from logging import DEBUG, getLogger
 from os import umask
 from struct import pack
-from typing import cast, List, Tuple
+from time import time
+from typing import Any, Callable, cast, Deque, Dict, List, Optional, Tuple
 import zmq
 
 from . import common
-from .common import CoordReport, HintReport, StatusReport, Report
+from .common import (
+    Completions,
+    CoordReport,
+    HintReport,
+    StatusReport,
+    Report,
+)
+from .lookcache import LookupCache
 from .zmsg import Bcast, Rept, Resp, topic
 
 log = getLogger("loctrkd/rectifier")
 
+CACHETTL: int = 86400
+STATSINTERVAL: int = 300
+LOOKUPTHREADS: int = 4
+LOOKUPTIMEOUT: int = 30
+
 
 class QryModule:
     @staticmethod
@@ -35,12 +51,199 @@ class QryModule:
         ...
 
 
+class Lookups:
+    """
+    Lookups done in a pool of `workers` threads. Lookups for one IMEI
+    are done one after another in the order of arrival, so that the
+    responses to the terminal and the reports go out in that order,
+    lookups for different IMEIs run concurrently. A lookup that runs
+    longer than `timeout` seconds (not counting the time it waited for
+    a free worker) is given up and the next one for the IMEI is started,
+    although its thread cannot be interrupted.
+    """
+
+    def __init__(self, workers: int, timeout: float) -> None:
+        self.executor = ThreadPoolExecutor(
+            workers, thread_name_prefix="lookup"
+        )
+        self.timeout = timeout
+        self.completions: Completions[
+            Tuple[Optional[str], "Future[Any]"]
+        ] = Completions()
+        # Lookups waiting for the IMEI, the first one is running
+        self.queues: Dict[
+            Optional[str],
+            Deque[Tuple[Callable[[], Any], Callable[["Future[Any]"], None]]],
+        ] = {}
+        # Time when the lookup has started, once it has
+        self.running: Dict[
+            Optional[str], Tuple[List[float], "Future[Any]"]
+        ] = {}
+
+    def fileno(self) -> int:
+        return self.completions.fileno()
+
+    def submit(
+        self,
+        imei: Optional[str],
+        func: Callable[[], Any],
+        then: Callable[["Future[Any]"], None],
+    ) -> None:
+        """
+        Run `func()` in a worker, then `then(future)` in the thread that
+        calls `process()`. Future is not done if the lookup timed out.
+        """
+        queue = self.queues.setdefault(imei, deque())
+        queue.append((func, then))
+        if len(queue) == 1:
+            self._start(imei)
+
+    def _start(self, imei: Optional[str]) -> None:
+        func, _ = self.queues[imei][0]
+        started: List[float] = []
+        future = self.executor.submit(self._run, started, func)
+        self.running[imei] = (started, future)
+        future.add_done_callback(
+            lambda future: self.completions.put((imei, future))
+        )
+
+    @staticmethod
+    def _run(started: List[float], func: Callable[[], Any]) -> Any:
+        started.append(time())
+        return func()
+
+    def _finish(self, imei: Optional[str], future: "Future[Any]") -> None:
+        _, then = self.queues[imei].popleft()
+        del self.running[imei]
+        if self.queues[imei]:
+            self._start(imei)
+        else:
+            del self.queues[imei]
+        then(future)
+
+    def process(self) -> Optional[float]:
+        """
+        Called from the loop to finish completed and overdue lookups.
+        Return the number of seconds until the next one becomes overdue.
+        """
+        for imei, future in self.completions.take():
+            running = self.running.get(imei)
+            if running is not None and running[1] is future:
+                self._finish(imei, future)
+            # Otherwise it has been given up already
+        now = time()
+        deadlines = []
+        for imei, (started, future) in list(self.running.items()):
+            if not started:
+                continue  # Still waiting for a free worker
+            deadline = started[0] + self.timeout
+            if deadline <= now:
+                future.cancel()  # In case it has not really started
+                self._finish(imei, future)
+            else:
+                deadlines.append(deadline)
+        if deadlines:
+            return max(0.0, min(deadlines) - now)
+        return None
+
+    def close(self) -> None:
+        for _, future in self.running.values():
+            future.cancel()
+        self.executor.shutdown(wait=False)
+        self.completions.close()
+
+
+def located(
+    zpub: Any,
+    zpush: Any,
+    binary: bool,
+    needanswer: bool,
+    zmsg: Bcast,
+    msg: Any,
+    rect: HintReport,
+    future: "Future[Tuple[float, float, float]]",
+) -> None:
+    """Send the response and the report when lookup has finished"""
+    if not future.done():
+        log.error("Lookup for %s rectified as %s timed out", msg, rect)
+        return
+    try:
+        lat, lon, acc = future.result()
+        log.debug(
+            "Approximated lat=%s, lon=%s, acc=%s for %s",
+            lat,
+            lon,
+            acc,
+            rect,
+        )
+        if needanswer:
+            resp = Resp(
+                imei=zmsg.imei,
+                when=zmsg.when,  # not the current time, but the original!
+                packet=msg.Out(latitude=lat, longitude=lon).packed,
+            )
+            log.debug("Sending reponse %s", resp)
+            zpush.send(resp.packed)
+        rept = CoordReport(
+            devtime=rect.devtime,
+            battery_percentage=rect.battery_percentage,
+            accuracy=acc,
+            altitude=None,
+            speed=None,
+            direction=None,
+            latitude=lat,
+            longitude=lon,
+        )
+        log.debug("Sending report %s", rept)
+        zpub.send(
+            Rept(
+                imei=zmsg.imei,
+                payload=rept.binary if binary else rept.json,
+            ).packed
+        )
+    except Exception as e:
+        log.exception(
+            "Lookup for %s rectified as %s resulted in %s",
+            msg,
+            rect,
+            e,
+        )
+
+
+def learned(msg: Any, future: "Future[int]") -> None:
+    """Log the outcome of learning from a report with a WiFi scan"""
+    if not future.done():
+        log.error("Learning from %s timed out", msg)
+        return
+    try:
+        log.debug("Learned %d access points from %s", future.result(), msg)
+    except Exception as e:
+        log.exception("Learning from %s resulted in %s", msg, e)
+
+
 def runserver(conf: ConfigParser) -> None:
     qry = cast(
         QryModule,
         import_module("." + conf.get("rectifier", "lookaside"), __package__),
     )
+    # Backend may learn from reports that have both GPS and WiFi data
+    learn: Optional[Callable[..., int]] = getattr(qry, "learn", None)
+    cache: Optional[LookupCache] = None
+    cachesize = conf.getint("rectifier", "cachesize", fallback=0)
+    if cachesize > 0:
+        cache = LookupCache(
+            qry,
+            cachesize,
+            conf.getint("rectifier", "cachettl", fallback=CACHETTL),
+            conf.get("rectifier", "cachefile", fallback=None),
+        )
+        qry = cast(QryModule, cache)
     qry.init(conf)
+    binary = conf.getboolean("rectifier", "binaryreports", fallback=False)
+    lookups = Lookups(
+        conf.getint("rectifier", "lookupthreads", fallback=LOOKUPTHREADS),
+        conf.getint("rectifier", "lookuptimeout", fallback=LOOKUPTIMEOUT),
+    )
     proto_needanswer = dict(common.exposed_protos())
     # Is this https://github.com/zeromq/pyzmq/issues/1627 still not fixed?!
     zctx = zmq.Context()  # type: ignore
@@ -54,73 +257,93 @@ def runserver(conf: ConfigParser) -> None:
     oldmask = umask(0o117)
     zpub.bind(conf.get("rectifier", "publishurl"))
     umask(oldmask)
+    poller = zmq.Poller()
+    poller.register(zsub, flags=zmq.POLLIN)
+    poller.register(lookups.fileno(), flags=zmq.POLLIN)
 
     try:
+        nextstats = time() + STATSINTERVAL
+        timeout = 1000
         while True:
-            zmsg = Bcast(zsub.recv())
-            msg = common.parse_message(
-                zmsg.proto, zmsg.packet, is_incoming=zmsg.is_incoming
-            )
-            log.debug(
-                "IMEI %s from %s at %s: %s",
-                zmsg.imei,
-                zmsg.peeraddr,
-                datetime.fromtimestamp(zmsg.when).astimezone(tz=timezone.utc),
-                msg,
-            )
-            rect = msg.rectified()
-            log.debug("rectified: %s", rect)
-            if isinstance(rect, (CoordReport, StatusReport)):
-                zpub.send(Rept(imei=zmsg.imei, payload=rect.json).packed)
-            elif isinstance(rect, HintReport):
+            if cache is not None and time() >= nextstats:
+                cache.logstats()
+                nextstats = time() + STATSINTERVAL
+            poller.poll(timeout)
+            while True:
                 try:
-                    lat, lon, acc = qry.lookup(
-                        rect.mcc,
-                        rect.mnc,
-                        rect.gsm_cells,
-                        list((mac, strng) for _, mac, strng in rect.wifi_aps),
+                    parts = zsub.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                # Collector may publish batches as multipart
+                for zmsg in (Bcast(part) for part in parts):
+                    msg = common.parse_message(
+                        zmsg.proto, zmsg.packet, is_incoming=zmsg.is_incoming
                     )
-                    log.debug(
-                        "Approximated lat=%s, lon=%s, acc=%s for %s",
-                        lat,
-                        lon,
-                        acc,
-                        rect,
-                    )
-                    if proto_needanswer.get(zmsg.proto, False):
-                        resp = Resp(
-                            imei=zmsg.imei,
-                            when=zmsg.when,  # not the current time, but the original!
-                            packet=msg.Out(latitude=lat, longitude=lon).packed,
+                    if log.isEnabledFor(DEBUG):
+                        log.debug(
+                            "IMEI %s from %s at %s: %s",
+                            zmsg.imei,
+                            zmsg.peeraddr,
+                            datetime.fromtimestamp(zmsg.when).astimezone(
+                                tz=timezone.utc
+                            ),
+                            msg,
                         )
-                        log.debug("Sending reponse %s", resp)
-                        zpush.send(resp.packed)
-                    rept = CoordReport(
-                        devtime=rect.devtime,
-                        battery_percentage=rect.battery_percentage,
-                        accuracy=acc,
-                        altitude=None,
-                        speed=None,
-                        direction=None,
-                        latitude=lat,
-                        longitude=lon,
-                    )
-                    log.debug("Sending report %s", rept)
-                    zpub.send(
-                        Rept(
-                            imei=zmsg.imei,
-                            payload=rept.json,
-                        ).packed
-                    )
-                except Exception as e:
-                    log.exception(
-                        "Lookup for %s rectified as %s resulted in %s",
-                        msg,
-                        rect,
-                        e,
-                    )
+                    rect = msg.rectified()
+                    log.debug("rectified: %s", rect)
+                    if (
+                        learn is not None
+                        and isinstance(rect, CoordReport)
+                        and hasattr(msg, "wifi_scan")
+                    ):
+                        lookups.submit(
+                            zmsg.imei,
+                            partial(
+                                learn,
+                                msg.wifi_scan(),
+                                rect.latitude,
+                                rect.longitude,
+                                rect.accuracy,
+                            ),
+                            partial(learned, msg),
+                        )
+                    if isinstance(rect, (CoordReport, StatusReport)):
+                        # Not waiting for lookups of this IMEI, if any
+                        zpub.send(
+                            Rept(
+                                imei=zmsg.imei,
+                                payload=rect.binary if binary else rect.json,
+                            ).packed
+                        )
+                    elif isinstance(rect, HintReport):
+                        lookups.submit(
+                            zmsg.imei,
+                            partial(
+                                qry.lookup,
+                                rect.mcc,
+                                rect.mnc,
+                                rect.gsm_cells,
+                                list(
+                                    (mac, strng)
+                                    for _, mac, strng in rect.wifi_aps
+                                ),
+                            ),
+                            partial(
+                                located,
+                                zpub,
+                                zpush,
+                                binary,
+                                proto_needanswer.get(zmsg.proto, False),
+                                zmsg,
+                                msg,
+                                rect,
+                            ),
+                        )
+            due = lookups.process()
+            timeout = 1000 if due is None else min(1000, int(due * 1000) + 1)
 
     except KeyboardInterrupt:
+        lookups.close()
         zsub.close()
         zpub.close()
         zpush.close()
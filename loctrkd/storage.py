@@ -2,22 +2,277 @@
 
 from configparser import ConfigParser
 from datetime import datetime, timezone
-from json import loads
-from logging import getLogger
+from logging import DEBUG, getLogger
+from os import replace, unlink
+from queue import Empty, Full, Queue
+from struct import Struct
+from sys import exit
+from threading import Event, Lock, Thread
+from time import time
+from typing import BinaryIO, Optional, Tuple
 import zmq
 
 from . import common
-from .evstore import initdb, stow, stowloc, stowpmod
+from .evstore import (
+    commit_pending,
+    committed,
+    flush,
+    initdb,
+    stow,
+    stowloc,
+    stowpmod,
+)
 from .zmsg import Bcast, Rept
 
 log = getLogger("loctrkd/storage")
 
+COMMITROWS: int = 1000
+COMMITMSEC: int = 100
+MAXPENDING: int = 100000
+QUEUESIZE: int = 10000
+STATSINTERVAL: int = 300
 
-def runserver(conf: ConfigParser) -> None:
-    stowevents = conf.getboolean("storage", "events", fallback=False)
-    dbname = conf.get("storage", "dbfn")
-    log.info('Using Sqlite3 database "%s"', dbname)
-    initdb(dbname)
+# Kinds of messages passed to the writer thread
+BCAST = 0
+REPT = 1
+
+# Journal record header: kind and length of the message
+_RECORD = Struct("!BI")
+
+
+class Writer(Thread):
+    """
+    Thread that owns the database and stores messages that the main
+    thread receives from zmq and puts into a bounded queue. When the
+    queue is full, depending on `policy`, the main thread waits ("block"),
+    throws away the oldest queued message ("dropoldest"), or appends
+    the message to a journal file ("spill"), that the writer replays
+    when it has caught up with the queue.
+
+    The counters are only reported by `logstats()`, that the main thread
+    calls every `STATSINTERVAL` seconds and on exit. `received`, `dropped`
+    and `spilled` count messages and are updated by the main thread,
+    `failed` counts messages that the writer could not parse or store.
+    Rows are counted as stored when their transaction is committed.
+    """
+
+    def __init__(self, conf: ConfigParser) -> None:
+        super().__init__(name="writer", daemon=True)
+        self.conf = conf
+        self.stowevents = conf.getboolean("storage", "events", fallback=False)
+        self.policy = conf.get("storage", "queuefull", fallback="block")
+        if self.policy not in ("block", "dropoldest", "spill"):
+            raise ValueError(
+                f"queuefull must be block, dropoldest or spill,"
+                f" not {self.policy}"
+            )
+        self.journal = conf.get(
+            "storage",
+            "journal",
+            fallback=conf.get("storage", "dbfn") + ".journal",
+        )
+        self.queue: "Queue[Optional[Tuple[int, bytes]]]" = Queue(
+            conf.getint("storage", "queuesize", fallback=QUEUESIZE)
+        )
+        self.ready = Event()
+        self.lock = Lock()  # Guards spill file
+        self.spillfile: Optional[BinaryIO] = None
+        self.received = 0
+        self.maxdepth = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.failed = 0
+
+    def _wait(self, item: Optional[Tuple[int, bytes]]) -> bool:
+        """
+        Wait for room in the queue for as long as the writer is alive,
+        return False if it is not.
+        """
+        while True:
+            try:
+                self.queue.put(item, timeout=1.0)
+                return True
+            except Full:
+                if not self.is_alive():
+                    return False
+
+    def put(self, kind: int, data: bytes) -> None:
+        """Called from the main thread to pass a message to the writer"""
+        self.received += 1
+        if self.policy == "block":
+            if not self._wait((kind, data)):
+                self.dropped += 1
+        else:
+            try:
+                self.queue.put_nowait((kind, data))
+            except Full:
+                if self.policy == "dropoldest":
+                    try:
+                        self.queue.get_nowait()
+                    except Empty:
+                        pass
+                    self.dropped += 1
+                    # Only this thread puts, so there is room now
+                    self.queue.put_nowait((kind, data))
+                else:
+                    with self.lock:
+                        if self.spillfile is None:
+                            self.spillfile = open(self.journal, "ab")
+                        self.spillfile.write(
+                            _RECORD.pack(kind, len(data)) + data
+                        )
+                    self.spilled += 1
+        depth = self.queue.qsize()
+        if depth > self.maxdepth:
+            self.maxdepth = depth
+
+    def stop(self) -> None:
+        """Called from the main thread to make the writer finish"""
+        self._wait(None)
+        self.join()
+
+    def logstats(self) -> None:
+        log.info(
+            "Received %d, dropped %d, spilled %d, failed %d,"
+            " stored %d rows, queue depth %d (max %d)",
+            self.received,
+            self.dropped,
+            self.spilled,
+            self.failed,
+            committed(),
+            self.queue.qsize(),
+            self.maxdepth,
+        )
+
+    def run(self) -> None:
+        try:
+            initdb(
+                self.conf.get("storage", "dbfn"),
+                wal=self.conf.getboolean("storage", "wal", fallback=True),
+                synchronous=self.conf.get(
+                    "storage", "synchronous", fallback="normal"
+                ),
+                commitrows=self.conf.getint(
+                    "storage", "commitrows", fallback=COMMITROWS
+                ),
+                commitmsec=self.conf.getint(
+                    "storage", "commitmsec", fallback=COMMITMSEC
+                ),
+                partition=self.conf.get("storage", "partition", fallback=None),
+                retention=self.conf.getint("storage", "retention", fallback=0),
+                maxpending=self.conf.getint(
+                    "storage", "maxpending", fallback=MAXPENDING
+                ),
+            )
+        finally:
+            self.ready.set()
+        # Leftovers from the previous run, if any
+        self.replay(self.journal + ".replay")
+        self.catchup()
+        timeout = 1.0
+        while True:
+            try:
+                item = self.queue.get(timeout=timeout)
+                while item is not None:
+                    self.handle(*item)
+                    item = self.queue.get_nowait()
+                break  # None tells us to finish
+            except Empty:
+                pass
+            if self.spillfile is not None:
+                self.catchup()
+            try:
+                due = commit_pending()
+            except Exception as e:
+                # E.g. database locked by the archiver, retry later
+                log.exception("Could not commit: %s", e)
+                due = None
+            timeout = 1.0 if due is None else due / 1000.0
+        flush()
+        if self.spillfile is not None:
+            self.spillfile.close()
+
+    def catchup(self) -> None:
+        """Replay what has been spilled to the journal"""
+        with self.lock:
+            if self.spillfile is not None:
+                self.spillfile.close()
+                self.spillfile = None
+            try:
+                # Main thread can start a new journal while we replay
+                replace(self.journal, self.journal + ".replay")
+            except FileNotFoundError:
+                return
+        self.replay(self.journal + ".replay")
+
+    def replay(self, fn: str) -> None:
+        try:
+            with open(fn, "rb") as fl:
+                while True:
+                    header = fl.read(_RECORD.size)
+                    if len(header) < _RECORD.size:
+                        break
+                    kind, length = _RECORD.unpack(header)
+                    data = fl.read(length)
+                    if len(data) < length:
+                        break
+                    self.handle(kind, data)
+        except FileNotFoundError:
+            return
+        log.info("Replayed journal %s", fn)
+        flush()
+        unlink(fn)
+
+    def handle(self, kind: int, data: bytes) -> None:
+        try:
+            self.store(kind, data)
+        except Exception as e:
+            # Bad message must not kill the thread
+            self.failed += 1
+            log.exception("Could not store %s: %s", data.hex(), e)
+
+    def store(self, kind: int, data: bytes) -> None:
+        if kind == BCAST:
+            zmsg = Bcast(data)
+            if log.isEnabledFor(DEBUG):
+                log.debug(
+                    "%s IMEI %s from %s at %s %s: %s",
+                    "I" if zmsg.is_incoming else "O",
+                    zmsg.imei,
+                    zmsg.peeraddr,
+                    zmsg.pmod,
+                    datetime.fromtimestamp(zmsg.when).astimezone(
+                        tz=timezone.utc
+                    ),
+                    zmsg.packet.hex(),
+                )
+            if zmsg.imei is not None and zmsg.pmod is not None:
+                stowpmod(zmsg.imei, zmsg.pmod)
+            if self.stowevents:
+                stow(
+                    is_incoming=zmsg.is_incoming,
+                    peeraddr=str(zmsg.peeraddr),
+                    when=zmsg.when,
+                    imei=zmsg.imei,
+                    proto=zmsg.proto,
+                    packet=zmsg.packet,
+                )
+        elif kind == REPT:
+            rept = Rept(data)
+            report = rept.report
+            log.debug("R IMEI %s %s", rept.imei, report)
+            if report.pop("type") == "location":
+                report["imei"] = rept.imei
+                stowloc(**report)
+
+
+def runserver(conf: ConfigParser) -> int:
+    log.info('Using Sqlite3 database "%s"', conf.get("storage", "dbfn"))
+    writer = Writer(conf)
+    writer.start()
+    writer.ready.wait()
+    if not writer.is_alive():
+        return 1  # Could not open the database
     # Is this https://github.com/zeromq/pyzmq/issues/1627 still not fixed?!
     zctx = zmq.Context()  # type: ignore
     zraw = zctx.socket(zmq.SUB)  # type: ignore
@@ -31,56 +286,41 @@ def runserver(conf: ConfigParser) -> None:
     poller.register(zrep, flags=zmq.POLLIN)
 
     try:
-        while True:
+        nextstats = time() + STATSINTERVAL
+        while writer.is_alive():
             events = poller.poll(1000)
             for sk, fl in events:
                 if sk is zraw:
                     while True:
                         try:
-                            zmsg = Bcast(zraw.recv(zmq.NOBLOCK))
+                            parts = zraw.recv_multipart(zmq.NOBLOCK)
                         except zmq.Again:
                             break
-                        log.debug(
-                            "%s IMEI %s from %s at %s %s: %s",
-                            "I" if zmsg.is_incoming else "O",
-                            zmsg.imei,
-                            zmsg.peeraddr,
-                            zmsg.pmod,
-                            datetime.fromtimestamp(zmsg.when).astimezone(
-                                tz=timezone.utc
-                            ),
-                            zmsg.packet.hex(),
-                        )
-                        if zmsg.imei is not None and zmsg.pmod is not None:
-                            stowpmod(zmsg.imei, zmsg.pmod)
-                        if stowevents:
-                            stow(
-                                is_incoming=zmsg.is_incoming,
-                                peeraddr=str(zmsg.peeraddr),
-                                when=zmsg.when,
-                                imei=zmsg.imei,
-                                proto=zmsg.proto,
-                                packet=zmsg.packet,
-                            )
+                        # Collector may publish batches as multipart
+                        for part in parts:
+                            writer.put(BCAST, part)
                 elif sk is zrep:
                     while True:
                         try:
-                            rept = Rept(zrep.recv(zmq.NOBLOCK))
+                            writer.put(REPT, zrep.recv(zmq.NOBLOCK))
                         except zmq.Again:
                             break
-                        data = loads(rept.payload)
-                        log.debug("R IMEI %s %s", rept.imei, data)
-                        if data.pop("type") == "location":
-                            data["imei"] = rept.imei
-                            stowloc(**data)
-
                 else:
                     log.error("Event %s on unknown socket %s", fl, sk)
+            if time() >= nextstats:
+                writer.logstats()
+                nextstats = time() + STATSINTERVAL
+        log.error("Writer thread terminated")
+        status = 1  # Let systemd restart us
     except KeyboardInterrupt:
-        zrep.close()
-        zraw.close()
-        zctx.destroy()  # type: ignore
+        writer.stop()
+        writer.logstats()
+        status = 0
+    zrep.close()
+    zraw.close()
+    zctx.destroy()  # type: ignore
+    return status
 
 
 if __name__.endswith("__main__"):
-    runserver(common.init(log))
+    exit(runserver(common.init(log)))
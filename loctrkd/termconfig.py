@@ -59,51 +59,56 @@ def runserver(conf: ConfigParser) -> None:
 
     try:
         while True:
-            zmsg = Bcast(zsub.recv())
-            msg = parse_message(zmsg.packet)
-            log.debug(
-                "IMEI %s from %s at %s: %s",
-                zmsg.imei,
-                zmsg.peeraddr,
-                datetime.fromtimestamp(zmsg.when).astimezone(tz=timezone.utc),
-                msg,
-            )
-            if msg.RESPOND is not Respond.EXT:
-                log.error(
-                    "%s does not expect externally provided response", msg
+            # Collector may publish batches as multipart
+            for zmsg in (Bcast(part) for part in zsub.recv_multipart()):
+                msg = parse_message(zmsg.packet)
+                log.debug(
+                    "IMEI %s from %s at %s: %s",
+                    zmsg.imei,
+                    zmsg.peeraddr,
+                    datetime.fromtimestamp(zmsg.when).astimezone(
+                        tz=timezone.utc
+                    ),
+                    msg,
                 )
-            if zmsg.imei is not None and conf.has_section(zmsg.imei):
-                termconfig = normconf(conf[zmsg.imei])
-            elif conf.has_section("termconfig"):
-                termconfig = normconf(conf["termconfig"])
-            else:
-                termconfig = {}
-            kwargs = {}
-            if isinstance(msg, STATUS):
-                kwargs = {
-                    "upload_interval": termconfig.get(
-                        "statusintervalminutes", 25
+                if msg.RESPOND is not Respond.EXT:
+                    log.error(
+                        "%s does not expect externally provided response", msg
                     )
-                }
-            elif isinstance(msg, SETUP):
-                for key in (
-                    "uploadintervalseconds",
-                    "binaryswitch",
-                    "alarms",
-                    "dndtimeswitch",
-                    "dndtimes",
-                    "gpstimeswitch",
-                    "gpstimestart",
-                    "gpstimestop",
-                    "phonenumbers",
-                ):
-                    if key in termconfig:
-                        kwargs[key] = termconfig[key]
-            resp = Resp(
-                imei=zmsg.imei, when=zmsg.when, packet=msg.Out(**kwargs).packed
-            )
-            log.debug("Response: %s", resp)
-            zpush.send(resp.packed)
+                if zmsg.imei is not None and conf.has_section(zmsg.imei):
+                    termconfig = normconf(conf[zmsg.imei])
+                elif conf.has_section("termconfig"):
+                    termconfig = normconf(conf["termconfig"])
+                else:
+                    termconfig = {}
+                kwargs = {}
+                if isinstance(msg, STATUS):
+                    kwargs = {
+                        "upload_interval": termconfig.get(
+                            "statusintervalminutes", 25
+                        )
+                    }
+                elif isinstance(msg, SETUP):
+                    for key in (
+                        "uploadintervalseconds",
+                        "binaryswitch",
+                        "alarms",
+                        "dndtimeswitch",
+                        "dndtimes",
+                        "gpstimeswitch",
+                        "gpstimestart",
+                        "gpstimestop",
+                        "phonenumbers",
+                    ):
+                        if key in termconfig:
+                            kwargs[key] = termconfig[key]
+                resp = Resp(
+                    imei=zmsg.imei,
+                    when=zmsg.when,
+                    packet=msg.Out(**kwargs).packed,
+                )
+                log.debug("Response: %s", resp)
+                zpush.send(resp.packed)
 
     except KeyboardInterrupt:
         zsub.close()
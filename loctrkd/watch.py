@@ -34,29 +34,32 @@ def runserver(conf: ConfigParser) -> None:
                 if sk is zraw:
                     while True:
                         try:
-                            zmsg = Bcast(zraw.recv(zmq.NOBLOCK))
+                            parts = zraw.recv_multipart(zmq.NOBLOCK)
                         except zmq.Again:
                             break
-                        print(
-                            "I" if zmsg.is_incoming else "O",
-                            zmsg.proto,
-                            zmsg.imei,
-                        )
-                        pmod = common.pmod_for_proto(zmsg.proto)
-                        if pmod is not None:
-                            msg = pmod.parse_message(
-                                zmsg.packet, zmsg.is_incoming
+                        for zmsg in (Bcast(part) for part in parts):
+                            print(
+                                "I" if zmsg.is_incoming else "O",
+                                zmsg.proto,
+                                zmsg.imei,
                             )
-                            print(msg)
-                            if zmsg.is_incoming and hasattr(msg, "rectified"):
-                                print("Rectified:", msg.rectified())
+                            pmod = common.pmod_for_proto(zmsg.proto)
+                            if pmod is not None:
+                                msg = pmod.parse_message(
+                                    zmsg.packet, zmsg.is_incoming
+                                )
+                                print(msg)
+                                if zmsg.is_incoming and hasattr(
+                                    msg, "rectified"
+                                ):
+                                    print("Rectified:", msg.rectified())
                 elif sk is zrep:
                     while True:
                         try:
                             rept = Rept(zrep.recv(zmq.NOBLOCK))
                         except zmq.Again:
                             break
-                        print(rept)
+                        print("R", rept.imei, rept.report)
                 else:
                     print("what is this socket?!", sk)
     except KeyboardInterrupt:
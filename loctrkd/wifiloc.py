@@ -0,0 +1,199 @@
+"""
+Lookaside backend that locates WiFi access points seen by terminals
+together with a GPS fix, and combines them with another backend
+"""
+
+from configparser import ConfigParser
+from importlib import import_module
+from logging import getLogger
+from math import cos, radians, sqrt
+from sqlite3 import connect, Connection
+from threading import Lock
+from time import time
+from typing import Any, List, Optional, Tuple
+
+from .opencellid import centroid, EARTHRADIUS
+
+__all__ = "init", "learn", "lookup", "shut"
+
+log = getLogger("loctrkd/wifiloc")
+
+# Running weighted mean of the positions where the access point was
+# seen, `radius` is the weighted root mean square of their distance
+# from there plus the accuracy of the fixes.
+SCHEMA = """create table if not exists aps (
+    bssid text not null primary key,
+    latitude real not null,
+    longitude real not null,
+    radius real not null,
+    weight real not null,
+    samples integer not null,
+    updated real not null
+) without rowid"""
+
+MAXACCURACY: float = 100.0  # Worse fixes are not learned from
+MINACCURACY: float = 5.0  # GPS fixes are not better than that
+DEFAULTSIGNAL: int = -80
+MOVED: float = 1000.0  # Access point seen this far has been moved
+
+db: Optional[Connection] = None
+lock = Lock()
+cells: Any = None
+maxaccuracy = MAXACCURACY
+
+
+def init(conf: ConfigParser) -> None:
+    global db, cells, maxaccuracy
+    dbfn = conf.get(
+        "wifiloc", "dbfn", fallback="/var/lib/loctrkd/wifiloc.sqlite"
+    )
+    db = connect(dbfn, check_same_thread=False)
+    db.execute(SCHEMA)
+    maxaccuracy = conf.getfloat("wifiloc", "maxaccuracy", fallback=MAXACCURACY)
+    backend = conf.get("wifiloc", "cells", fallback="opencellid")
+    if backend:
+        cells = import_module("." + backend, __package__)
+        cells.init(conf)
+    count = db.execute("select count(*) from aps").fetchone()[0]
+    log.info("%d access points known, cells from %s", count, backend)
+
+
+def shut() -> None:
+    global db
+    if cells is not None:
+        cells.shut()
+    if db is not None:
+        db.close()
+        db = None
+
+
+def _distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Equirectangular approximation, good for short distances"""
+    dy = radians(lat2 - lat1)
+    dx = radians(lon2 - lon1) * cos(radians((lat1 + lat2) / 2))
+    return EARTHRADIUS * sqrt(dx * dx + dy * dy)
+
+
+def learn(
+    wifi_aps: List[Tuple[str, int]],
+    latitude: float,
+    longitude: float,
+    accuracy: Optional[float],
+) -> int:
+    """
+    Update access points in `wifi_aps` with the fix where they were
+    seen, return the number of updated access points.
+    """
+    if accuracy is None or accuracy <= 0.0:
+        accuracy = maxaccuracy  # Unknown, but the terminal trusts it
+    if accuracy > maxaccuracy or not wifi_aps:
+        return 0
+    accuracy = max(accuracy, MINACCURACY)
+    assert db is not None
+    now = time()
+    with lock:
+        for mac, signal in wifi_aps:
+            bssid = mac.lower()
+            if signal >= 0:
+                signal = DEFAULTSIGNAL
+            # Closer to the access point where the signal is stronger
+            weight = 1.0 / (-signal * accuracy)
+            row = db.execute(
+                """select latitude, longitude, radius, weight, samples
+                   from aps where bssid = ?""",
+                (bssid,),
+            ).fetchone()
+            if row is not None:
+                lat, lon, rad, total, samples = row
+                dist = _distance(lat, lon, latitude, longitude)
+                if dist > MOVED:
+                    log.info("Access point %s has moved %.0f m", bssid, dist)
+                    row = None
+            if row is None:
+                lat, lon, rad, total, samples = (
+                    latitude,
+                    longitude,
+                    accuracy,
+                    weight,
+                    1,
+                )
+            else:
+                total += weight
+                lat += (latitude - lat) * weight / total
+                lon += (longitude - lon) * weight / total
+                rad = sqrt(
+                    rad * rad
+                    + (dist * dist + accuracy * accuracy - rad * rad)
+                    * weight
+                    / total
+                )
+                samples += 1
+            db.execute(
+                """insert or replace into aps (bssid, latitude, longitude,
+                       radius, weight, samples, updated)
+                   values (?, ?, ?, ?, ?, ?, ?)""",
+                (bssid, lat, lon, rad, total, samples, now),
+            )
+        db.commit()
+    return len(wifi_aps)
+
+
+def _wifi(
+    wifi_aps: List[Tuple[str, int]]
+) -> List[Tuple[float, float, float, float, int]]:
+    assert db is not None
+    signals = {mac.lower(): signal for mac, signal in wifi_aps}
+    with lock:
+        rows = db.execute(
+            f"""select bssid, latitude, longitude, radius, samples
+                from aps where bssid in ({",".join("?" * len(signals))})""",
+            tuple(signals),
+        ).fetchall()
+    return [
+        (lat, lon, rad, float(samples), signals[bssid])
+        for bssid, lat, lon, rad, samples in rows
+    ]
+
+
+def lookup(
+    mcc: int,
+    mnc: int,
+    gsm_cells: List[Tuple[int, int, int]],
+    wifi_aps: List[Tuple[str, int]],
+) -> Tuple[float, float, float]:
+    """
+    Weighted centroid of known access points, like that of the cells in
+    `opencellid`, combined with the result of the cells backend. Access
+    points too far from where the cells are (probably moved since we
+    have seen them) are not used. Estimates are combined weighting them
+    by the inverse square of their accuracy.
+    """
+    cellpos: Optional[Tuple[float, float, float]] = None
+    if cells is not None and gsm_cells:
+        try:
+            cellpos = cells.lookup(mcc, mnc, gsm_cells, wifi_aps)
+        except Exception as e:
+            log.debug("No position from cells: %s", e)
+    data = _wifi(wifi_aps) if wifi_aps else []
+    if cellpos is not None:
+        clat, clon, cacc = cellpos
+        data = [
+            ap
+            for ap in data
+            if _distance(clat, clon, ap[0], ap[1])
+            <= cacc + max(ap[2], MINACCURACY)
+        ]
+    if not data:
+        if cellpos is None:
+            raise ValueError("Neither access points nor cells are known")
+        return cellpos
+    wlat, wlon, wacc = centroid(data, MINACCURACY)
+    if cellpos is None:
+        return wlat, wlon, wacc
+    wwgt = 1.0 / (wacc * wacc)
+    cwgt = 1.0 / (cacc * cacc)
+    return (
+        (wlat * wwgt + clat * cwgt) / (wwgt + cwgt),
+        (wlon * wwgt + clon * cwgt) / (wwgt + cwgt),
+        1.0 / sqrt(wwgt + cwgt),
+    )
@@ -1,13 +1,26 @@
 """ Websocket Gateway """
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from configparser import ConfigParser
 from datetime import datetime, timezone
 from importlib import import_module
 from json import dumps, loads
 from logging import getLogger
 from socket import socket, AF_INET6, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+from sqlite3 import Connection
 from time import time
-from typing import Any, cast, Dict, List, Optional, Set, Tuple
+from typing import (
+    Any,
+    Callable,
+    cast,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 from wsproto import ConnectionType, WSConnection
 from wsproto.events import (
     AcceptConnection,
@@ -22,7 +35,8 @@ from wsproto.utilities import RemoteProtocolError
 import zmq
 
 from . import common
-from .evstore import initdb, fetch, fetchpmod
+from .common import Completions
+from .evstore import createdb, fetch, fetchlatest, fetchpmod, Readers
 from .protomodule import ProtoModule
 from .zmsg import Rept, Resp, rtopic
 
@@ -30,17 +44,61 @@ log = getLogger("loctrkd/wsgateway")
 
 htmlfile = None
 
+READERS: int = 4
+
 
-def backlog(imei: str, numback: int) -> List[Dict[str, Any]]:
+def backlog(
+    imei: str, numback: int, db: Optional[Connection] = None
+) -> List[Dict[str, Any]]:
     result = []
-    for report in fetch(imei, numback):
-        report["type"] = "location"
-        timestamp = report.pop("devtime")
-        report["timestamp"] = timestamp
-        result.append(report)
+    for report in (
+        fetchlatest([imei], db=db)
+        if numback == 1
+        else fetch(imei, numback, db=db)
+    ):
+        result.append(location(report))
     return result
 
 
+def fleet(db: Optional[Connection] = None) -> List[Dict[str, Any]]:
+    """Last known locations of all terminals"""
+    return [location(report) for report in fetchlatest(db=db)]
+
+
+def location(report: Dict[str, Any]) -> Dict[str, Any]:
+    """Location report in the form that the clients expect"""
+    report["type"] = "location"
+    report["timestamp"] = report.pop("devtime")
+    return report
+
+
+def _devepoch(report: Dict[str, Any]) -> Optional[float]:
+    """Like `devepoch` column in the database, None if not a valid time"""
+    try:
+        devtime = datetime.fromisoformat(str(report.get("timestamp")))
+    except ValueError:
+        return None
+    if devtime.tzinfo is None:
+        devtime = devtime.replace(tzinfo=timezone.utc)
+    return devtime.timestamp()
+
+
+def remember(
+    positions: Dict[str, Dict[str, Any]], report: Dict[str, Any]
+) -> None:
+    """
+    Keep `report` as the last known position of the terminal, unless
+    the one that is kept is newer, as the `latest` table does
+    """
+    kept = positions.get(report["imei"])
+    if kept is not None:
+        new = _devepoch(report)
+        old = _devepoch(kept)
+        if old is not None and (new is None or new < old):
+            return
+    positions[report["imei"]] = report
+
+
 def try_http(data: bytes, fd: int, e: Exception) -> bytes:
     global htmlfile
     try:
@@ -177,9 +235,13 @@ class Client:
         )
         return imei in self.imeis
 
-    def send(self, message: Dict[str, Any]) -> None:
+    def send(
+        self, message: Dict[str, Any], text: Optional[str] = None
+    ) -> None:
         if self.ready and message["imei"] in self.imeis:
-            self.ws_data += self.ws.send(Message(data=dumps(message)))
+            self.ws_data += self.ws.send(
+                Message(data=dumps(message) if text is None else text)
+            )
 
     def write(self) -> bool:
         if self.ws_data:
@@ -219,9 +281,12 @@ class Clients:
     def send(self, clnt: Optional[Client], msg: Dict[str, Any]) -> Set[int]:
         towrite = set()
         if clnt is None:
+            text = None  # Serialized once for all the clients
             for fd, cl in self.by_fd.items():
                 if cl.wants(msg["imei"]):
-                    cl.send(msg)
+                    if text is None:
+                        text = dumps(msg)
+                    cl.send(msg, text)
                     towrite.add(fd)
         else:
             fd = clnt.sock.fileno()
@@ -250,7 +315,104 @@ class Clients:
         return result
 
 
-def sendcmd(zpush: Any, wsmsg: Dict[str, Any]) -> Dict[str, Any]:
+class Lookups:
+    """
+    Database queries done in worker threads over read-only connections,
+    so that the event loop never waits for the database. Queries with
+    the same key are done one after another in the order of arrival.
+    """
+
+    def __init__(self, dbfn: str, workers: int) -> None:
+        self.readers = Readers(dbfn, workers)
+        self.executor = ThreadPoolExecutor(
+            workers, thread_name_prefix="reader"
+        )
+        self.completions: Completions[
+            Tuple[
+                Optional[str], Optional[Client], Dict[str, Any], "Future[Any]"
+            ]
+        ] = Completions()
+        # Queries waiting for the key, the first one is running
+        self.queues: Dict[
+            str,
+            Deque[
+                Tuple[
+                    Optional[Client],
+                    Dict[str, Any],
+                    Callable[..., Any],
+                    Tuple[Any, ...],
+                ]
+            ],
+        ] = {}
+
+    def fileno(self) -> int:
+        return self.completions.fileno()
+
+    def submit(
+        self,
+        clnt: Optional[Client],
+        wsmsg: Dict[str, Any],
+        func: Callable[..., Any],
+        *args: Any,
+        key: Optional[str] = None,
+    ) -> None:
+        """
+        Run `func(*args, db=<connection>)`, keep `clnt` and `wsmsg`.
+        Unless `key` is given, the query runs concurrently with others.
+        """
+        if key is None:
+            self._start(None, clnt, wsmsg, func, args)
+            return
+        queue = self.queues.setdefault(key, deque())
+        queue.append((clnt, wsmsg, func, args))
+        if len(queue) == 1:
+            self._start(key, clnt, wsmsg, func, args)
+
+    def _start(
+        self,
+        key: Optional[str],
+        clnt: Optional[Client],
+        wsmsg: Dict[str, Any],
+        func: Callable[..., Any],
+        args: Tuple[Any, ...],
+    ) -> None:
+        future = self.executor.submit(self._run, func, *args)
+        future.add_done_callback(
+            lambda future: self.completions.put((key, clnt, wsmsg, future))
+        )
+
+    def _run(self, func: Callable[..., Any], *args: Any) -> Any:
+        with self.readers.connection() as db:
+            return func(*args, db=db)
+
+    def completed(
+        self,
+    ) -> List[Tuple[Optional[Client], Dict[str, Any], Any]]:
+        """Called from the event loop, return results of finished queries"""
+        result = []
+        for key, clnt, wsmsg, future in self.completions.take():
+            if key is not None:
+                queue = self.queues[key]
+                queue.popleft()
+                if queue:
+                    self._start(key, *queue[0])
+                else:
+                    del self.queues[key]
+            try:
+                result.append((clnt, wsmsg, future.result()))
+            except Exception as e:
+                log.error("Lookup for %s failed: %s", wsmsg, e)
+        return result
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self.readers.close()
+        self.completions.close()
+
+
+def sendcmd(
+    zpush: Any, wsmsg: Dict[str, Any], pmod: Optional[str]
+) -> Dict[str, Any]:
     imei = wsmsg.pop("imei", None)
     cmd = wsmsg.pop("type", None)
     if imei is None or cmd is None:
@@ -260,7 +422,6 @@ def sendcmd(zpush: Any, wsmsg: Dict[str, Any]) -> Dict[str, Any]:
             "imei": imei,
             "result": "Did not get imei or cmd",
         }
-    pmod = fetchpmod(imei)
     if pmod is None:
         log.info("Uknown type of recipient for %s %s %s", cmd, imei, wsmsg)
         return {
@@ -288,7 +449,13 @@ def sendcmd(zpush: Any, wsmsg: Dict[str, Any]) -> Dict[str, Any]:
 
 def runserver(conf: ConfigParser) -> None:
     global htmlfile
-    initdb(conf.get("storage", "dbfn"))
+    # Read-only connections cannot open the database if the storage
+    # daemon has not created it yet
+    createdb(conf.get("storage", "dbfn"))
+    lookups = Lookups(
+        conf.get("storage", "dbfn"),
+        conf.getint("wsgateway", "readers", fallback=READERS),
+    )
     htmlfile = conf.get("wsgateway", "htmlfile", fallback=None)
     # Is this https://github.com/zeromq/pyzmq/issues/1627 still not fixed?!
     zctx = zmq.Context()  # type: ignore
@@ -305,8 +472,12 @@ def runserver(conf: ConfigParser) -> None:
     poller = zmq.Poller()  # type: ignore
     poller.register(zsub, flags=zmq.POLLIN)
     poller.register(tcpfd, flags=zmq.POLLIN)
+    poller.register(lookups.fileno(), flags=zmq.POLLIN)
     clients = Clients()
     activesubs: Set[str] = set()
+    # Last known positions of the terminals that we are subscribed to,
+    # kept up to date by the reports that come for them.
+    positions: Dict[str, Dict[str, Any]] = {}
     try:
         towait: Set[int] = set()
         while True:
@@ -315,6 +486,7 @@ def runserver(conf: ConfigParser) -> None:
                 zsub.setsockopt(zmq.SUBSCRIBE, rtopic(imei))
             for imei in activesubs - neededsubs:
                 zsub.setsockopt(zmq.UNSUBSCRIBE, rtopic(imei))
+                positions.pop(imei, None)
             activesubs = neededsubs
             log.debug("Subscribed to: %s", activesubs)
             tosend: List[Tuple[Optional[Client], Dict[str, Any]]] = []
@@ -327,15 +499,28 @@ def runserver(conf: ConfigParser) -> None:
                     while True:
                         try:
                             zmsg = Rept(zsub.recv(zmq.NOBLOCK))
-                            msg = loads(zmsg.payload)
+                            msg = zmsg.report
                             msg["imei"] = zmsg.imei
                             log.debug("Got %s, sending %s", zmsg, msg)
+                            if msg.get("type", None) == "location":
+                                remember(positions, location(dict(msg)))
                             tosend.append((None, msg))
                         except zmq.Again:
                             break
                 elif sk == tcpfd:
                     clntsock, clntaddr = tcpl.accept()
                     topoll.append((clntsock, clntaddr))
+                elif sk == lookups.fileno():
+                    for clnt, wsmsg, result in lookups.completed():
+                        if wsmsg.get("type", None) in ("subscribe", "fleet"):
+                            tosend.extend([(clnt, msg) for msg in result])
+                            for report in result:
+                                if report["imei"] in activesubs:
+                                    remember(positions, report)
+                        else:
+                            tosend.append(
+                                (clnt, sendcmd(zpush, wsmsg, result))
+                            )
                 elif fl & zmq.POLLIN:
                     clnt, received = clients.recv(sk)
                     if received is None:
@@ -350,14 +535,28 @@ def runserver(conf: ConfigParser) -> None:
                                 imeis = cast(List[str], wsmsg.get("imei"))
                                 numback: int = wsmsg.get("backlog", 5)
                                 for imei in imeis:
-                                    tosend.extend(
-                                        [
-                                            (clnt, msg)
-                                            for msg in backlog(imei, numback)
-                                        ]
-                                    )
+                                    if numback == 1 and imei in positions:
+                                        tosend.append((clnt, positions[imei]))
+                                    else:
+                                        lookups.submit(
+                                            clnt,
+                                            wsmsg,
+                                            backlog,
+                                            imei,
+                                            numback,
+                                        )
+                            elif wsmsg.get("type", None) == "fleet":
+                                lookups.submit(clnt, wsmsg, fleet)
                             else:
-                                tosend.append((clnt, sendcmd(zpush, wsmsg)))
+                                # Commands to a terminal go out in order
+                                imei = wsmsg.get("imei", None)
+                                lookups.submit(
+                                    clnt,
+                                    wsmsg,
+                                    fetchpmod,
+                                    imei,
+                                    key=imei,
+                                )
                         towrite.add(sk)
                 elif fl & zmq.POLLOUT:
                     log.debug("Write now open for fd %d", sk)
@@ -391,6 +590,7 @@ def runserver(conf: ConfigParser) -> None:
             towait &= trywrite
             towait |= morewait
     except KeyboardInterrupt:
+        lookups.close()
         zsub.close()
         zctx.destroy()  # type: ignore
         tcpl.close()
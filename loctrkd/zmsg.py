@@ -1,12 +1,44 @@
 """ Zeromq messages """
 
+from functools import lru_cache
 import ipaddress as ip
-from struct import pack, unpack
-from typing import Any, cast, Optional, Tuple, Type, Union
-
-__all__ = "Bcast", "Resp", "topic", "rtopic"
-
-
+from json import dumps, loads
+from struct import pack, Struct
+from typing import Any, Callable, cast, Dict, Optional, Tuple, Type, Union
+
+__all__ = "Bcast", "Rept", "Resp", "pack_report", "topic", "rtopic"
+
+# Peer address of a terminal does not change during the connection,
+# so there are (much) fewer distinct addresses than messages.
+PEERCACHE: int = 16384
+
+_BCAST = Struct("!B16s16sd16s")
+_RESP = Struct("!16sd")
+_REPT = Struct("16s")
+_PORT = Struct("!H")
+
+# Binary report: marker (JSON text never starts with it), type, bitmaps
+# of fields that are present and not null, the fixed fields, then
+# devtime and the extension map of all other keys.
+_REPORTMARK = 1
+_REPORT = Struct("!BBBB6dh")
+_REPORTFLOATS = (
+    "latitude",
+    "longitude",
+    "accuracy",
+    "altitude",
+    "speed",
+    "direction",
+)
+_REPORTTYPES = ("", "location", "status", "approximate_location")
+_LEN = Struct("!H")
+_INT = Struct("!q")
+_FLOAT = Struct("!d")
+# Tags of extension map values
+_TAGNONE, _TAGINT, _TAGFLOAT, _TAGSTR, _TAGJSON = range(5)
+
+
+@lru_cache(maxsize=PEERCACHE)
 def pack_peer(  # 18 bytes
     peeraddr: Union[None, Tuple[str, int], Tuple[str, int, Any, Any]]
 ) -> bytes:
@@ -23,14 +55,15 @@ def pack_peer(  # 18 bytes
         addr = ip.ip_address(saddr)
     if isinstance(addr, ip.IPv4Address):
         addr = ip.IPv6Address(b"\0\0\0\0\0\0\0\0\0\0\xff\xff" + addr.packed)
-    return addr.packed + pack("!H", port)
+    return addr.packed + _PORT.pack(port)
 
 
+@lru_cache(maxsize=PEERCACHE)
 def unpack_peer(
     buffer: bytes,
 ) -> Tuple[str, int]:
     a6 = ip.IPv6Address(buffer[:16])
-    port = unpack("!H", buffer[16:])[0]
+    (port,) = _PORT.unpack_from(buffer, 16)
     a4 = a6.ipv4_mapped
     if a4 is not None:
         return (str(a4), port)
@@ -39,6 +72,145 @@ def unpack_peer(
     return (str(a6), port)
 
 
+def pack_report(report: Dict[str, Any]) -> bytes:
+    """
+    Encode report dict in binary form. Location fields, battery
+    percentage, devtime and type are in fixed places, other keys and
+    values that do not fit the fixed fields go to the extension map.
+    """
+    ext = dict(report)
+    rtype = ext.pop("type", None)
+    if rtype in _REPORTTYPES[1:]:
+        tcode = _REPORTTYPES.index(rtype)
+    else:
+        tcode = 0
+        if "type" in report:
+            ext["type"] = rtype
+    present = notnull = 0
+    values = []
+    for bit, key in enumerate(_REPORTFLOATS):
+        value = ext.get(key, 0.0)
+        if value is None:
+            del ext[key]
+            present |= 1 << bit
+            value = 0.0
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            if key in ext:
+                del ext[key]
+                present |= 1 << bit
+                notnull |= 1 << bit
+        else:
+            value = 0.0  # Goes to the extension map
+        values.append(value)
+    battery = ext.get("battery_percentage", 0)
+    if battery is None:
+        del ext["battery_percentage"]
+        present |= 0x40
+        battery = 0
+    elif isinstance(battery, int) and -32768 <= battery < 32768:
+        if "battery_percentage" in ext:
+            del ext["battery_percentage"]
+            present |= 0x40
+            notnull |= 0x40
+    else:
+        battery = 0
+    devtime = ext.get("devtime", "")
+    if devtime is None:
+        del ext["devtime"]
+        present |= 0x80
+        devtime = ""
+    elif isinstance(devtime, str):
+        if "devtime" in ext:
+            del ext["devtime"]
+            present |= 0x80
+            notnull |= 0x80
+    else:
+        devtime = ""
+    bdevtime = devtime.encode()
+    parts = [
+        _REPORT.pack(_REPORTMARK, tcode, present, notnull, *values, battery),
+        _LEN.pack(len(bdevtime)),
+        bdevtime,
+        _LEN.pack(len(ext)),
+    ]
+    for key, value in ext.items():
+        bkey = key.encode()
+        parts.append(_LEN.pack(len(bkey)) + bkey)
+        if value is None:
+            parts.append(bytes((_TAGNONE,)))
+        elif (
+            isinstance(value, int)
+            and not isinstance(value, bool)
+            and -(1 << 63) <= value < (1 << 63)
+        ):
+            parts.append(bytes((_TAGINT,)) + _INT.pack(value))
+        elif isinstance(value, float):
+            parts.append(bytes((_TAGFLOAT,)) + _FLOAT.pack(value))
+        else:
+            bvalue = (
+                value if isinstance(value, str) else dumps(value)
+            ).encode()
+            parts.append(
+                bytes((_TAGSTR if isinstance(value, str) else _TAGJSON,))
+                + _LEN.pack(len(bvalue))
+                + bvalue
+            )
+    return b"".join(parts)
+
+
+def unpack_report(buffer: bytes) -> Dict[str, Any]:
+    (
+        _,
+        tcode,
+        present,
+        notnull,
+        *values,
+        battery,
+    ) = _REPORT.unpack_from(buffer)
+    report: Dict[str, Any] = {}
+    if tcode:
+        report["type"] = _REPORTTYPES[tcode]
+    for bit, key in enumerate(_REPORTFLOATS):
+        if present & (1 << bit):
+            report[key] = values[bit] if notnull & (1 << bit) else None
+    if present & 0x40:
+        report["battery_percentage"] = battery if notnull & 0x40 else None
+    offset = _REPORT.size
+    (length,) = _LEN.unpack_from(buffer, offset)
+    offset += _LEN.size
+    if present & 0x80:
+        report["devtime"] = (
+            buffer[offset : offset + length].decode()
+            if notnull & 0x80
+            else None
+        )
+    offset += length
+    (count,) = _LEN.unpack_from(buffer, offset)
+    offset += _LEN.size
+    for _ in range(count):
+        (length,) = _LEN.unpack_from(buffer, offset)
+        offset += _LEN.size
+        key = buffer[offset : offset + length].decode()
+        offset += length
+        tag = buffer[offset]
+        offset += 1
+        if tag == _TAGNONE:
+            report[key] = None
+        elif tag == _TAGINT:
+            (report[key],) = _INT.unpack_from(buffer, offset)
+            offset += _INT.size
+        elif tag == _TAGFLOAT:
+            (report[key],) = _FLOAT.unpack_from(buffer, offset)
+            offset += _FLOAT.size
+        else:
+            (length,) = _LEN.unpack_from(buffer, offset)
+            offset += _LEN.size
+            value = buffer[offset : offset + length].decode()
+            offset += length
+            report[key] = value if tag == _TAGSTR else loads(value)
+    return report
+
+
 class _Zmsg:
     KWARGS: Tuple[Tuple[str, Any], ...]
 
@@ -104,6 +276,57 @@ def rtopic(imei: str) -> bytes:
     return pack("16s", imei.encode())
 
 
+class _LazyField:
+    """
+    Non-data descriptor that decodes a group of fields from the received
+    buffer on first access to any of them. Decoded values are set as
+    instance attributes, that shadow the descriptors from then on.
+    Fields that were assigned before the group is decoded keep the
+    assigned values.
+    """
+
+    def __init__(self, decoder: Callable[[Any, bytes], None]) -> None:
+        self.decoder = decoder
+
+    def __set_name__(self, owner: Type[_Zmsg], name: str) -> None:
+        self.name = name
+
+    def __get__(self, obj: Any, objtype: Any = None) -> Any:
+        if obj is None:
+            return self
+        self.decoder(obj, obj._buffer)
+        return getattr(obj, self.name)
+
+
+def _bcast_header(obj: Any, buffer: bytes) -> None:
+    is_incoming, proto, imei, when, pmod = _BCAST.unpack_from(buffer)
+    assigned = obj.__dict__
+    # Fields of the group that were assigned before are not overwritten
+    for name, value in (
+        ("is_incoming", bool(is_incoming)),
+        ("proto", proto.decode().rstrip("\0")),
+        (
+            "imei",
+            None if imei == b"0000000000000000" else imei.decode().strip("\0"),
+        ),
+        ("when", when),
+        (
+            "pmod",
+            None if pmod == b"                " else pmod.decode().strip("\0"),
+        ),
+    ):
+        if name not in assigned:
+            setattr(obj, name, value)
+
+
+def _bcast_peeraddr(obj: Any, buffer: bytes) -> None:
+    obj.peeraddr = unpack_peer(bytes(buffer[57:75]))
+
+
+def _bcast_packet(obj: Any, buffer: bytes) -> None:
+    obj.packet = buffer[75:]
+
+
 class Bcast(_Zmsg):
     """Zmq message to broadcast what was received from the terminal"""
 
@@ -120,8 +343,7 @@ class Bcast(_Zmsg):
     @property
     def packed(self) -> bytes:
         return (
-            pack(
-                "!B16s16sd16s",
+            _BCAST.pack(
                 int(self.is_incoming),
                 self.proto[:16].ljust(16, "\0").encode(),
                 b"0000000000000000"
@@ -133,24 +355,23 @@ class Bcast(_Zmsg):
                 else self.pmod.encode(),
             )
             + pack_peer(self.peeraddr)
-            + self.packet
+            + cast(bytes, self.packet)
         )
 
+    # Fixed header fields are decoded together by one `unpack_from()`,
+    # a descriptor call per field would cost more than it saves.
+    is_incoming = _LazyField(_bcast_header)
+    proto = _LazyField(_bcast_header)
+    imei = _LazyField(_bcast_header)
+    when = _LazyField(_bcast_header)
+    pmod = _LazyField(_bcast_header)
+    peeraddr = _LazyField(_bcast_peeraddr)
+    packet = _LazyField(_bcast_packet)
+
     def decode(self, buffer: bytes) -> None:
-        is_incoming, proto, imei, when, pmod = unpack(
-            "!B16s16sd16s", buffer[:57]
-        )
-        self.is_incoming = bool(is_incoming)
-        self.proto = proto.decode().rstrip("\0")
-        self.imei = (
-            None if imei == b"0000000000000000" else imei.decode().strip("\0")
-        )
-        self.when = when
-        self.pmod = (
-            None if pmod == b"                " else pmod.decode().strip("\0")
-        )
-        self.peeraddr = unpack_peer(buffer[57:75])
-        self.packet = buffer[75:]
+        # Fields are decoded on first access, see `_LazyField`. Instances
+        # made from keyword arguments have them all set and no `_buffer`.
+        self._buffer = buffer
 
 
 class Resp(_Zmsg):
@@ -161,8 +382,7 @@ class Resp(_Zmsg):
     @property
     def packed(self) -> bytes:
         return (
-            pack(
-                "!16sd",
+            _RESP.pack(
                 "0000000000000000"
                 if self.imei is None
                 else self.imei.encode(),
@@ -172,7 +392,7 @@ class Resp(_Zmsg):
         )
 
     def decode(self, buffer: bytes) -> None:
-        imei, when = unpack("!16sd", buffer[:24])
+        imei, when = _RESP.unpack_from(buffer)
         self.imei = (
             None if imei == b"0000000000000000" else imei.decode().strip("\0")
         )
@@ -182,20 +402,22 @@ class Resp(_Zmsg):
 
 
 class Rept(_Zmsg):
-    """Broadcast zmq message with "rectified" proto-agnostic json data"""
+    """
+    Broadcast zmq message with "rectified" proto-agnostic data, `payload`
+    is either json text, or bytes made by `pack_report()`
+    """
 
     KWARGS = (("imei", None), ("payload", ""))
+    payload: Union[str, bytes]
 
     @property
     def packed(self) -> bytes:
-        return (
-            pack(
-                "16s",
-                b"0000000000000000"
-                if self.imei is None
-                else self.imei.encode(),
-            )
-            + self.payload.encode()
+        return _REPT.pack(
+            b"0000000000000000" if self.imei is None else self.imei.encode(),
+        ) + (
+            self.payload
+            if isinstance(self.payload, bytes)
+            else self.payload.encode()
         )
 
     def decode(self, buffer: bytes) -> None:
@@ -203,4 +425,14 @@ class Rept(_Zmsg):
         self.imei = (
             None if imei == b"0000000000000000" else imei.decode().strip("\0")
         )
-        self.payload = buffer[16:].decode()
+        if len(buffer) > 16 and buffer[16] == _REPORTMARK:
+            self.payload = buffer[16:]
+        else:
+            self.payload = buffer[16:].decode()
+
+    @property
+    def report(self) -> Dict[str, Any]:
+        """Decoded payload in either form"""
+        if isinstance(self.payload, bytes):
+            return unpack_report(self.payload)
+        return cast(Dict[str, Any], loads(self.payload))
@@ -59,6 +59,7 @@ MAXBUFFER: int = 4096
 class Stream:
     def __init__(self) -> None:
         self.buffer = b""
+        self.offset = 0  # Start of not yet consumed data in the buffer
 
     def recv(self, segment: bytes) -> List[Union[bytes, str]]:
         """
@@ -66,51 +67,55 @@ class Stream:
         packets as `bytes` and error messages as `str`.
         """
         when = time()
-        self.buffer += segment
-        if len(self.buffer) > MAXBUFFER:
+        # Drop consumed data once per segment rather than once per frame
+        buffer = self.buffer[self.offset :] + segment
+        if len(buffer) > MAXBUFFER:
             # We are receiving junk. Let's drop it or we run out of memory.
             self.buffer = b""
+            self.offset = 0
             return [f"More than {MAXBUFFER} unparseable data, dropping"]
+        self.buffer = buffer
         msgs: List[Union[bytes, str]] = []
+        start = 0
         while True:
-            framestart = self.buffer.find(b"xx")
+            framestart = buffer.find(b"xx", start)
             if framestart == -1:  # No frames, return whatever we have
                 break
-            if framestart > 0:  # Should not happen, report
+            if framestart > start:  # Should not happen, report
                 msgs.append(
-                    f'Undecodable data ({framestart}) "{self.buffer[:framestart][:64].hex()}"'
+                    f"Undecodable data ({framestart - start})"
+                    f' "{buffer[start:framestart][:64].hex()}"'
                 )
-                self.buffer = self.buffer[framestart:]
+                start = framestart
             # At this point, buffer starts with a packet
-            if len(self.buffer) < 6:  # no len and proto - cannot proceed
+            if len(buffer) - start < 6:  # no len and proto - cannot proceed
                 break
-            exp_end = self.buffer[2] + 3  # Expect '\r\n' here
-            frameend = 0
+            exp_end = start + buffer[start + 2] + 3  # Expect '\r\n' here
             # Length field can legitimeely be much less than the
             # length of the packet (e.g. WiFi positioning), but
             # it _should not_ be greater. Still sometimes it is.
             # Luckily, not by too much: by maybe two or three bytes?
             # Do this embarrassing hack to avoid accidental match
-            # of some binary data in the packet against '\r\n'.
-            while True:
-                frameend = self.buffer.find(b"\r\n", frameend + 1)
-                if frameend == -1 or frameend >= (
-                    exp_end - 3
-                ):  # Found realistic match or none
-                    break
+            # of some binary data in the packet against '\r\n':
+            # skip the matches before the realistic position.
+            frameend = buffer.find(
+                b"\r\n", exp_end - 3 if exp_end > start + 4 else start + 1
+            )
             if frameend == -1:  # Incomplete frame, return what we have
                 break
-            packet = self.buffer[2:frameend]
-            self.buffer = self.buffer[frameend + 2 :]
+            packet = buffer[start + 2 : frameend]
+            start = frameend + 2
             if len(packet) < 2:  # frameend comes too early
                 msgs.append(f"Packet too short: {packet.hex()}")
             else:
                 msgs.append(packet)
+        self.offset = start
         return msgs
 
     def close(self) -> bytes:
-        ret = self.buffer
+        ret = self.buffer[self.offset :]
         self.buffer = b""
+        self.offset = 0
         return ret
 
 
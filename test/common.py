@@ -24,7 +24,7 @@ from sys import exit, stderr
 from random import Random
 from tempfile import mkstemp
 from time import sleep
-from typing import Any, Optional
+from typing import Any, Dict, Optional
 from unittest import TestCase
 
 from loctrkd.common import init_protocols
@@ -34,7 +34,11 @@ NUMPORTS = 3
 
 class TestWithServers(TestCase):
     def setUp(
-        self, *args: str, httpd: bool = False, verbose: bool = False
+        self,
+        *args: str,
+        httpd: bool = False,
+        verbose: bool = False,
+        extraconf: Optional[Dict[str, Dict[str, str]]] = None,
     ) -> None:
         freeports = []
         with ExitStack() as stack:
@@ -68,6 +72,8 @@ class TestWithServers(TestCase):
         self.conf["wsgateway"] = {
             "port": str(freeports[1]),
         }
+        for section, options in (extraconf or {}).items():
+            self.conf[section].update(options)
         init_protocols(self.conf)
         self.children = []
         for srvname in args:
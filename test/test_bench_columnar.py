@@ -0,0 +1,82 @@
+""" Measure location history queries on the columnar export """
+
+from datetime import datetime, timezone
+from os import close, unlink
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp
+from time import perf_counter
+from typing import Any, Dict
+import unittest
+from loctrkd import columnar, evstore
+
+try:
+    from loctrkd import colquery
+except ImportError:
+    colquery = None  # type: ignore
+
+REPORTS: int = 100000
+TERMINALS: int = 10
+
+
+@unittest.skipIf(colquery is None, "numpy is not installed")
+class BenchColumnar(unittest.TestCase):
+    def setUp(self) -> None:
+        fd, self.dbname = mkstemp(suffix=".sqlite")
+        close(fd)
+        unlink(self.dbname)
+        self.directory = mkdtemp()
+        evstore.initdb(self.dbname, commitrows=10000)
+
+    def tearDown(self) -> None:
+        assert evstore.DB is not None
+        evstore.DB.close()
+        unlink(self.dbname)
+        rmtree(self.directory)
+
+    def _stow(self, first: int, last: int) -> None:
+        for num in range(first, last):
+            report: Dict[str, Any] = {
+                "imei": f"{9999000000000000 + num % TERMINALS:016d}",
+                "devtime": str(
+                    datetime.fromtimestamp(1.6e9 + num * 10, timezone.utc)
+                ),
+                "accuracy": 10.0,
+                "latitude": 53.5 + num * 1e-5,
+                "longitude": 12.7,
+                "battery_percentage": num % 100,
+            }
+            evstore.stowloc(**report)
+        evstore.flush()
+
+    def test_columnar(self) -> None:
+        assert evstore.DB is not None
+        imei = f"{9999000000000000:016d}"
+        self._stow(0, REPORTS)
+        start = perf_counter()
+        columnar.export(evstore.DB, self.directory)
+        full = perf_counter() - start
+        # Out of order report goes to the tail, history is not rewritten
+        self._stow(0, 1)
+        start = perf_counter()
+        columnar.export(evstore.DB, self.directory)
+        late = perf_counter() - start
+        self.assertLess(late * 10, full)
+
+        start = perf_counter()
+        evstore.DB.execute(
+            """select latitude, longitude from reports where imei = ?
+               and devepoch >= ? and devepoch < ? order by devepoch""",
+            (imei, 1.6e9, 1.6e9 + REPORTS * 5 - 5),
+        ).fetchall()
+        sqlite = perf_counter() - start
+        start = perf_counter()
+        track = colquery.track(
+            self.directory, imei, 1.6e9, 1.6e9 + REPORTS * 5 - 5
+        )
+        colquery.distance(track["latitude"], track["longitude"])
+        numpy = perf_counter() - start
+        self.assertLess(numpy, sqlite)
+
+
+if __name__ == "__main__":
+    unittest.main()
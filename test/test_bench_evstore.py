@@ -0,0 +1,117 @@
+""" Measure event storage speed """
+
+from datetime import datetime, timezone
+from os import close, unlink
+from sqlite3 import connect
+from tempfile import mkstemp
+from time import perf_counter, time
+from typing import Any, Dict
+import unittest
+from loctrkd import evstore
+
+ROWS: int = 1000
+REPORTS: int = 200000
+TERMINALS: int = 1000
+BACKLOG: int = 100
+
+
+class BenchEvstore(unittest.TestCase):
+    def setUp(self) -> None:
+        fd, self.dbname = mkstemp(suffix=".sqlite")
+        close(fd)
+        unlink(self.dbname)
+
+    def tearDown(self) -> None:
+        evstore.flush()
+        assert evstore.DB is not None
+        evstore.DB.close()
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                unlink(self.dbname + suffix)
+            except FileNotFoundError:
+                pass
+
+    def _stow(self, **kwargs: Any) -> float:
+        evstore.initdb(self.dbname, **kwargs)
+        start = perf_counter()
+        for num in range(ROWS):
+            evstore.stow(
+                peeraddr="('192.0.2.1', 4303)",
+                when=time(),
+                imei="9999123456780000",
+                proto="ZX:STATUS",
+                packet=num.to_bytes(4, "big"),
+            )
+        evstore.flush()
+        return perf_counter() - start
+
+    def test_commit(self) -> None:
+        single = self._stow()
+        grouped = self._stow(wal=True, synchronous="normal", commitrows=100)
+        self.assertLess(grouped, single)
+
+    def test_backlog(self) -> None:
+        # Database in the old format: no devepoch column, no indexes
+        with connect(self.dbname) as db:
+            db.execute(
+                """create table reports (
+                imei text,
+                devtime text not null,
+                accuracy real,
+                latitude real,
+                longitude real,
+                remainder text
+            )"""
+            )
+            db.executemany(
+                """insert into reports
+                   (imei, devtime, accuracy, latitude, longitude, remainder)
+                   values (?, ?, 10.0, 53.5, 12.7, '{}')""",
+                (
+                    (
+                        f"{9999000000000000 + num % TERMINALS:016d}",
+                        str(datetime.fromtimestamp(1.6e9 + num, timezone.utc)),
+                    )
+                    for num in range(REPORTS)
+                ),
+            )
+            start = perf_counter()
+            for num in range(10):
+                db.execute(
+                    """select * from reports where imei = ?
+                       order by devtime desc limit ?""",
+                    (f"{9999000000000000 + num:016d}", BACKLOG),
+                ).fetchall()
+            before = perf_counter() - start
+        evstore.initdb(self.dbname)
+        start = perf_counter()
+        for num in range(10):
+            evstore.fetch(f"{9999000000000000 + num:016d}", BACKLOG)
+        after = perf_counter() - start
+        self.assertLess(after, before)
+
+    def test_latest(self) -> None:
+        evstore.initdb(self.dbname, commitrows=10000)
+        for num in range(REPORTS):
+            report: Dict[str, Any] = {
+                "imei": f"{9999000000000000 + num % TERMINALS:016d}",
+                "devtime": str(
+                    datetime.fromtimestamp(1.6e9 + num, timezone.utc)
+                ),
+                "latitude": 53.5,
+                "longitude": 12.7 + num * 1e-6,
+            }
+            evstore.stowloc(**report)
+        evstore.flush()
+        start = perf_counter()
+        for num in range(TERMINALS):
+            evstore.fetch(f"{9999000000000000 + num:016d}", 1)
+        history = perf_counter() - start
+        start = perf_counter()
+        evstore.fetchlatest()
+        latest = perf_counter() - start
+        self.assertLess(latest, history)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+""" Measure opencellid lookups, sql and in memory """
+
+from configparser import ConfigParser
+import csv
+import gzip
+from os import close, path, unlink
+from sqlite3 import connect
+from tempfile import mkstemp
+from time import perf_counter
+from typing import List, Tuple
+import unittest
+from loctrkd import opencellid
+from loctrkd.ocid_dload import DBINDEX, SCHEMA
+
+REPEAT: int = 20000
+
+
+class BenchOpencellid(unittest.TestCase):
+    def setUp(self) -> None:
+        fd, self.dbname = mkstemp(suffix=".sqlite")
+        close(fd)
+        self.observed: List[Tuple[int, int, List[Tuple[int, int, int]]]] = []
+        with gzip.open(
+            path.join(path.dirname(__file__), "262.csv.gz"), "rt"
+        ) as fl, connect(self.dbname) as db:
+            db.execute(SCHEMA)
+            for row in csv.reader(fl):
+                db.execute(
+                    """insert into cells
+                       values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    row,
+                )
+            db.execute(DBINDEX)
+            cells = db.execute(
+                """select mcc, net, area, cell from cells
+                   where typeof(mcc) = 'integer'"""
+            ).fetchall()
+        # Terminals report up to 5 cells of one network, one is unknown
+        for num in range(0, len(cells) - 5, 3):
+            mcc, net, _, _ = cells[num]
+            self.observed.append(
+                (
+                    mcc,
+                    net,
+                    [
+                        (area, cell, -60 - i)
+                        for i, (_, cnet, area, cell) in enumerate(
+                            cells[num : num + 4]
+                        )
+                        if cnet == net
+                    ]
+                    + [(1, 1, -90)],
+                )
+            )
+        self.conf = ConfigParser()
+        self.conf.read_dict(
+            {"opencellid": {"dbfn": self.dbname, "downloadmcc": "262"}}
+        )
+
+    def tearDown(self) -> None:
+        unlink(self.dbname)
+
+    def _lookups(self) -> float:
+        start = perf_counter()
+        for num in range(REPEAT):
+            mcc, net, gsm_cells = self.observed[num % len(self.observed)]
+            opencellid.lookup(mcc, net, gsm_cells, [])
+        return perf_counter() - start
+
+    def test_lookup(self) -> None:
+        opencellid.init(self.conf)
+        sqltime = self._lookups()
+        opencellid.shut()
+        self.conf.set("opencellid", "inmemory", "yes")
+        opencellid.init(self.conf)
+        memtime = self._lookups()
+        opencellid.shut()
+        opencellid.cells = None
+        self.assertLess(memtime, sqltime)
+
+
+if __name__ == "__main__":
+    unittest.main()
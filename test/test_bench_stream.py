@@ -0,0 +1,56 @@
+""" Measure deframing speed """
+
+from time import perf_counter
+from typing import List, Union
+import unittest
+from loctrkd import beesure, zx303proto
+from loctrkd.zx303proto import WIFI_OFFLINE_POSITIONING
+
+SEGMENTS: int = 20000
+REPEAT: int = 50
+
+
+class BenchStream(unittest.TestCase):
+    def _run(
+        self,
+        stream: Union[beesure.Stream, zx303proto.Stream],
+        segments: List[bytes],
+    ) -> float:
+        start = perf_counter()
+        for segment in segments:
+            stream.recv(segment)
+        return perf_counter() - start
+
+    def test_zx303_frames(self) -> None:
+        frame = zx303proto.enframe(
+            WIFI_OFFLINE_POSITIONING.In(
+                mnc=3,
+                mcc=262,
+                wifi_aps=[("02:03:04:05:06:07", -89)],
+                gsm_cells=[(24420, 27178, -90), (24420, 36243, -78)],
+            ).packed
+        )
+        single = self._run(zx303proto.Stream(), [frame] * SEGMENTS)
+        batched = self._run(
+            zx303proto.Stream(), [frame * 100] * (SEGMENTS // 100)
+        )
+        # Many frames in one segment are not copied over and over
+        self.assertLess(batched, single)
+
+    def test_beesure_junk(self) -> None:
+        def scan(junklen: int) -> float:
+            data = bytes(junklen) + b"[SG*1234567890*0002*LK]"
+            segments = [
+                data[pos : pos + 1460] for pos in range(0, len(data), 1460)
+            ]
+            return sum(
+                self._run(beesure.Stream(), segments) for _ in range(REPEAT)
+            )
+
+        # Search for the header does not rescan what was already seen,
+        # so four times the junk takes about four times as long
+        self.assertLess(scan(0xC000), 8 * scan(0x3000))
+
+
+if __name__ == "__main__":
+    unittest.main()
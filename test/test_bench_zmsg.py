@@ -0,0 +1,68 @@
+""" Measure zmq message encoding and decoding speed """
+
+from json import dumps
+from time import perf_counter, time
+import unittest
+from loctrkd.common import CoordReport
+from loctrkd.zmsg import Bcast, Rept
+
+REPEAT: int = 100000
+
+
+class BenchZmsg(unittest.TestCase):
+    def test_bcast(self) -> None:
+        packed = Bcast(
+            proto="ZX:STATUS",
+            pmod="zx303proto",
+            imei="9999123456780000",
+            when=time(),
+            peeraddr=("::ffff:192.0.2.1", 4303, 0, 0),
+            packet=bytes(range(40)),
+        ).packed
+        start = perf_counter()
+        for _ in range(REPEAT):
+            decoded = Bcast(packed)
+            decoded.imei, decoded.pmod
+        header = perf_counter() - start
+        start = perf_counter()
+        for _ in range(REPEAT):
+            decoded = Bcast(packed)
+            for k, _ in Bcast.KWARGS:
+                getattr(decoded, k)
+        full = perf_counter() - start
+        # Consumers that only look at the header do not pay for the rest
+        self.assertLess(header, full)
+
+    def test_rept(self) -> None:
+        payload = CoordReport(
+            devtime="2023-01-31 12:34:56+00:00",
+            battery_percentage=77,
+            accuracy=150.0,
+            altitude=None,
+            speed=None,
+            direction=None,
+            latitude=53.512345,
+            longitude=12.712345,
+        )
+        elapsed = {}
+        for form in ("json", "binary"):
+            start = perf_counter()
+            for _ in range(REPEAT // 10):
+                # rectifier
+                packed = Rept(
+                    imei="9999123456780000", payload=getattr(payload, form)
+                ).packed
+                # storage
+                Rept(packed).report
+                # wsgateway
+                rept = Rept(packed)
+                msg = rept.report
+                msg["imei"] = rept.imei
+                dumps(msg)
+            elapsed[form] = perf_counter() - start
+        # Leave a margin for the noise of a shared machine
+        self.assertLess(elapsed["binary"], elapsed["json"] * 1.2)
+
+
+if __name__ == "__main__":
+    unittest.main()
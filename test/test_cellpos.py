@@ -0,0 +1,160 @@
+""" Cell based position estimate on synthetic cell layouts """
+
+from configparser import ConfigParser
+import csv
+import gzip
+from os import close, path, unlink
+from sqlite3 import connect
+from tempfile import mkstemp
+from typing import List, Tuple
+import unittest
+from loctrkd.ocid_dload import DBINDEX, SCHEMA
+from loctrkd.opencellid import Cell, CellIndex, centroid
+from loctrkd import opencellid
+
+# Cells around a point in Berlin, about 1 km apart
+LAT: float = 52.52
+LON: float = 13.405
+STEP: float = 0.009
+
+
+class Centroid(unittest.TestCase):
+    def test_single(self) -> None:
+        lat, lon, acc = centroid([(LAT, LON, 2000.0, 10.0, -70)])
+        self.assertAlmostEqual(lat, LAT)
+        self.assertAlmostEqual(lon, LON)
+        self.assertAlmostEqual(acc, 2000.0)
+        # Tiny range from the database is not trusted
+        self.assertAlmostEqual(
+            centroid([(LAT, LON, 1.0, 10.0, -70)])[2], opencellid.MINRANGE
+        )
+
+    def test_symmetric(self) -> None:
+        data: List[Cell] = [
+            (LAT + STEP, LON, 500.0, 10.0, -80),
+            (LAT - STEP, LON, 500.0, 10.0, -80),
+            (LAT, LON + STEP, 500.0, 10.0, -80),
+            (LAT, LON - STEP, 500.0, 10.0, -80),
+        ]
+        lat, lon, acc = centroid(data)
+        self.assertAlmostEqual(lat, LAT)
+        self.assertAlmostEqual(lon, LON)
+        # Cells are 1 km and 0.6 km from the centre
+        self.assertGreater(acc, 900.0)
+        self.assertLess(acc, 1100.0)
+
+    def test_pull(self) -> None:
+        north, south = (LAT + STEP, LON), (LAT - STEP, LON)
+        even = centroid(
+            [(*north, 500.0, 10.0, -80), (*south, 500.0, 10.0, -80)]
+        )
+        self.assertAlmostEqual(even[0], LAT)
+        for data in (
+            # Stronger signal
+            [(*north, 500.0, 10.0, -60), (*south, 500.0, 10.0, -90)],
+            # Smaller cell
+            [(*north, 200.0, 10.0, -80), (*south, 2000.0, 10.0, -80)],
+            # Better known cell
+            [(*north, 500.0, 100.0, -80), (*south, 500.0, 1.0, -80)],
+        ):
+            lat, lon, _ = centroid(data)
+            self.assertGreater(lat, LAT)
+            self.assertAlmostEqual(lon, LON)
+
+    def test_nosignal(self) -> None:
+        # Terminals that do not report signal strength send zero
+        self.assertEqual(
+            centroid(
+                [(LAT, LON, 500.0, 10.0, 0), (LAT + STEP, LON, 500.0, 10.0, 0)]
+            ),
+            centroid(
+                [
+                    (LAT, LON, 500.0, 10.0, -100),
+                    (LAT + STEP, LON, 500.0, 10.0, -100),
+                ]
+            ),
+        )
+
+    def test_index(self) -> None:
+        index = CellIndex(
+            [
+                (262, 1, 100, 1000, LAT, LON, 500.0, 3.0),
+                (262, 1, 100, 1000, LAT + STEP, LON, 700.0, 5.0),
+                (262, 1, 100, 1 << 30, LAT, LON + STEP, 900.0, 7.0),
+            ]
+        )
+        self.assertEqual(
+            sorted(index.get(262, 1, 100, 1000)),
+            [(LAT, LON, 500.0, 3.0), (LAT + STEP, LON, 700.0, 5.0)],
+        )
+        self.assertEqual(
+            index.get(262, 1, 100, 1 << 30), [(LAT, LON + STEP, 900.0, 7.0)]
+        )
+
+
+class Lookup(unittest.TestCase):
+    def setUp(self) -> None:
+        fd, self.dbname = mkstemp(suffix=".sqlite")
+        close(fd)
+        with gzip.open(
+            path.join(path.dirname(__file__), "262.csv.gz"), "rt"
+        ) as fl, connect(self.dbname) as db:
+            db.execute(SCHEMA)
+            for row in csv.reader(fl):
+                db.execute(
+                    """insert into cells
+                       values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    row,
+                )
+            db.execute(DBINDEX)
+            self.cells = db.execute(
+                """select mcc, net, area, cell from cells
+                   where typeof(mcc) = 'integer'"""
+            ).fetchall()
+        self.conf = ConfigParser()
+        self.conf.read_dict(
+            {"opencellid": {"dbfn": self.dbname, "downloadmcc": "262"}}
+        )
+
+    def tearDown(self) -> None:
+        opencellid.shut()
+        opencellid.cells = None
+        unlink(self.dbname)
+
+    def _lookups(self) -> List[Tuple[float, float, float]]:
+        results = []
+        for num in range(0, len(self.cells) - 5, 3):
+            mcc, net, _, _ = self.cells[num]
+            results.append(
+                opencellid.lookup(
+                    mcc,
+                    net,
+                    [
+                        (area, cell, -60 - i)
+                        for i, (_, cnet, area, cell) in enumerate(
+                            self.cells[num : num + 4]
+                        )
+                        if cnet == net
+                    ]
+                    + [(1, 1, -90)],
+                    [],
+                )
+            )
+        return results
+
+    def test_inmemory(self) -> None:
+        opencellid.init(self.conf)
+        sqlresults = self._lookups()
+        opencellid.shut()
+        self.conf.set("opencellid", "inmemory", "yes")
+        opencellid.init(self.conf)
+        self.assertIsNotNone(opencellid.cells)
+        memresults = self._lookups()
+        self.assertTrue(sqlresults)
+        for sql, mem in zip(sqlresults, memresults):
+            for sqlval, memval in zip(sql, mem):
+                self.assertAlmostEqual(sqlval, memval)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,215 @@
+""" Behaviour of the collector towards subscribers and terminals """
+
+from socket import getaddrinfo, socket, AF_INET, SOCK_STREAM, SOL_SOCKET
+from socket import SO_RCVBUF
+from time import sleep, time
+from typing import Any, List, Tuple
+import unittest
+from unittest.mock import patch
+import zmq
+from .common import TestWithServers
+from loctrkd import collector
+from loctrkd.collector import Publisher
+from loctrkd.zmsg import Bcast, Resp, topic
+from loctrkd.zx303proto import enframe, LOGIN
+
+MAXSENDBUFFER: int = 1 << 20
+CHUNK: int = 8192
+
+
+class FakeSocket:
+    def __init__(self) -> None:
+        self.sent: List[List[bytes]] = []
+
+    def send_multipart(self, parts: List[bytes]) -> None:
+        self.sent.append(parts)
+
+
+class BatchPublish(unittest.TestCase):
+    def test_order(self) -> None:
+        zpub: Any = FakeSocket()
+        publisher = Publisher(zpub, batch=True)
+        msgs = [
+            Bcast(proto=proto, imei="9999123456780000", packet=bytes([n]))
+            for n, proto in enumerate(("STATUS", "LOGIN", "STATUS", "STATUS"))
+        ]
+        for msg in msgs:
+            publisher.send(msg)
+        publisher.flush()
+        # Only consecutive messages with the same topic are grouped
+        self.assertEqual(
+            zpub.sent,
+            [[msgs[0].packed], [msgs[1].packed], [m.packed for m in msgs[2:]]],
+        )
+        self.assertTrue(
+            all(
+                parts[0].startswith(topic("STATUS", True, "9999123456780000"))
+                for parts in zpub.sent[::2]
+            )
+        )
+        publisher.flush()
+        self.assertEqual(len(zpub.sent), 3)
+
+
+class Terminals(TestWithServers):
+    def setUp(self, *args: str, **kwargs: Any) -> None:
+        super().setUp("collector", **kwargs)
+        for fam, typ, pro, cnm, skadr in getaddrinfo(
+            "127.0.0.1",
+            self.conf.getint("collector", "port"),
+            family=AF_INET,
+            type=SOCK_STREAM,
+        ):
+            break  # Just take the first element
+        self.skadr = skadr
+        self.socks: List[socket] = []
+        self.zctx = zmq.Context()  # type: ignore
+        self.zpush = self.zctx.socket(zmq.PUSH)
+        self.zpush.connect(self.conf.get("collector", "listenurl"))
+
+    def tearDown(self) -> None:
+        for sock in self.socks:
+            sock.close()
+        self.zpush.close(linger=0)
+        self.zctx.destroy()
+        super().tearDown()
+
+    def _connect(self, imei: str) -> socket:
+        sock = socket(AF_INET, SOCK_STREAM)
+        # Small receive window, so that the collector's queue fills up
+        sock.setsockopt(SOL_SOCKET, SO_RCVBUF, 4096)
+        sock.settimeout(10)
+        sock.connect(self.skadr)
+        self.socks.append(sock)
+        sock.send(enframe(LOGIN.In(imei=imei, ver=9).packed))
+        self.assertTrue(sock.recv(4096), "No response to LOGIN")
+        return sock
+
+    def _push(self, imei: str, count: int) -> None:
+        for _ in range(count):
+            self.zpush.send(
+                Resp(imei=imei, when=time(), packet=b"x" * CHUNK).packed
+            )
+
+    def _drain(self, sock: socket, size: int) -> Tuple[int, bool]:
+        """Read up to `size` bytes, return how many and if the peer closed"""
+        total = 0
+        try:
+            while total < size:
+                got = len(sock.recv(min(size - total, 65536)))
+                if not got:
+                    return total, True
+                total += got
+        except ConnectionResetError:
+            return total, True
+        except OSError:  # Timeout
+            pass
+        return total, False
+
+
+class SendBuffer(Terminals):
+    def setUp(self, *args: str, **kwargs: Any) -> None:
+        super().setUp(
+            extraconf={"collector": {"maxsendbuffer": str(MAXSENDBUFFER)}}
+        )
+
+    def test_slow_reader(self) -> None:
+        framed = len(enframe(b"x" * CHUNK))
+        quiet = self._connect("9999000000000001")
+        slow = self._connect("9999000000000002")
+        # Much more than the socket buffers, but less than maxsendbuffer
+        self._push("9999000000000002", MAXSENDBUFFER // 2 // CHUNK)
+        # Terminal that never reads lets the queue grow over the limit
+        for _ in range(64):
+            self._push("9999000000000001", 4 * MAXSENDBUFFER // CHUNK // 64)
+            sleep(0.02)
+        sleep(2)
+        # Others are still served
+        other = self._connect("9999000000000003")
+        self._push("9999000000000003", 1)
+        self.assertEqual(self._drain(other, framed), (framed, False))
+        # Slow terminal gets everything queued for it, in time
+        size = MAXSENDBUFFER // 2 // CHUNK * framed
+        self.assertEqual(self._drain(slow, size), (size, False))
+        # And the one that did not read was disconnected
+        got, closed = self._drain(quiet, 4 * MAXSENDBUFFER // CHUNK * framed)
+        self.assertTrue(closed, f"Not disconnected after {got} bytes")
+
+
+class Housekeeping(Terminals):
+    def setUp(self, *args: str, **kwargs: Any) -> None:
+        super().setUp(
+            extraconf={
+                "collector": {"idletimeout": "2", "maxconnections": "3"}
+            }
+        )
+
+    def test_idle(self) -> None:
+        silent = self._connect("9999000000000001")
+        active = self._connect("9999000000000002")
+        for _ in range(8):
+            sleep(0.5)
+            active.send(
+                enframe(LOGIN.In(imei="9999000000000002", ver=9).packed)
+            )
+            self.assertTrue(active.recv(4096), "No response to LOGIN")
+        # Silent for 4s, more than twice the idletimeout
+        self.assertEqual(self._drain(silent, 4096), (0, True))
+        framed = len(enframe(b"x" * CHUNK))
+        self._push("9999000000000002", 1)
+        self.assertEqual(self._drain(active, framed), (framed, False))
+
+    def test_maxconnections(self) -> None:
+        socks = [self._connect(f"999900000000000{n}") for n in range(3)]
+        extra = socket(AF_INET, SOCK_STREAM)
+        extra.settimeout(10)
+        extra.connect(self.skadr)  # Accepted by the kernel regardless
+        self.socks.append(extra)
+        self.assertEqual(self._drain(extra, 4096), (0, True))
+        # Those that were there before are still served
+        framed = len(enframe(b"x" * CHUNK))
+        for n, sock in enumerate(socks):
+            self._push(f"999900000000000{n}", 1)
+            self.assertEqual(self._drain(sock, framed), (framed, False))
+
+
+class Workers(Terminals):
+    def setUp(self, *args: str, **kwargs: Any) -> None:
+        super().setUp(extraconf={"collector": {"workers": "3"}})
+
+    def test_routing(self) -> None:
+        imeis = [f"99990000000000{n:02d}" for n in range(12)]
+        # Spread over the workers by the kernel
+        socks = [self._connect(imei) for imei in imeis]
+        sleep(0.5)  # For the subscriptions to propagate
+        for n, imei in enumerate(imeis):
+            self.zpush.send(
+                Resp(imei=imei, when=time(), packet=bytes([n]) * 8).packed
+            )
+        for n, sock in enumerate(socks):
+            self.assertEqual(sock.recv(4096), enframe(bytes([n]) * 8))
+        # Nothing was sent to the terminals that it was not meant for
+        for sock in socks:
+            sock.settimeout(0.1)
+            self.assertEqual(self._drain(sock, 1), (0, False))
+
+
+class WorkerCrash(TestWithServers):
+    def setUp(self, *args: str, **kwargs: Any) -> None:
+        # Worker fails on start, and the collector should give up at once
+        with patch.object(collector, "MAXRESTARTS", 0):
+            super().setUp(
+                "collector",
+                extraconf={
+                    "collector": {"workers": "1", "eventloop": "nonesuch"}
+                },
+            )
+
+    def test_giveup(self) -> None:
+        srvname, proc = self.children.pop()
+        proc.join(10)
+        self.assertFalse(proc.is_alive(), "Collector did not give up")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+""" Late reports and interrupted runs of the columnar export """
+
+from datetime import datetime, timezone
+from math import pi
+from os import close, path, replace, unlink
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp
+from typing import Any, List
+import unittest
+from unittest.mock import patch
+from loctrkd import columnar, evstore
+
+try:
+    from loctrkd import colquery
+except ImportError:
+    colquery = None  # type: ignore
+
+IMEI: str = "9999123456780000"
+
+
+@unittest.skipIf(colquery is None, "numpy is not installed")
+class LateReports(unittest.TestCase):
+    def setUp(self) -> None:
+        fd, self.dbname = mkstemp(suffix=".sqlite")
+        close(fd)
+        unlink(self.dbname)
+        self.directory = mkdtemp()
+        evstore.initdb(self.dbname)
+
+    def tearDown(self) -> None:
+        assert evstore.DB is not None
+        evstore.DB.close()
+        unlink(self.dbname)
+        rmtree(self.directory)
+
+    def _stow(self, *nums: int, imei: str = IMEI) -> None:
+        for num in nums:
+            evstore.stowloc(
+                imei=imei,  # type: ignore
+                devtime=str(  # type: ignore
+                    datetime.fromtimestamp(1.6e9 + num, timezone.utc)
+                ),
+                latitude=float(num),  # type: ignore
+                longitude=-float(num),  # type: ignore
+                battery_percentage=num % 100,  # type: ignore
+            )
+        evstore.flush()
+
+    def _export(self) -> int:
+        assert evstore.DB is not None
+        return columnar.export(evstore.DB, self.directory)
+
+    def _check(self, nums: List[int]) -> None:
+        track = colquery.track(self.directory, IMEI)
+        # Epoch comes from julianday() and is not quite exact
+        self.assertEqual([round(e - 1.6e9) for e in track["epoch"]], nums)
+        self.assertEqual(list(track["latitude"]), [float(n) for n in nums])
+        self.assertEqual(list(track["longitude"]), [-float(n) for n in nums])
+
+    def _size(self, tail: bool = False) -> int:
+        return path.getsize(
+            columnar.columnfile(self.directory, IMEI, "latitude", tail)
+        )
+
+    def test_tail(self) -> None:
+        self._stow(*range(100, 120))
+        self.assertEqual(self._export(), 20)
+        self._stow(50, 121, 60)
+        self.assertEqual(self._export(), 3)
+        # Main columns are appended to, not rewritten
+        self.assertEqual(self._size(), 21 * 8)
+        self.assertEqual(self._size(tail=True), 2 * 8)
+        self._stow(55)
+        self._export()
+        self.assertEqual(self._size(tail=True), 3 * 8)
+        self._check([50, 55, 60] + list(range(100, 120)) + [121])
+        self.assertEqual(
+            len(
+                colquery.track(
+                    self.directory, IMEI, 1.6e9 + 54, 1.6e9 + 100.5
+                )["epoch"]
+            ),
+            3,
+        )
+        # Tail larger than 1/COMPACT of the main columns is merged
+        self._stow(*range(10, 20))
+        self._export()
+        self.assertEqual(self._size(tail=True), 0)
+        self.assertEqual(self._size(), 34 * 8)
+        self._check(
+            list(range(10, 20)) + [50, 55, 60] + list(range(100, 120)) + [121]
+        )
+
+    def test_track(self) -> None:
+        self._stow(*range(100, 150))
+        self._stow(*range(100, 150), imei="9999000000000001")
+        self._export()
+        track = colquery.track(self.directory, IMEI, 1.6e9 + 110, 1.6e9 + 120)
+        self.assertEqual(
+            [round(e - 1.6e9) for e in track["epoch"]], list(range(110, 120))
+        )
+        self.assertEqual(
+            list(track["battery"]), [float(n) for n in range(10, 20)]
+        )
+        # 9 steps of one degree along a meridian
+        self.assertAlmostEqual(
+            colquery.distance(track["latitude"], track["latitude"] * 0),
+            9 * pi / 180 * colquery.EARTHRADIUS,
+        )
+        self.assertEqual(len(colquery.track(self.directory, "nosuch")), 5)
+        self.assertEqual(
+            len(colquery.track(self.directory, "nosuch")["epoch"]), 0
+        )
+
+    def test_interrupted(self) -> None:
+        self._stow(*range(100, 120))
+        self._export()
+        self._stow(*range(10, 20), 120)
+        calls: List[Any] = []
+
+        def crash(src: str, dst: str) -> None:
+            # Die after the first column has been renamed
+            if src.endswith(".f64.new") and calls:
+                raise KeyboardInterrupt
+            calls.append(src)
+            replace(src, dst)
+
+        with patch.object(columnar, "replace", crash):
+            with self.assertRaises(KeyboardInterrupt):
+                self._export()
+        # Next run completes the renames before anything else
+        self.assertEqual(self._export(), 0)
+        self._check(list(range(10, 20)) + list(range(100, 121)))
+        self._stow(121)
+        self.assertEqual(self._export(), 1)
+        self._check(list(range(10, 20)) + list(range(100, 122)))
+
+
+if __name__ == "__main__":
+    unittest.main()
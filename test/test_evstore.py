@@ -0,0 +1,397 @@
+""" Event store: group commit, partitions, archive, readers, positions """
+
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from contextlib import closing
+from datetime import datetime, timezone
+from os import close, unlink
+from sqlite3 import connect, OperationalError
+from tempfile import mkstemp
+from time import time
+from typing import Any, Dict, Tuple
+import unittest
+from unittest.mock import patch
+from loctrkd import archive, evstore
+from loctrkd.evstore import PARTITIONED
+
+IMEI: str = "9999123456780000"
+
+
+class Evstore(unittest.TestCase):
+    def setUp(self) -> None:
+        fd, self.dbname = mkstemp(suffix=".sqlite")
+        close(fd)
+        unlink(self.dbname)
+
+    def tearDown(self) -> None:
+        evstore.flush()
+        assert evstore.DB is not None
+        evstore.DB.close()
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                unlink(self.dbname + suffix)
+            except FileNotFoundError:
+                pass
+
+    def _stowloc(self, imei: str, epoch: float, **kwargs: Any) -> None:
+        report: Dict[str, Any] = {
+            "imei": imei,
+            "devtime": str(datetime.fromtimestamp(epoch, timezone.utc)),
+            "latitude": 53.5,
+            "longitude": 12.7,
+        }
+        report.update(kwargs)
+        evstore.stowloc(**report)
+
+    def test_commit(self) -> None:
+        runs: Tuple[Dict[str, Any], ...] = (
+            {},
+            {"wal": True, "synchronous": "normal"},
+            {"wal": True, "synchronous": "normal", "commitrows": 10},
+        )
+        for kwargs in runs:
+            evstore.initdb(self.dbname, **kwargs)
+            for num in range(25):
+                evstore.stow(
+                    peeraddr="('192.0.2.1', 4303)",
+                    when=time(),
+                    imei=IMEI,
+                    proto="ZX:STATUS",
+                    packet=num.to_bytes(4, "big"),
+                )
+            evstore.flush()
+        with connect(self.dbname) as db:
+            (count,) = db.execute("select count(*) from events").fetchone()
+        self.assertEqual(count, 3 * 25)
+
+    def test_commit_pending(self) -> None:
+        evstore.initdb(self.dbname, commitrows=100, commitmsec=50)
+        evstore.stowpmod(IMEI, "zx303proto")
+        due = evstore.commit_pending()
+        assert due is not None
+        self.assertLessEqual(due, 50)
+        self.assertEqual(evstore.NPENDING, 1)
+        evstore.OLDEST -= 0.05
+        self.assertIsNone(evstore.commit_pending())
+        self.assertEqual(evstore.NPENDING, 0)
+        self.assertEqual(evstore.fetchpmod(IMEI), "zx303proto")
+
+    def test_pmod_cache(self) -> None:
+        evstore.initdb(self.dbname)
+        evstore.stowpmod(IMEI, "zx303proto")
+        assert evstore.DB is not None
+        evstore.DB.execute("update pmodmap set tstamp = 0")
+        evstore.DB.commit()
+        # Same mapping, recently written: the row is not touched
+        evstore.stowpmod(IMEI, "zx303proto")
+        self.assertIsNone(evstore.fetchpmod(IMEI))
+        # Mapping changed: written at once
+        evstore.stowpmod(IMEI, "beesure")
+        self.assertEqual(evstore.fetchpmod(IMEI), "beesure")
+        # Same mapping, but time to refresh the timestamp
+        evstore.DB.execute("update pmodmap set tstamp = 0")
+        evstore.DB.commit()
+        imei, (pmod, when) = next(iter(evstore.PMODCACHE.items()))
+        evstore.PMODCACHE[imei] = (pmod, when - evstore.PMODREFRESH)
+        evstore.stowpmod(IMEI, "beesure")
+        self.assertEqual(evstore.fetchpmod(IMEI), "beesure")
+
+    def test_pmod_dropped(self) -> None:
+        evstore.initdb(self.dbname, commitrows=10)
+        evstore.stowpmod(IMEI, "zx303proto")
+        # A row that cannot be bound makes the whole batch dropped
+        evstore._queue(
+            "insert into pmodmap (imei, pmod) values (:imei, :pmod)",
+            {"imei": IMEI[::-1], "pmod": object()},
+        )
+        with self.assertRaises(Exception):
+            evstore.flush()
+        self.assertIsNone(evstore.fetchpmod(IMEI))
+        # The mapping was never stored, so it is not taken from the cache
+        evstore.stowpmod(IMEI, "zx303proto")
+        self.assertEqual(evstore.NPENDING, 1)
+        evstore.flush()
+        self.assertEqual(evstore.fetchpmod(IMEI), "zx303proto")
+
+    def test_maxpending(self) -> None:
+        evstore.initdb(self.dbname, maxpending=3)
+        assert evstore.DB is not None
+        evstore.DB.execute("pragma busy_timeout = 0")
+        with closing(connect(self.dbname)) as other:
+            other.execute("begin exclusive")
+            for num in range(1, 3):
+                with self.assertRaises(OperationalError):
+                    evstore.stowpmod(IMEI[:-1] + str(num), "zx303proto")
+                self.assertEqual(evstore.NPENDING, num)
+            with self.assertLogs("loctrkd/evstore", "ERROR"):
+                with self.assertRaises(OperationalError):
+                    evstore.stowpmod(IMEI, "zx303proto")
+            self.assertEqual(evstore.NPENDING, 0)
+            other.rollback()
+        self.assertEqual(evstore.committed(), 0)
+        evstore.stowpmod(IMEI, "beesure")
+        self.assertEqual(evstore.committed(), 1)
+        self.assertEqual(evstore.fetchpmod(IMEI), "beesure")
+        self.assertIsNone(evstore.fetchpmod(IMEI[:-1] + "1"))
+
+    def test_backlog(self) -> None:
+        # Database in the old format: no devepoch column, no indexes
+        with connect(self.dbname) as db:
+            db.execute(
+                """create table reports (
+                imei text,
+                devtime text not null,
+                accuracy real,
+                latitude real,
+                longitude real,
+                remainder text
+            )"""
+            )
+            db.executemany(
+                """insert into reports
+                   (imei, devtime, accuracy, latitude, longitude, remainder)
+                   values (?, ?, 10.0, 53.5, 12.7, '{}')""",
+                (
+                    (
+                        f"{9999000000000000 + num % 3:016d}",
+                        str(datetime.fromtimestamp(1.6e9 + num, timezone.utc)),
+                    )
+                    for num in range(30)
+                ),
+            )
+        evstore.initdb(self.dbname)
+        backlog = evstore.fetch(f"{9999000000000000:016d}", 5)
+        self.assertEqual(
+            [report["devtime"] for report in backlog],
+            [
+                str(datetime.fromtimestamp(1.6e9 + num, timezone.utc))
+                for num in range(15, 30, 3)
+            ],
+        )
+
+    def test_latest(self) -> None:
+        evstore.initdb(self.dbname)
+        for num in range(30):
+            self._stowloc(
+                f"{9999000000000000 + num % 3:016d}",
+                1.6e9 + num,
+                longitude=12.7 + num,
+            )
+        # Late report does not replace the newer one
+        self._stowloc(f"{9999000000000002:016d}", 1.6e9, longitude=0.0)
+        evstore.flush()
+        latest = evstore.fetchlatest()
+        self.assertEqual(len(latest), 3)
+        self.assertEqual(
+            evstore.fetchlatest([f"{9999000000000002:016d}"])[0]["longitude"],
+            12.7 + 29,
+        )
+        # Existing database gets the table populated
+        assert evstore.DB is not None
+        evstore.DB.execute("drop table latest")
+        evstore.DB.commit()
+        evstore.initdb(self.dbname)
+        self.assertEqual(
+            sorted(evstore.fetchlatest(), key=lambda r: str(r["imei"])),
+            sorted(latest, key=lambda r: str(r["imei"])),
+        )
+
+    def test_latest_notime(self) -> None:
+        evstore.initdb(self.dbname)
+        # First fix of the terminal has no valid time
+        self._stowloc(IMEI, 1.6e9, devtime="None", longitude=1.0)
+        evstore.flush()
+        self.assertEqual(evstore.fetchlatest([IMEI])[0]["longitude"], 1.0)
+        self._stowloc(IMEI, 1.6e9, longitude=2.0)
+        evstore.flush()
+        self.assertEqual(evstore.fetchlatest([IMEI])[0]["longitude"], 2.0)
+        self._stowloc(IMEI, 1.6e9, devtime="None", longitude=3.0)
+        evstore.flush()
+        self.assertEqual(evstore.fetchlatest([IMEI])[0]["longitude"], 2.0)
+
+    def test_partitions(self) -> None:
+        now = time()
+        evstore.initdb(self.dbname, partition="day", retention=3)
+        evstore.stow(
+            peeraddr="('192.0.2.1', 4303)",
+            when=now - 10 * 86400,
+            imei=IMEI,
+            proto="ZX:STATUS",
+        )
+        assert evstore.DB is not None
+        # Row past the retention period does not create a partition
+        self.assertEqual(evstore.partitions(evstore.DB, "events"), ["events"])
+        for days in range(5, -1, -1):
+            evstore.stow(
+                peeraddr="('192.0.2.1', 4303)",
+                when=now - days * 86400,
+                imei=IMEI,
+                proto="ZX:STATUS",
+                packet=days.to_bytes(4, "big"),
+            )
+        self._stowloc(IMEI, now)
+        names = evstore.partitions(evstore.DB, "events")
+        # Partition with the current day is created last, and drops
+        # those that are entirely older than the retention period.
+        self.assertEqual(len(names), 4 + 1)
+        self.assertEqual(names[-1], "events")
+        self.assertEqual(
+            names[0],
+            datetime.fromtimestamp(now, timezone.utc).strftime(
+                "events_%Y%m%d"
+            ),
+        )
+        self.assertEqual(len(evstore.fetch(IMEI, 10)), 1)
+        evstore.expire(now + 86400)
+        self.assertEqual(len(evstore.partitions(evstore.DB, "events")), 3 + 1)
+
+    def test_late(self) -> None:
+        now = time()
+        evstore.initdb(self.dbname, partition="day")
+        with patch.object(evstore, "time", return_value=now - 86400):
+            for num in range(5):
+                self._stowloc(IMEI, 1.6e9 + num)
+        # Arrives late, or the terminal's clock is wrong
+        self._stowloc(IMEI, 1.6e9 - 100)
+        evstore.flush()
+        assert evstore.DB is not None
+        self.assertEqual(len(evstore.partitions(evstore.DB, "reports")), 3)
+        self.assertEqual(
+            [report["devtime"] for report in evstore.fetch(IMEI, 3)],
+            [
+                str(datetime.fromtimestamp(1.6e9 + num, timezone.utc))
+                for num in range(2, 5)
+            ],
+        )
+        self.assertEqual(
+            [report["devtime"] for report in evstore.fetch(IMEI, 10)],
+            [
+                str(datetime.fromtimestamp(1.6e9 + num, timezone.utc))
+                for num in (-100, 0, 1, 2, 3, 4)
+            ],
+        )
+        self.assertNotIn("devepoch", evstore.fetch(IMEI, 1)[0])
+
+    def test_archive(self) -> None:
+        evstore.initdb(self.dbname)
+        start = time() - 3 * 86400
+        for num in range(100):
+            evstore.stow(
+                peeraddr="('192.0.2.1', 4303)",
+                when=start + num * 1728,
+                imei=IMEI,
+                proto="BS:UD",
+                packet=f"[SG*9999123456*0080*UD,{num % 60:02d}0123,"
+                "123456,A,53.500000,N,12.700000,E,0.00,0.0,0.0,7,100,"
+                "80,12345,0,00000000,1,1,460,0,9360,4082,131]".encode(),
+            )
+        evstore.flush()
+        assert evstore.DB is not None
+        original = [
+            tuple(row)
+            for row in evstore.DB.execute(
+                """select tstamp, imei, peeraddr, is_incoming, proto, packet
+                   from events order by tstamp"""
+            )
+        ]
+        (rawsize,) = evstore.DB.execute(
+            "select sum(length(peeraddr) + length(proto) + length(packet))"
+            " from events"
+        ).fetchone()
+        self.assertEqual(evstore.archive(time() - 86400 / 2), 100)
+        (arcsize,) = evstore.DB.execute(
+            "select sum(length(data)) from archive"
+        ).fetchone()
+        self.assertLess(arcsize, rawsize)
+        (count,) = evstore.DB.execute("select count(*) from events").fetchone()
+        self.assertEqual(count, 0)
+        self.assertEqual(
+            [
+                (tstamp, imei, peeraddr, int(is_incoming), proto, packet)
+                for tstamp, imei, peeraddr, is_incoming, proto, packet in (
+                    evstore.archived(evstore.DB, imei=IMEI)
+                )
+            ],
+            original,
+        )
+        self.assertEqual(
+            len(list(evstore.archived(evstore.DB, protos=("ZX:STATUS",)))), 0
+        )
+
+    def test_createdb(self) -> None:
+        evstore.createdb(self.dbname)
+        readers = evstore.Readers(self.dbname, 1)
+        with readers.connection() as db:
+            self.assertEqual(evstore.fetch(IMEI, 5, db=db), [])
+            self.assertEqual(evstore.fetchlatest(db=db), [])
+        readers.close()
+        # Existing database is not migrated
+        unlink(self.dbname)
+        with closing(connect(self.dbname)) as db:
+            db.execute("create table reports (imei text)")
+        evstore.createdb(self.dbname)
+        with closing(connect(self.dbname)) as db:
+            self.assertEqual(
+                db.execute("select name from sqlite_master").fetchall(),
+                [("reports",)],
+            )
+        unlink(self.dbname)
+        evstore.initdb(self.dbname)  # For tearDown
+
+    def test_archive_nomigrate(self) -> None:
+        # Database of an older version, not yet migrated by storage
+        with closing(connect(self.dbname)) as db:
+            db.execute(PARTITIONED["events"][0].format(name="events"))
+            db.execute("create table reports (imei text, devtime text)")
+            db.execute(
+                """insert into events (tstamp, imei, peeraddr, proto)
+                   values (?, ?, '', 'ZX:STATUS')""",
+                (time() - 10 * 86400, IMEI),
+            )
+            db.commit()
+        conf = ConfigParser()
+        conf.read_dict({"storage": {"dbfn": self.dbname, "archiveafter": "1"}})
+        archive.main(conf)
+        assert evstore.DB is not None
+        self.assertEqual(len(list(evstore.archived(evstore.DB))), 1)
+        self.assertEqual(
+            [
+                row[1]
+                for row in evstore.DB.execute("pragma table_info(reports)")
+            ],
+            ["imei", "devtime"],
+        )
+
+    def test_readers(self) -> None:
+        evstore.initdb(self.dbname, wal=True, commitrows=100)
+        for num in range(20):
+            self._stowloc(IMEI, 1.6e9 + num)
+        evstore.flush()
+        readers = evstore.Readers(self.dbname, 2)
+
+        def backlog(num: int) -> int:
+            with readers.connection() as db:
+                reports = evstore.fetch(IMEI, num, db=db)
+                # Uncommitted update is not visible, and does not block
+                self.assertTrue(all(r["accuracy"] is None for r in reports))
+                return len(reports)
+
+        assert evstore.DB is not None
+        evstore.DB.execute("update reports set accuracy = 10.0")
+        with ThreadPoolExecutor(4) as executor:
+            counts = list(executor.map(backlog, range(1, 21)))
+        evstore.DB.rollback()
+        self.assertEqual(counts, list(range(1, 21)))
+        evstore.stowpmod(IMEI, "zx303proto")
+        evstore.flush()
+        self.assertLessEqual(readers.opened, 2)
+        with readers.connection() as db:
+            self.assertEqual(evstore.fetchpmod(IMEI, db=db), "zx303proto")
+            with self.assertRaises(OperationalError):
+                db.execute("delete from reports")
+        readers.close()
+        self.assertEqual(readers.opened, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+""" Lookaside cache """
+
+from configparser import ConfigParser
+from os import close, unlink
+from tempfile import mkstemp
+from time import sleep
+from typing import List, Tuple
+import unittest
+from loctrkd.lookcache import LookupCache
+
+
+class FakeQry:
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def init(self, conf: ConfigParser) -> None:
+        pass
+
+    def shut(self) -> None:
+        pass
+
+    def lookup(
+        self,
+        mcc: int,
+        mnc: int,
+        gsm_cells: List[Tuple[int, int, int]],
+        wifi_aps: List[Tuple[str, int]],
+    ) -> Tuple[float, float, float]:
+        self.calls += 1
+        if not gsm_cells:
+            raise ValueError("No location data found")
+        return (53.5, 12.7 + gsm_cells[0][1], 100.0)
+
+
+class LookCache(unittest.TestCase):
+    def setUp(self) -> None:
+        fd, self.dbname = mkstemp(suffix=".sqlite")
+        close(fd)
+        self.qry = FakeQry()
+
+    def tearDown(self) -> None:
+        unlink(self.dbname)
+
+    def test_cache(self) -> None:
+        cache = LookupCache(self.qry, 2, 3600, self.dbname)
+        cache.init(ConfigParser())
+        first = cache.lookup(
+            262, 3, [(1, 1, -60), (1, 2, -70)], [("AA:BB", -50)]
+        )
+        # Same cells and access points, other order and signals
+        self.assertEqual(
+            cache.lookup(262, 3, [(1, 2, -80), (1, 1, -65)], [("aa:bb", -40)]),
+            first,
+        )
+        self.assertEqual((cache.hits, cache.misses, self.qry.calls), (1, 1, 1))
+        with self.assertRaises(ValueError):
+            cache.lookup(262, 3, [], [])
+        with self.assertRaises(ValueError):
+            cache.lookup(262, 3, [], [])
+        self.assertEqual(self.qry.calls, 3)
+        # Least recently used is evicted
+        cache.lookup(262, 3, [(1, 3, -60)], [])
+        cache.lookup(262, 3, [(1, 1, -60), (1, 2, -70)], [("AA:BB", -50)])
+        cache.lookup(262, 3, [(1, 4, -60)], [])
+        cache.lookup(262, 3, [(1, 1, -60), (1, 2, -70)], [("AA:BB", -50)])
+        self.assertEqual(self.qry.calls, 5)
+        cache.lookup(262, 3, [(1, 3, -60)], [])
+        self.assertEqual(self.qry.calls, 6)
+        cache.shut()
+        # Results survive restart
+        cache = LookupCache(self.qry, 2, 3600, self.dbname)
+        cache.init(ConfigParser())
+        cache.lookup(262, 3, [(1, 3, -60)], [])
+        cache.lookup(262, 3, [(1, 1, -60), (1, 2, -70)], [("AA:BB", -50)])
+        self.assertEqual(self.qry.calls, 6)
+        cache.shut()
+
+    def test_ttl(self) -> None:
+        cache = LookupCache(self.qry, 10, 0.1)
+        cache.init(ConfigParser())
+        cache.lookup(262, 3, [(1, 1, -60)], [])
+        cache.lookup(262, 3, [(1, 1, -60)], [])
+        self.assertEqual(self.qry.calls, 1)
+        sleep(0.2)
+        cache.lookup(262, 3, [(1, 1, -60)], [])
+        self.assertEqual(self.qry.calls, 2)
+        cache.shut()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+""" Many terminals connecting to the collector at once """
+
+from resource import getrlimit, RLIMIT_NOFILE
+from selectors import DefaultSelector, EVENT_READ
+from socket import getaddrinfo, socket, AF_INET, SOCK_STREAM
+from time import time
+from typing import Any, List
+import unittest
+from .common import TestWithServers
+from loctrkd.zx303proto import enframe, LOGIN
+
+NUMCONN: int = 1000
+
+
+class ReconnectStorm(TestWithServers):
+    def setUp(self, *args: str, **kwargs: Any) -> None:
+        super().setUp("collector")
+        for fam, typ, pro, cnm, skadr in getaddrinfo(
+            "127.0.0.1",
+            self.conf.getint("collector", "port"),
+            family=AF_INET,
+            type=SOCK_STREAM,
+        ):
+            break  # Just take the first element
+        self.skadr = skadr
+        self.socks: List[socket] = []
+
+    def tearDown(self) -> None:
+        for sock in self.socks:
+            sock.close()
+        super().tearDown()
+
+    def test_reconnect(self) -> None:
+        # Both we and the collector need an fd per connection
+        numconn = min(NUMCONN, getrlimit(RLIMIT_NOFILE)[0] - 64)
+        start = time()
+        for _ in range(numconn):
+            sock = socket(AF_INET, SOCK_STREAM)
+            sock.connect(self.skadr)
+            self.socks.append(sock)
+        for num, sock in enumerate(self.socks):
+            imei = f"{9999000000000000 + num:016d}"
+            sock.send(enframe(LOGIN.In(imei=imei, ver=9).packed))
+        sel = DefaultSelector()
+        for sock in self.socks:
+            sock.setblocking(False)
+            sel.register(sock, EVENT_READ)
+        answered = 0
+        while answered < numconn and time() - start < 30:
+            for key, _ in sel.select(timeout=1):
+                sel.unregister(key.fileobj)
+                if key.fileobj.recv(4096):  # type: ignore
+                    answered += 1
+        self.assertEqual(answered, numconn, "Not all logged in within 30s")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+""" Concurrent lookups in the rectifier """
+
+from concurrent.futures import Future
+from functools import partial
+from select import select
+from threading import Event
+from time import perf_counter, sleep
+from typing import List, Optional, Tuple
+import unittest
+from loctrkd.rectifier import Lookups
+
+
+class RectifierLookups(unittest.TestCase):
+    def setUp(self) -> None:
+        self.lookups = Lookups(4, 0.5)
+        self.results: List[Tuple[str, int, Optional[int]]] = []
+
+    def tearDown(self) -> None:
+        self.lookups.close()
+
+    def _then(self, imei: str, num: int, future: "Future[int]") -> None:
+        self.results.append(
+            (imei, num, future.result() if future.done() else None)
+        )
+
+    def _submit(self, imei: str, num: int, delay: float) -> None:
+        def func() -> int:
+            sleep(delay)
+            return num
+
+        self.lookups.submit(imei, func, partial(self._then, imei, num))
+
+    def _wait(self, count: int) -> None:
+        while True:
+            due = self.lookups.process()
+            if len(self.results) >= count:
+                break
+            select([self.lookups.fileno()], [], [], due)
+
+    def test_order(self) -> None:
+        start = perf_counter()
+        # Slow lookup of one terminal does not delay the other
+        for num, delay in enumerate((0.2, 0.0, 0.1)):
+            self._submit("1", num, delay)
+        self._submit("2", 0, 0.0)
+        self._wait(4)
+        self.assertEqual(self.results[0], ("2", 0, 0))
+        self.assertEqual(
+            [result for result in self.results if result[0] == "1"],
+            [("1", 0, 0), ("1", 1, 1), ("1", 2, 2)],
+        )
+        self.assertLess(perf_counter() - start, 0.5)
+        self.assertIsNone(self.lookups.process())
+
+    def test_timeout(self) -> None:
+        stuck = Event()
+        self.lookups.submit(
+            "1", partial(stuck.wait, 5), partial(self._then, "1", 0)
+        )
+        self._submit("1", 1, 0.0)
+        self._wait(2)
+        self.assertEqual(self.results, [("1", 0, None), ("1", 1, 1)])
+        stuck.set()
+        # Late result of the given up lookup is ignored
+        sleep(0.1)
+        self.lookups.process()
+        self.assertEqual(len(self.results), 2)
+
+
+class RectifierBusy(unittest.TestCase):
+    def test_queued(self) -> None:
+        # Waiting for the only worker does not count against the timeout
+        lookups = Lookups(1, 0.3)
+        results: List[Tuple[str, bool]] = []
+        for imei in ("1", "2", "3"):
+            lookups.submit(
+                imei,
+                partial(sleep, 0.2),
+                lambda future, imei=imei: results.append(  # type: ignore
+                    (imei, future.done())
+                ),
+            )
+        try:
+            while True:
+                due = lookups.process()
+                if len(results) >= 3:
+                    break
+                select([lookups.fileno()], [], [], due)
+        finally:
+            lookups.close()
+        self.assertEqual(results, [("1", True), ("2", True), ("3", True)])
+
+
+if __name__ == "__main__":
+    unittest.main()
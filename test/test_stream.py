@@ -0,0 +1,47 @@
+""" Deframing of the terminal byte streams """
+
+from typing import List, Union
+import unittest
+from loctrkd import beesure, zx303proto
+from loctrkd.zx303proto import WIFI_OFFLINE_POSITIONING
+
+
+class Streams(unittest.TestCase):
+    def test_zx303(self) -> None:
+        frame = zx303proto.enframe(
+            WIFI_OFFLINE_POSITIONING.In(
+                mnc=3,
+                mcc=262,
+                wifi_aps=[("02:03:04:05:06:07", -89)],
+                gsm_cells=[(24420, 27178, -90), (24420, 36243, -78)],
+            ).packed
+        )
+        for segsize in (1, 7, len(frame), 3 * len(frame) - 1):
+            data = frame * 10
+            stream = zx303proto.Stream()
+            msgs = []
+            for pos in range(0, len(data), segsize):
+                msgs.extend(stream.recv(data[pos : pos + segsize]))
+            self.assertEqual(msgs, [frame[2:-2]] * 10, f"segsize {segsize}")
+
+    def test_beesure(self) -> None:
+        datalen = 0x8000
+        frame = (
+            f"[SG*1234567890*{datalen:04X}*".encode() + bytes(datalen) + b"]"
+        )
+        small = b"[SG*1234567890*0002*LK]"
+        # Junk before a header that is split between segments
+        data = bytes(0x4000) + frame + small
+        stream = beesure.Stream()
+        msgs: List[Union[bytes, str]] = []
+        for pos in range(0, len(data), 1460):
+            msgs.extend(
+                msg
+                for msg in stream.recv(data[pos : pos + 1460])
+                if isinstance(msg, bytes)
+            )
+        self.assertEqual(msgs, [frame, small])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+""" WiFi access point lookaside backend """
+
+from configparser import ConfigParser
+from os import close, unlink
+from random import Random
+from tempfile import mkstemp
+from typing import Any, List, Tuple
+import unittest
+from loctrkd import opencellid, wifiloc
+
+LAT: float = 52.52
+LON: float = 13.405
+STEP: float = 0.009  # About 1 km of latitude
+
+
+class FakeCells:
+    def __init__(self, result: Tuple[float, float, float]) -> None:
+        self.result = result
+
+    def shut(self) -> None:
+        pass
+
+    def lookup(
+        self,
+        mcc: int,
+        mnc: int,
+        gsm_cells: List[Tuple[int, int, int]],
+        wifi_aps: List[Tuple[str, int]],
+    ) -> Tuple[float, float, float]:
+        return self.result
+
+
+class WifiLoc(unittest.TestCase):
+    def setUp(self) -> None:
+        fd, self.dbname = mkstemp(suffix=".sqlite")
+        close(fd)
+        conf = ConfigParser()
+        conf.read_dict({"wifiloc": {"dbfn": self.dbname, "cells": ""}})
+        wifiloc.init(conf)
+
+    def tearDown(self) -> None:
+        wifiloc.shut()
+        wifiloc.cells = None
+        unlink(self.dbname)
+
+    def _walk(self, mac: str, lat: float, lon: float, count: int) -> None:
+        # Fixes scattered up to 50 m around the access point
+        rnd = Random(mac)
+        for _ in range(count):
+            wifiloc.learn(
+                [(mac, rnd.randint(-90, -40))],
+                lat + rnd.uniform(-0.00045, 0.00045),
+                lon + rnd.uniform(-0.0007, 0.0007),
+                rnd.uniform(5.0, 30.0),
+            )
+
+    def test_learn(self) -> None:
+        self._walk("AA:BB:CC:00:00:01", LAT, LON, 50)
+        self._walk("aa:bb:cc:00:00:02", LAT + 0.001, LON, 50)
+        # Too inaccurate to learn from
+        self.assertEqual(
+            wifiloc.learn([("aa:bb:cc:00:00:03", -50)], LAT, LON, 500.0), 0
+        )
+        lat, lon, acc = wifiloc.lookup(
+            262,
+            1,
+            [],
+            [("aa:bb:cc:00:00:01", -50), ("AA:BB:CC:00:00:03", -50)],
+        )
+        self.assertLess(wifiloc._distance(lat, lon, LAT, LON), 15.0)
+        self.assertGreater(acc, 20.0)
+        self.assertLess(acc, 150.0)
+        lat, _, _ = wifiloc.lookup(
+            262,
+            1,
+            [],
+            [("aa:bb:cc:00:00:01", -50), ("aa:bb:cc:00:00:02", -50)],
+        )
+        self.assertGreater(lat, LAT + 0.0003)
+        self.assertLess(lat, LAT + 0.0007)
+        with self.assertRaises(ValueError):
+            wifiloc.lookup(262, 1, [], [("aa:bb:cc:00:00:03", -50)])
+
+    def test_moved(self) -> None:
+        self._walk("aa:bb:cc:00:00:01", LAT, LON, 20)
+        wifiloc.learn([("aa:bb:cc:00:00:01", -50)], LAT + STEP * 5, LON, 10.0)
+        lat, _, acc = wifiloc.lookup(262, 1, [], [("aa:bb:cc:00:00:01", -50)])
+        self.assertAlmostEqual(lat, LAT + STEP * 5)
+        # Accuracy of the fix, not the cell tower minimum range
+        self.assertAlmostEqual(acc, 10.0)
+        wifiloc.learn([("aa:bb:cc:00:00:01", -50)], LAT + STEP * 5, LON, 1.0)
+        _, _, acc = wifiloc.lookup(262, 1, [], [("aa:bb:cc:00:00:01", -50)])
+        self.assertGreaterEqual(acc, wifiloc.MINACCURACY)
+        self.assertLess(acc, 10.0)
+
+    def test_cells(self) -> None:
+        self._walk("aa:bb:cc:00:00:01", LAT, LON, 20)
+        self._walk("aa:bb:cc:00:00:02", LAT + STEP * 10, LON, 20)
+        wifiloc.cells = FakeCells((LAT + STEP, LON, 1500.0))
+        aps = [("aa:bb:cc:00:00:01", -60), ("aa:bb:cc:00:00:02", -60)]
+        cells = [(100, 1000, -70)]
+        # Second access point is far from the cells, and is not used
+        lat, lon, acc = wifiloc.lookup(262, 1, cells, aps)
+        self.assertGreater(lat, LAT)
+        self.assertLess(lat, LAT + STEP * 0.1)
+        self.assertLess(acc, opencellid.MINRANGE)
+        # Only the cells, when no access point is known
+        self.assertEqual(
+            wifiloc.lookup(262, 1, cells, [("aa:bb:cc:00:00:04", -60)]),
+            (LAT + STEP, LON, 1500.0),
+        )
+        self.assertEqual(
+            wifiloc.lookup(262, 1, cells, aps[1:]), (LAT + STEP, LON, 1500.0)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+""" Storage writer thread with the queue overflowing """
+
+from configparser import ConfigParser
+from os import close, unlink
+from sqlite3 import connect
+from tempfile import mkstemp
+from time import time
+from typing import List
+import unittest
+from loctrkd.evstore import committed
+from loctrkd.storage import BCAST, REPT, Writer
+from loctrkd.zmsg import Bcast, Rept
+
+QUEUESIZE: int = 10
+MESSAGES: int = 25
+
+
+class QueueFull(unittest.TestCase):
+    def setUp(self) -> None:
+        fd, self.dbname = mkstemp(suffix=".sqlite")
+        close(fd)
+        unlink(self.dbname)
+        self.conf = ConfigParser()
+        self.conf["storage"] = {
+            "dbfn": self.dbname,
+            "events": "yes",
+            "queuesize": str(QUEUESIZE),
+        }
+
+    def tearDown(self) -> None:
+        for suffix in ("", "-wal", "-shm", ".journal", ".journal.replay"):
+            try:
+                unlink(self.dbname + suffix)
+            except FileNotFoundError:
+                pass
+
+    def _run(self, policy: str) -> Writer:
+        self.conf["storage"]["queuefull"] = policy
+        writer = Writer(self.conf)
+        # Writer is not started yet, so the queue overflows
+        for num in range(MESSAGES):
+            writer.put(
+                BCAST,
+                Bcast(
+                    proto="ZX:STATUS",
+                    imei="9999123456780000",
+                    when=time(),
+                    packet=num.to_bytes(4, "big"),
+                ).packed,
+            )
+        writer.start()
+        writer.ready.wait()
+        writer.stop()
+        return writer
+
+    def _stored(self) -> List[int]:
+        with connect(self.dbname) as db:
+            return [
+                int.from_bytes(packet, "big")
+                for packet, in db.execute(
+                    "select packet from events order by rowid"
+                )
+            ]
+
+    def test_dropoldest(self) -> None:
+        writer = self._run("dropoldest")
+        self.assertEqual(writer.dropped, MESSAGES - QUEUESIZE)
+        self.assertEqual(writer.maxdepth, QUEUESIZE)
+        self.assertEqual(
+            self._stored(), list(range(MESSAGES - QUEUESIZE, MESSAGES))
+        )
+
+    def test_spill(self) -> None:
+        writer = self._run("spill")
+        self.assertEqual(writer.spilled, MESSAGES - QUEUESIZE)
+        self.assertEqual(sorted(self._stored()), list(range(MESSAGES)))
+        self.assertEqual(committed(), MESSAGES)
+
+
+class BadMessages(unittest.TestCase):
+    def setUp(self) -> None:
+        fd, self.dbname = mkstemp(suffix=".sqlite")
+        close(fd)
+        unlink(self.dbname)
+        self.conf = ConfigParser()
+        self.conf["storage"] = {
+            "dbfn": self.dbname,
+            "queuesize": str(QUEUESIZE),
+        }
+
+    def tearDown(self) -> None:
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                unlink(self.dbname + suffix)
+            except FileNotFoundError:
+                pass
+
+    def test_survive(self) -> None:
+        writer = Writer(self.conf)
+        writer.start()
+        writer.ready.wait()
+        # Report without "type" used to kill the writer
+        writer.put(REPT, Rept(imei="9999123456780000", payload="{}").packed)
+        writer.put(
+            REPT,
+            Rept(
+                imei="9999123456780000",
+                payload='{"type": "location", "devtime": "2022-05-27",'
+                ' "latitude": 1.0, "longitude": 2.0}',
+            ).packed,
+        )
+        writer.stop()
+        with connect(self.dbname) as db:
+            self.assertEqual(
+                db.execute("select latitude from reports").fetchall(),
+                [(1.0,)],
+            )
+        self.assertEqual(writer.failed, 1)
+        # The report and the latest position of the device
+        self.assertEqual(committed(), 2)
+
+    def test_dead(self) -> None:
+        writer = Writer(self.conf)
+        # Never started, so it is not alive and puts must not hang
+        start = time()
+        for num in range(QUEUESIZE + 2):
+            writer.put(REPT, Rept(imei=None, payload="{}").packed)
+        self.assertEqual(writer.dropped, 2)
+        self.assertLess(time() - start, 5.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+""" Last known positions cached in the websocket gateway """
+
+from datetime import datetime, timedelta, timezone
+from os import close, unlink
+from select import select
+from sqlite3 import Connection
+from tempfile import mkstemp
+from time import sleep
+from typing import Any, Dict, List
+import unittest
+from loctrkd import evstore
+from loctrkd.wsgateway import backlog, fleet, location, Lookups, remember
+
+IMEI: str = "9999123456780000"
+
+
+class Positions(unittest.TestCase):
+    def setUp(self) -> None:
+        fd, self.dbname = mkstemp(suffix=".sqlite")
+        close(fd)
+        unlink(self.dbname)
+        evstore.initdb(self.dbname)
+
+    def tearDown(self) -> None:
+        assert evstore.DB is not None
+        evstore.DB.close()
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                unlink(self.dbname + suffix)
+            except FileNotFoundError:
+                pass
+
+    def _report(self, minutes: int, longitude: float) -> Dict[str, Any]:
+        return {
+            "type": "location",
+            "imei": IMEI,
+            "devtime": str(
+                datetime(2022, 5, 27, tzinfo=timezone.utc)
+                + timedelta(minutes=minutes)
+            ),
+            "accuracy": 10.0,
+            "latitude": 53.5,
+            "longitude": longitude,
+            "battery_percentage": 50,
+        }
+
+    def test_shape(self) -> None:
+        # Cached live report looks like what backlog() returns
+        live = self._report(0, 12.7)
+        stored = dict(live)
+        stored.pop("type")
+        evstore.stowloc(**stored)
+        evstore.flush()
+        self.assertEqual(location(dict(live)), backlog(IMEI, 1)[0])
+
+    def test_order(self) -> None:
+        positions: Dict[str, Dict[str, Any]] = {}
+        remember(positions, location(self._report(10, 1.0)))
+        # Fix that arrived late does not replace the newer one
+        remember(positions, location(self._report(5, 2.0)))
+        self.assertEqual(positions[IMEI]["longitude"], 1.0)
+        remember(positions, location(self._report(10, 3.0)))
+        self.assertEqual(positions[IMEI]["longitude"], 3.0)
+        # Nor does one without valid time
+        late = self._report(20, 4.0)
+        late["devtime"] = "None"
+        remember(positions, location(late))
+        self.assertEqual(positions[IMEI]["longitude"], 3.0)
+        remember(positions, location(self._report(20, 5.0)))
+        self.assertEqual(positions[IMEI]["longitude"], 5.0)
+
+    def test_fleet(self) -> None:
+        for num in range(3):
+            report = self._report(num, float(num))
+            report.pop("type")
+            report["imei"] = f"{9999000000000000 + num:016d}"
+            evstore.stowloc(**report)
+        evstore.flush()
+        positions = sorted(fleet(), key=lambda r: str(r["imei"]))
+        self.assertEqual(
+            positions,
+            [
+                backlog(f"{9999000000000000 + num:016d}", 1)[0]
+                for num in range(3)
+            ],
+        )
+
+    def test_commands(self) -> None:
+        def slow(num: int, db: Connection) -> int:
+            sleep(0.1 * (3 - num))
+            return num
+
+        lookups = Lookups(self.dbname, 4)
+        try:
+            for num in range(3):
+                lookups.submit(None, {}, slow, num, key=IMEI)
+            lookups.submit(None, {}, slow, 3)
+            done: List[int] = []
+            while len(done) < 4:
+                self.assertTrue(select([lookups], [], [], 5)[0], "Timeout")
+                done.extend(result for _, _, result in lookups.completed())
+            # Queries for one IMEI complete in order, others do not wait
+            self.assertEqual(done, [3, 0, 1, 2])
+            self.assertEqual(lookups.queues, {})
+        finally:
+            lookups.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+""" Encoding and decoding of zmq messages """
+
+from json import loads
+from time import time
+import unittest
+from loctrkd.common import CoordReport
+from loctrkd.zmsg import Bcast, Rept
+
+
+class Messages(unittest.TestCase):
+    def setUp(self) -> None:
+        self.bcast = Bcast(
+            proto="ZX:STATUS",
+            pmod="zx303proto",
+            imei="9999123456780000",
+            when=time(),
+            peeraddr=("::ffff:192.0.2.1", 4303, 0, 0),
+            packet=bytes(range(40)),
+        )
+
+    def test_bcast(self) -> None:
+        decoded = Bcast(self.bcast.packed)
+        self.assertEqual(decoded.imei, self.bcast.imei)
+        self.assertEqual(decoded.peeraddr, ("192.0.2.1", 4303))
+        self.assertEqual(decoded.packet, self.bcast.packet)
+        self.assertEqual(decoded.when, self.bcast.when)
+        self.assertEqual(decoded.pmod, self.bcast.pmod)
+        self.assertEqual(decoded.proto, self.bcast.proto)
+        self.assertIs(decoded.is_incoming, True)
+        with self.assertRaises(AttributeError):
+            getattr(decoded, "nosuchfield")
+
+    def test_assign(self) -> None:
+        decoded = Bcast(self.bcast.packed)
+        decoded.imei = "9999000000000001"
+        # Reading another field of the same group decodes the group
+        self.assertEqual(decoded.proto, "ZX:STATUS")
+        self.assertEqual(decoded.imei, "9999000000000001")
+        decoded = Bcast(self.bcast.packed)
+        decoded.is_incoming = False
+        decoded.packet = b"\1\2\3"
+        self.assertEqual(
+            Bcast(decoded.packed),
+            Bcast(
+                is_incoming=False,
+                proto="ZX:STATUS",
+                pmod="zx303proto",
+                imei="9999123456780000",
+                when=self.bcast.when,
+                peeraddr=("192.0.2.1", 4303),
+                packet=b"\1\2\3",
+            ),
+        )
+
+    def test_rept(self) -> None:
+        report = CoordReport(
+            devtime="2023-01-31 12:34:56+00:00",
+            battery_percentage=77,
+            accuracy=150.0,
+            altitude=None,
+            speed=None,
+            direction=None,
+            latitude=53.512345,
+            longitude=12.712345,
+        )
+        results = {}
+        for form in ("json", "binary"):
+            rept = Rept(
+                Rept(
+                    imei="9999123456780000", payload=getattr(report, form)
+                ).packed
+            )
+            self.assertEqual(rept.imei, "9999123456780000")
+            results[form] = rept.report
+        self.assertEqual(results["binary"], results["json"])
+        self.assertEqual(results["json"], loads(report.json))
+        self.assertEqual(results["json"]["type"], "location")
+
+
+if __name__ == "__main__":
+    unittest.main()